@@ -0,0 +1,283 @@
+# hotpaths.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+"""
+Benchmarks the parts of a build that run inside shardimg itself, on synthetic root trees.
+Doesn't need root, network access, pacman or flatpak.
+
+Usage: python3 benchmarks/hotpaths.py [--sizes 10000,100000,1000000] [--only NAME,...] [--workdir DIR] [--output FILE]
+
+Every benchmark runs in its own process, so that its peak memory can be measured.
+The results are printed as json, one object per benchmark and tree size.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+BENCHMARKS = ["fsguard_filelist", "fsguard_filelist_cached", "copy_tree", "parse_manifest", "flatpak_manifest"]
+# Share of files per size class: (share, smallest size, largest size)
+SIZE_CLASSES = [
+    (0.80, 0, 4 * 1024),
+    (0.19, 4 * 1024, 64 * 1024),
+    (0.01, 64 * 1024, 1024 * 1024),
+]
+LARGE_FILE_SIZE = 32 * 1024 * 1024
+FILES_PER_DIRECTORY = 200
+
+
+def create_tree(root: str, files: int, seed: int = 0) -> dict:
+    """
+    Creates a synthetic image root with the given number of files below root/usr.
+    Mixes small, medium and large files, relative and absolute symlinks and suid binaries.
+
+    Parameters:
+    root  (str): Where to create the root
+    files (int): How many files to create
+    seed  (int): Seed for the random generator, the same seed creates the same tree
+
+    Returns:
+    dict: The number of files and bytes in the tree
+    """
+    generator = random.Random(seed)
+    block = generator.randbytes(LARGE_FILE_SIZE)
+    created = []
+    total = 0
+    regular = int(files * 0.95)
+    for index in range(regular):
+        directory = f"{root}/usr/lib/d{index // FILES_PER_DIRECTORY:05d}"
+        if index % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory, exist_ok=True)
+        if index < max(1, files // 10000):
+            size = LARGE_FILE_SIZE
+        else:
+            pick = generator.random()
+            for (share, smallest, largest) in SIZE_CLASSES:
+                if pick < share:
+                    break
+                pick -= share
+            size = generator.randint(smallest, largest)
+        path = f"{directory}/f{index}"
+        offset = generator.randint(0, LARGE_FILE_SIZE - size)
+        with open(path, "wb") as f:
+            f.write(block[offset:offset + size])
+        if index % 1000 == 1:
+            os.chmod(path, 0o4755)
+        created.append(path)
+        total += size
+
+    os.makedirs(root + "/usr/bin", exist_ok=True)
+    for index in range(files - regular):
+        target = created[generator.randrange(len(created))]
+        if index % 2 == 0:
+            os.symlink(os.path.relpath(target, root + "/usr/bin"), f"{root}/usr/bin/l{index}")
+        else:
+            os.symlink(target.replace(root, "", 1), f"{root}/usr/bin/l{index}")
+    for directory in ["proc", "sys", "dev"]:
+        os.makedirs(root + "/" + directory, exist_ok=True)
+    return {"files": files, "bytes": total}
+
+
+def write_manifest(path: str, packages: int):
+    """
+    Writes a system manifest with the given number of packages and commands.
+    """
+    with open(path, "w") as f:
+        json.dump({
+            "name": "Bench",
+            "id": "org.shards.bench",
+            "version": "1.0",
+            "type": "system",
+            "base": "",
+            "author": "bench",
+            "packages": [f"package-{index}" for index in range(packages)],
+            "commands": [f"echo {index}" for index in range(packages // 10)],
+            "fsguard_enabled": True,
+            "fsguard_binary": "/usr/bin/FsGuard",
+            "fsguard_paths": ["usr"],
+        }, f)
+
+
+def run_benchmark(name: str, build_dir: str, tree: dict, scratch: str) -> dict:
+    """
+    Runs a single benchmark in the current process.
+
+    Parameters:
+    name      (str) : Name of the benchmark
+    build_dir (str) : Build directory containing the synthetic root
+    tree      (dict): Number of files and bytes in the synthetic root
+    scratch   (str) : Empty directory the benchmark may write to
+
+    Returns:
+    dict: The number of processed files and bytes and the runtime
+    """
+    from shardimg.functions.system import SystemImage
+    from shardimg.utils.checksum import ChecksumCache
+
+    files = tree["files"]
+    size = tree["bytes"]
+    if name == "fsguard_filelist":
+        start = time.perf_counter()
+        SystemImage.fsguard_filelist(["usr"], build_dir, "/usr/bin/FsGuard")
+        elapsed = time.perf_counter() - start
+    elif name == "fsguard_filelist_cached":
+        cache_path = scratch + "/checksums.sqlite"
+        cache = ChecksumCache(cache_path, build_dir + "/root")
+        SystemImage.fsguard_filelist(["usr"], build_dir, "/usr/bin/FsGuard", cache=cache)
+        cache.close()
+        start = time.perf_counter()
+        cache = ChecksumCache(cache_path, build_dir + "/root")
+        SystemImage.fsguard_filelist(["usr"], build_dir, "/usr/bin/FsGuard", cache=cache)
+        cache.close()
+        elapsed = time.perf_counter() - start
+    elif name == "copy_tree":
+        from shardimg.utils.files import FileUtils
+        start = time.perf_counter()
+        FileUtils.copy_directory(build_dir + "/root", scratch + "/root", True)
+        elapsed = time.perf_counter() - start
+    elif name == "parse_manifest":
+        from shardimg.classes.manifest import Manifest
+        write_manifest(scratch + "/manifest.json", 1000)
+        size = os.path.getsize(scratch + "/manifest.json")
+        files = 1000
+        start = time.perf_counter()
+        for run in range(files):
+            manifest = Manifest(manifest=scratch + "/manifest.json")
+            manifest.parse_manifest()
+        elapsed = time.perf_counter() - start
+        size *= files
+    elif name == "flatpak_manifest":
+        from shardimg.classes.manifest import Manifest
+        from shardimg.utils.shards import Shards
+        write_manifest(scratch + "/manifest.json", 100)
+        os.makedirs(scratch + "/modules")
+        for index in range(100):
+            with open(f"{scratch}/modules/module{index}.yml", "w") as f:
+                f.write("name: module\n")
+        manifest = Manifest(manifest=scratch + "/manifest.json")
+        manifest.parse_manifest()
+        files = 1000
+        start = time.perf_counter()
+        for run in range(files):
+            Shards.generate_flatpak_manifest(manifest, scratch)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(scratch + "/Bench.yml") * files
+    else:
+        raise ValueError(f"Unknown benchmark {name}")
+    return {"files": files, "bytes": size, "seconds": elapsed}
+
+
+def measure(name: str, build_dir: str, tree: dict) -> dict:
+    """
+    Runs a benchmark in a child process and collects its runtime and peak memory.
+
+    Parameters:
+    name      (str) : Name of the benchmark
+    build_dir (str) : Build directory containing the synthetic root
+    tree      (dict): Number of files and bytes in the synthetic root
+
+    Returns:
+    dict: The benchmark result
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(build_dir)) as scratch:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", name, "--build-dir", build_dir,
+             "--scratch", scratch, "--tree", json.dumps(tree)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        output = process.stdout.read()
+        (pid, status, usage) = os.wait4(process.pid, 0)
+        process.stdout.close()
+        if os.waitstatus_to_exitcode(status) != 0:
+            return {"benchmark": name, "files_in_tree": tree["files"], "error": "benchmark failed"}
+        result = json.loads(output.decode("UTF-8").splitlines()[-1])
+    return {
+        "benchmark": name,
+        "files_in_tree": tree["files"],
+        "files": result["files"],
+        "bytes": result["bytes"],
+        "seconds": round(result["seconds"], 4),
+        "files_per_s": round(result["files"] / result["seconds"], 1) if result["seconds"] > 0 else None,
+        "mb_per_s": round(result["bytes"] / 1024 / 1024 / result["seconds"], 1) if result["seconds"] > 0 else None,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_kib": usage.ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shardimg's in-process hot paths")
+    parser.add_argument("--sizes", default="10000", help="Comma separated numbers of files in the synthetic trees")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="Comma separated benchmarks to run")
+    parser.add_argument("--workdir", default=None, help="Where the synthetic trees are created and kept")
+    parser.add_argument("--output", default=None, help="Also write the results to this file")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--build-dir", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--scratch", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--tree", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker == "create_tree":
+        tree = create_tree(args.build_dir + "/root", int(args.tree))
+        with open(args.build_dir + "/tree.json", "w") as f:
+            json.dump(tree, f)
+        return 0
+    if args.worker is not None:
+        result = run_benchmark(args.worker, args.build_dir, json.loads(args.tree), args.scratch)
+        print(json.dumps(result))
+        return 0
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="shardimg-bench-")
+    results = []
+    try:
+        for files in [int(size) for size in args.sizes.split(",")]:
+            build_dir = f"{workdir}/tree-{files}"
+            if not os.path.exists(build_dir + "/tree.json"):
+                # Created in a child process, peak memory is inherited by the benchmark processes otherwise
+                shutil.rmtree(build_dir, ignore_errors=True)
+                subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--worker", "create_tree", "--build-dir", build_dir,
+                     "--tree", str(files)],
+                    check=True
+                )
+            with open(build_dir + "/tree.json", "r") as f:
+                tree = json.load(f)
+            for name in args.only.split(","):
+                results.append(measure(name, build_dir, tree))
+                print(json.dumps(results[-1]), file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps({"python": sys.version.split()[0], "cpus": os.cpu_count(), "results": results}, indent=4)
+    print(output)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
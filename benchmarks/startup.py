@@ -0,0 +1,92 @@
+# startup.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+"""
+Measures how long shardimg takes to start for commands that don't build anything.
+
+Usage: python3 benchmarks/startup.py [--runs N] [--max-ms MS]
+
+Prints the results as json. Exits with 1 if the median of any command is slower than --max-ms.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "python": ["-c", "pass"],
+    "help": ["-m", "shardimg.main", "--help"],
+    "init": ["-m", "shardimg.main", "init", "{directory}", "--name", "Bench", "--id", "org.shards.bench",
+             "--version", "1.0", "--author", "bench", "--type", "system", "--base", ""],
+}
+
+
+def measure(arguments: list, runs: int) -> list:
+    """
+    Runs a python command several times.
+
+    Parameters:
+    arguments (list): Arguments passed to the python interpreter
+    runs      (int) : How often to run the command
+
+    Returns:
+    list: The wall time of every run in milliseconds
+    """
+    env = dict(os.environ, PYTHONPATH=REPO)
+    times = []
+    for run in range(runs):
+        with tempfile.TemporaryDirectory() as directory:
+            command = [sys.executable] + [argument.format(directory=directory + "/image") for argument in arguments]
+            start = time.perf_counter()
+            subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark shardimg startup time")
+    parser.add_argument("--runs", type=int, default=20, help="Runs per command")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if a median exceeds this many milliseconds")
+    args = parser.parse_args()
+
+    results = {}
+    for name, arguments in COMMANDS.items():
+        times = measure(arguments, args.runs)
+        results[name] = {
+            "runs": args.runs,
+            "min_ms": round(min(times), 2),
+            "median_ms": round(statistics.median(times), 2),
+            "max_ms": round(max(times), 2),
+        }
+    print(json.dumps(results, indent=4))
+
+    if args.max_ms is not None:
+        slow = [name for name in results if name != "python" and results[name]["median_ms"] > args.max_ms]
+        if len(slow) > 0:
+            print("Slower than " + str(args.max_ms) + "ms: " + ", ".join(slow), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
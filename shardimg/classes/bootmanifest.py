@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # SPDX-License-Identifier: GPL-3.0-only
+import hashlib
 import json
 
 class BootManifest:
@@ -68,8 +69,11 @@ class BootManifest:
         self.kernelargs = data["kernelargs"]
         self.commands = data["commands"]
 
-    def write_manifest(self, path):
-        manifest = {
+    def as_dict(self) -> dict:
+        """
+        Returns the manifest fields as they are written to the manifest file.
+        """
+        return {
             "name": self.name,
             "version": self.version,
             "author": self.author,
@@ -80,6 +84,15 @@ class BootManifest:
             "kernelargs": self.kernelargs,
             "commands": self.commands
         }
+
+    def fingerprint(self) -> str:
+        """
+        Returns a hash over all manifest fields that doesn't depend on their formatting or order in the file.
+        """
+        return hashlib.sha256(json.dumps(self.as_dict(), sort_keys=True).encode("UTF-8")).hexdigest()
+
+    def write_manifest(self, path):
+        manifest = self.as_dict()
         with open(path, 'w') as manifest_file:
             json.dump(manifest, manifest_file, ensure_ascii=False, indent=4)
 
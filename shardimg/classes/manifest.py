@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # SPDX-License-Identifier: GPL-3.0-only
+import hashlib
 import json
 
 class Manifest:
@@ -30,6 +31,11 @@ class Manifest:
     fsguard_enabled: bool
     fsguard_binary: str
     fsguard_paths: list
+    fsguard_format: str
+    fsguard_hash: str
+    fsguard_merkle: bool
+    dedup: dict
+    prune: dict
     manifest_path: str
 
     def __init__(self,
@@ -44,7 +50,12 @@ class Manifest:
         commands: list = [],
         fsguard_enabled: bool = True,
         fsguard_binary: str = '',
-        fsguard_paths: list = []
+        fsguard_paths: list = [],
+        fsguard_format: str = 'text',
+        fsguard_hash: str = 'sha1',
+        fsguard_merkle: bool = False,
+        dedup: dict = {},
+        prune: dict = {}
     ):
         self.manifest_path = manifest
         self.name = name
@@ -58,6 +69,11 @@ class Manifest:
         self.fsguard_enabled = fsguard_enabled
         self.fsguard_binary = fsguard_binary
         self.fsguard_paths = fsguard_paths
+        self.fsguard_format = fsguard_format
+        self.fsguard_hash = fsguard_hash
+        self.fsguard_merkle = fsguard_merkle
+        self.dedup = dedup
+        self.prune = prune
 
     def parse_manifest(self):
         with open(self.manifest_path) as f:
@@ -73,8 +89,20 @@ class Manifest:
         self.fsguard_enabled = data["fsguard_enabled"]
         self.fsguard_binary = data["fsguard_binary"]
         self.fsguard_paths = data["fsguard_paths"]
+        # Optional, manifests written before it was added use the text file list
+        self.fsguard_format = data.get("fsguard_format", "text")
+        self.fsguard_hash = data.get("fsguard_hash", "sha1")
+        self.fsguard_merkle = data.get("fsguard_merkle", False)
+        # {"mode": "hardlink" or "reflink", "exclude": [globs], "min_size": bytes}, deduplication is off without it
+        self.dedup = data.get("dedup", {})
+        # {"exclude": [globs], "locales": [locales to keep], "strip": bool}, nothing is pruned without it
+        self.prune = data.get("prune", {})
 
-    def write_manifest(self, path):
+    def as_dict(self) -> dict:
+        """
+        Returns the manifest fields as they are written to the manifest file.
+        Optional fields are only included if they differ from their default.
+        """
         manifest = {
             "name": self.name,
             "version": self.version,
@@ -88,6 +116,26 @@ class Manifest:
             "fsguard_binary": self.fsguard_binary,
             "fsguard_paths": self.fsguard_paths
         }
+        if self.fsguard_format != "text":
+            manifest["fsguard_format"] = self.fsguard_format
+        if self.fsguard_hash != "sha1":
+            manifest["fsguard_hash"] = self.fsguard_hash
+        if self.fsguard_merkle:
+            manifest["fsguard_merkle"] = self.fsguard_merkle
+        if self.dedup:
+            manifest["dedup"] = self.dedup
+        if self.prune:
+            manifest["prune"] = self.prune
+        return manifest
+
+    def fingerprint(self) -> str:
+        """
+        Returns a hash over all manifest fields that doesn't depend on their formatting or order in the file.
+        """
+        return hashlib.sha256(json.dumps(self.as_dict(), sort_keys=True).encode("UTF-8")).hexdigest()
+
+    def write_manifest(self, path):
+        manifest = self.as_dict()
         with open(path, 'w') as manifest_file:
             json.dump(manifest, manifest_file, ensure_ascii=False, indent=4)
 
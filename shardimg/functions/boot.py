@@ -19,17 +19,30 @@
 from shardimg.classes.manifest import Manifest
 from shardimg.utils.files import FileUtils
 from shardimg.utils.command import Command
-from shardimg.utils.disks import DiskUtils
+from shardimg.utils.disks import BuildSandbox
 from shardimg.utils.log import setup_logging
 from shardimg.utils.shards import Shards
+from shardimg.utils.trace import Trace
 import random, string, os
 logger = setup_logging()
 
+def boot_packages(manifest: Manifest) -> list:
+    """
+    Returns the packages installed into the build root of a boot image.
+    """
+    return ["base", "dracut", "btrfs-progs", "busybox", "lvm2", "dmraid", "mdadm", "tpm2-tss", "dash", "binutils", "elfutils", manifest.kernelpackage, "linux-firmware"]
+
 def build_boot_image(
         manifest: Manifest,
         build_dir: str,
         repo: str,
-        manifest_path
+        manifest_path,
+        package_cache: str = None,
+        batch_commands: bool = False,
+        log_file: str = None,
+        sandbox: bool = True,
+        direct_export: bool = False,
+        lockfile: str = None
 ):
     print(os.path.abspath(manifest_path))
     FileUtils.create_directory(build_dir)
@@ -42,37 +55,37 @@ def build_boot_image(
 
     FileUtils.copy_file(manifest_path, build_dir+"/include/manifest.json", True)
 
-    logger.info(f"Mount proc, sys and dev in {build_dir}/buildroot")
-    DiskUtils.mount(source="/proc", mountpoint=build_dir + "/buildroot/proc", fs="proc")
-    DiskUtils.mount(source="/sys", mountpoint=build_dir + "/buildroot/sys", fs="sysfs")
-    DiskUtils.mount(source="/dev", mountpoint=build_dir + "/buildroot/dev", options=["bind"])
-
-    packages=["base", "dracut", "btrfs-progs", "busybox", "lvm2", "dmraid", "mdadm", "tpm2-tss", "dash", "binutils", "elfutils", manifest.kernelpackage, "linux-firmware"]
-
-    Shards.install_packages(packages, build_dir+"/buildroot")
-    Shards.execute_commands(manifest.commands, build_dir+"/buildroot")
+    packages=boot_packages(manifest)
 
-    Shards.execute_commands([f'dracut --no-hostonly-cmdline --no-hostonly --uefi --kver {manifest.kernelversion} /{manifest.kernelname}.unsigned.efi'], build_dir+"/buildroot")
+    with BuildSandbox(build_dir + "/buildroot", enabled=sandbox):
+        with Trace.span("Install packages", packages=len(packages)):
+            Shards.install_packages(packages, build_dir+"/buildroot", cache_dir=package_cache, log_file=log_file, lockfile=lockfile)
+        with Trace.span("Execute commands", commands=len(manifest.commands)):
+            Shards.execute_commands(manifest.commands, build_dir+"/buildroot", batched=batch_commands, log_file=log_file)
 
-    Command.execute_command(
-        command=[
-            "chown",
-            os.getenv("USER"),
-            f"{build_dir}/buildroot/{manifest.kernelname}.unsigned.efi",
-        ],
-        command_description="Correct permissions for kernel efi",
-        crash=True,
-        elevated=True
-    )
+        with Trace.span("Generate unified kernel image"):
+            Shards.execute_commands([f'dracut --no-hostonly-cmdline --no-hostonly --uefi --kver {manifest.kernelversion} /{manifest.kernelname}.unsigned.efi'], build_dir+"/buildroot", log_file=log_file)
 
-    FileUtils.copy_file(build_dir+f"/buildroot/{manifest.kernelname}.unsigned.efi", build_dir+f"/root/{manifest.kernelname}.unsigned.efi")
+        Command.execute_command(
+            command=[
+                "chown",
+                os.getenv("USER"),
+                f"{build_dir}/buildroot/{manifest.kernelname}.unsigned.efi",
+            ],
+            command_description="Correct permissions for kernel efi",
+            crash=True,
+            elevated=True
+        )
 
-    logger.info("Unmounting proc, sys and dev")
-    DiskUtils.unmount(mountpoint=build_dir + "/buildroot/proc")
-    DiskUtils.unmount(mountpoint=build_dir + "/buildroot/sys")
-    DiskUtils.unmount(mountpoint=build_dir + "/buildroot/dev")
+        FileUtils.copy_file(build_dir+f"/buildroot/{manifest.kernelname}.unsigned.efi", build_dir+f"/root/{manifest.kernelname}.unsigned.efi")
 
-    Shards.generate_flatpak_manifest(manifest, build_dir)
-    Shards.build_flatpak(manifest, build_dir, repo)
+    with Trace.span("Generate flatpak manifest"):
+        Shards.generate_flatpak_manifest(manifest, build_dir)
+    if direct_export and len(Shards.module_files(build_dir)) == 0:
+        with Trace.span("Export flatpak"):
+            Shards.export_flatpak(manifest, build_dir, repo, log_file=log_file)
+    else:
+        with Trace.span("Build flatpak"):
+            Shards.build_flatpak(manifest, build_dir, repo, log_file=log_file)
 
     
@@ -0,0 +1,235 @@
+# buildall.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import shardimg
+from shardimg.classes.manifest import Manifest
+from shardimg.classes.bootmanifest import BootManifest
+from shardimg.utils.files import FileUtils
+from shardimg.utils.shards import Shards
+from shardimg.utils.log import setup_logging
+
+logger = setup_logging()
+
+
+class BuildAll:
+
+    @staticmethod
+    def parse_manifest(manifest_path: str):
+        """
+        Parses a system or boot manifest.
+
+        Parameters:
+        manifest_path (str): Path to the manifest
+
+        Returns:
+        Manifest | BootManifest: The parsed manifest
+        """
+        try:
+            manifest = Manifest(manifest=manifest_path)
+            manifest.parse_manifest()
+        except KeyError:
+            manifest = BootManifest(manifest=manifest_path)
+            manifest.parse_manifest()
+        return manifest
+
+    @staticmethod
+    def dependency_graph(manifests: dict) -> dict:
+        """
+        Builds the dependency graph of a set of images from their base field.
+        Bases that are not part of the set are expected to be available already and are ignored.
+
+        Parameters:
+        manifests (dict): The parsed manifests by image ID
+
+        Returns:
+        dict: The IDs of the images that have to be built first, by image ID
+        """
+        dependencies = {}
+        for id, manifest in manifests.items():
+            base = getattr(manifest, "base", "").strip()
+            dependencies[id] = [base] if base in manifests else []
+
+        # Fails on cycles, which would otherwise never get scheduled
+        visited = {}
+
+        def visit(id, path):
+            if visited.get(id) == "done":
+                return
+            if visited.get(id) == "visiting":
+                logger.error("Dependency cycle between images: " + " -> ".join(path + [id]))
+                sys.exit(1)
+            visited[id] = "visiting"
+            for dependency in dependencies[id]:
+                visit(dependency, path + [id])
+            visited[id] = "done"
+
+        for id in dependencies:
+            visit(id, [])
+        return dependencies
+
+    @staticmethod
+    def build_image(manifest_path: str, build_dir: str, repo: str, log_file: str, build_args: list) -> int:
+        """
+        Builds a single image in a separate shardimg process, so that builds don't share any state.
+
+        Parameters:
+        manifest_path (str) : Path to the manifest of the image
+        build_dir     (str) : Build directory of the image
+        repo          (str) : Path to the repository the image is committed to
+        log_file      (str) : File the output of the build is written to
+        build_args    (list): Additional arguments for shardimg build
+
+        Returns:
+        int: The returncode of the build
+        """
+        env = dict(os.environ)
+        package_path = os.path.dirname(os.path.dirname(os.path.abspath(shardimg.__file__)))
+        env["PYTHONPATH"] = package_path + (":" + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+        command = [
+            sys.executable,
+            "-m",
+            "shardimg.main",
+            "build",
+            "--manifest",
+            os.path.abspath(manifest_path),
+            "--build-dir",
+            os.path.abspath(build_dir),
+            "--repo",
+            os.path.abspath(repo),
+        ] + build_args
+        with open(log_file, "w") as log:
+            out = subprocess.run(
+                command,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                cwd=os.path.dirname(os.path.abspath(manifest_path)),
+                env=env
+            )
+        return out.returncode
+
+    @staticmethod
+    def build_all(
+            manifest_paths: list,
+            build_root: str,
+            repo: str,
+            max_parallel: int = 2,
+            build_args: list = [],
+            user: bool = False
+    ) -> dict:
+        """
+        Builds many images, running images that don't depend on each other concurrently.
+        An image is only built after the image it is based on has been committed to the repository,
+        and the base is installed from the repository before, so that its dependents build on the new commit.
+        If a build fails, only the images based on it are skipped.
+
+        The builds share the package cache, the layer cache and the checksum cache. The package cache is locked while
+        packages are installed or pruned, the layer cache while layers are written. The checksum cache is an sqlite
+        database that serializes the writes of concurrent builds.
+
+        Parameters:
+        manifest_paths (list): Paths to the manifests of the images
+        build_root     (str) : Directory the build directories of all images are created in
+        repo           (str) : Path to the repository the images are committed to
+        max_parallel   (int) : How many images are built at the same time. Defaults to 2 if not specified
+        build_args     (list): Additional arguments passed to every shardimg build
+        user           (bool): Whether base images are installed for the current user instead of system wide,
+                               as builds with --overlay do
+
+        Returns:
+        dict: The result of every image by ID, either "success", "failed" or "skipped"
+        """
+        manifests = {}
+        paths = {}
+        for manifest_path in manifest_paths:
+            manifest = BuildAll.parse_manifest(manifest_path)
+            if manifest.id in manifests:
+                logger.error(f"Image {manifest.id} is defined by both {paths[manifest.id]} and {manifest_path}")
+                sys.exit(1)
+            manifests[manifest.id] = manifest
+            paths[manifest.id] = manifest_path
+
+        dependencies = BuildAll.dependency_graph(manifests)
+        results = {}
+        running = {}
+        started = {}
+        installed = set()
+        FileUtils.create_directory(build_root)
+
+        def skip_dependents(id):
+            for dependent, bases in dependencies.items():
+                if id in bases and dependent not in results:
+                    logger.warning(f"Skipping {dependent}, its base {id} was not built")
+                    results[dependent] = "skipped"
+                    skip_dependents(dependent)
+
+        with ThreadPoolExecutor(max_workers=max(max_parallel, 1)) as executor:
+            while len(results) < len(manifests):
+                for id in manifests:
+                    if len(running) >= max_parallel:
+                        break
+                    if id in results or id in running.values():
+                        continue
+                    if not all(results.get(base) == "success" for base in dependencies[id]):
+                        continue
+                    # Done here rather than in the builds, so dependents of the same base don't update it at once
+                    for base in set(dependencies[id]) - installed:
+                        logger.info(f"Installing {base} from {repo}")
+                        if Shards.install_base_from_repo(repo, base, user=user, log_file=build_root + "/" + base + ".log"):
+                            installed.add(base)
+                    if not all(base in installed for base in dependencies[id]):
+                        logger.error(f"Installing the base of {id} from {repo} failed, see {build_root}/{dependencies[id][0]}.log")
+                        results[id] = "failed"
+                        skip_dependents(id)
+                        continue
+                    logger.info(f"Building {id}")
+                    started[id] = time.time()
+                    future = executor.submit(
+                        BuildAll.build_image,
+                        paths[id],
+                        build_root + "/" + id,
+                        repo,
+                        build_root + "/" + id + ".log",
+                        build_args
+                    )
+                    running[future] = id
+
+                if len(running) == 0:
+                    break
+                done, pending = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    id = running.pop(future)
+                    returncode = future.result()
+                    elapsed = time.time() - started[id]
+                    if returncode == 0:
+                        logger.info(f"Built {id} in {elapsed:.1f}s")
+                        results[id] = "success"
+                    else:
+                        logger.error(f"Building {id} failed with returncode {returncode} after {elapsed:.1f}s, "
+                                     f"see {build_root}/{id}.log")
+                        results[id] = "failed"
+                        skip_dependents(id)
+
+        for id in manifests:
+            print(f"{results.get(id, 'skipped'):<8} {id}")
+        return results
@@ -16,14 +16,24 @@
 #
 # SPDX-License-Identifier: GPL-3.0-only
 
-import os
+import asyncio
 import hashlib
+import os
 import sys
 
 from shardimg.classes.manifest import Manifest
 from shardimg.utils.files import FileUtils
 from shardimg.utils.shards import Shards
-from shardimg.utils.disks import DiskUtils
+from shardimg.utils.checksum import Checksum, ChecksumCache
+from shardimg.utils.filelist import BinaryFilelist
+from shardimg.utils.merkle import MerkleTree
+from shardimg.utils.dedup import Deduplicator
+from shardimg.utils.prune import Pruner
+from shardimg.utils.lockfile import PackageLock
+from shardimg.utils.cache import CacheUtils
+from shardimg.utils.layers import LayerCache
+from shardimg.utils.trace import Trace
+from shardimg.utils.disks import DiskUtils, BuildSandbox
 from shardimg.utils.command import Command
 from shardimg.utils.log import setup_logging
 
@@ -40,7 +50,24 @@ class SystemImage:
             manifest_path: str,
             fsguard_enabled: bool = True,
             fsguard_paths: list = ["usr"],
-            fsguard_binary: str = "/usr/bin/FsGuard"
+            fsguard_binary: str = "/usr/bin/FsGuard",
+            workers: int = None,
+            cache_dir: str = None,
+            checksum_cache: str = "off",
+            checksum_cache_size: int = 1000000,
+            package_cache: str = None,
+            layer_cache: bool = False,
+            batch_commands: bool = False,
+            overlay: bool = False,
+            log_file: str = None,
+            sandbox: bool = True,
+            direct_export: bool = False,
+            fsguard_format: str = "text",
+            fsguard_hash: str = "sha1",
+            fsguard_merkle: bool = False,
+            dedup: dict = {},
+            prune: dict = {},
+            lockfile: str = None
     ):
         """
         Builds a flatpak system image based on the passed manifest.
@@ -53,6 +80,30 @@ class SystemImage:
         fsguard_enabled (bool): Whether FsGuard is enabled in the image
         fsguard_paths (list): Paths that should be added to the FsGuard file list. Defaults to usr if not specified
         fsguard_binary (str): Path to the FsGuard binary in the image. Defaults to "/usr/bin/FsGuard" if not specified
+        workers (int): How many files are hashed in parallel during FsGuard setup. Defaults to the cpu count if not specified
+        cache_dir (str): Directory to keep caches in across builds. Defaults to ~/.cache/shardimg if not specified
+        checksum_cache (str): How the FsGuard checksum cache validates entries, "strict", "mtime" or "off" to disable it.
+                              Defaults to off if not specified
+        checksum_cache_size (int): Maximum number of entries in the FsGuard checksum cache
+        package_cache (str): Shared pacman package cache. The cache in the image root is cleared instead if not specified
+        layer_cache (bool): Whether to restore unchanged package and command phases from cached snapshots of the root
+        batch_commands (bool): Whether to run all commands in a single chroot session. Has no effect with the layer cache,
+                               which needs a snapshot after every command
+        overlay (bool): Whether to build on top of an overlay mount of the base image instead of a copy of it
+        log_file (str): File the output of flatpak, pacman, the commands and flatpak-builder is written to.
+                        Only progress is shown on the terminal then. Output goes to the terminal if not specified
+        sandbox (bool): Whether proc, sys and dev are mounted in a private mount namespace that is removed
+                        automatically, instead of on the host. Defaults to True if not specified
+        direct_export (bool): Whether to commit the root to the repository directly instead of through flatpak-builder,
+                              which copies it twice. Images with modules are always built with flatpak-builder
+        fsguard_format (str): Format of the FsGuard file list, "text" or "binary". Defaults to "text" if not specified
+        fsguard_hash (str): Hash algorithm of the FsGuard file list. Defaults to sha1 if not specified
+        fsguard_merkle (bool): Whether to also write a Merkle tree of the FsGuard file list with a signed root digest
+        dedup (dict): The dedup section of the manifest. Identical files in the root are replaced with links after
+                      the commands ran if it is set and enabled isn't false
+        prune (dict): The prune section of the manifest. Excluded paths, unused locales and ELF debug sections
+                      are removed after the commands ran, before deduplication
+        lockfile (str): Lockfile the packages are installed from, without refreshing the sync databases (optional)
         """
         include_dir = os.path.abspath(manifest_path).split("/")
         include_dir.pop()
@@ -64,12 +115,39 @@ class SystemImage:
         modules_dir.append("modules")
         modules_dir = "/".join(modules_dir)
 
-        if manifest.base.strip() != "":
+        layers = None
+        fingerprints = []
+        cached_layer = -1
+        overlay_mounted = False
+        if layer_cache:
+            with Trace.span("Resolve cached layers"):
+                base_commit = Shards.base_image_commit(manifest.base, user=overlay, log_file=log_file) if manifest.base.strip() != "" else ""
+                layers = LayerCache((cache_dir or CacheUtils.default_directory()) + "/layers")
+                # Locked builds install exact package files, the lockfile decides which layer they can reuse
+                packages = manifest.packages + (["lockfile " + PackageLock.digest(lockfile)] if lockfile is not None else [])
+                fingerprints = LayerCache.fingerprints(manifest.base.strip(), base_commit, packages, manifest.commands)
+
+        if layers is not None:
+            with Trace.span("Restore cached layer"):
+                FileUtils.create_directory(build_dir)
+                cached_layer = layers.restore(fingerprints, build_dir + "/root")
+
+        if cached_layer >= 0:
+            logger.info(f"Reusing {cached_layer + 1} of {len(fingerprints)} cached layers")
+        elif manifest.base.strip() != "":
             logger.info(f"Pulling base image")
-            Shards.initialize_base_image(
-                base=manifest.base,
-                build_dir=build_dir
-            )
+            with Trace.span("Pull base image", base=manifest.base):
+                Shards.initialize_base_image(
+                    base=manifest.base,
+                    build_dir=build_dir,
+                    overlay=overlay,
+                    log_file=log_file
+                )
+            overlay_mounted = overlay
+        elif layers is not None:
+            logger.info(f"Populate build directory {build_dir}")
+            FileUtils.create_directory(build_dir)
+            LayerCache.create_root(build_dir + "/root")
         else:
             logger.info(f"Populate build directory {build_dir}")
             FileUtils.create_directory(build_dir)
@@ -78,51 +156,121 @@ class SystemImage:
             FileUtils.create_directory(build_dir + "/root/sys")
             FileUtils.create_directory(build_dir + "/root/dev")
 
-        logger.info("Add manifest.json to include")
-        FileUtils.copy_file(manifest_path, build_dir + "/manifest", False)
-        FileUtils.create_directory(build_dir + "/include")
-        FileUtils.copy_directory(include_dir, build_dir, False)
-        FileUtils.copy_file(manifest_path, build_dir + "/include/manifest.json", True)
+        # The overlay has to be unmounted however the build ends, including sys.exit from a failed step
+        try:
+            logger.info("Add manifest.json to include")
+            with Trace.span("Copy include and modules"):
+                FileUtils.copy_file(manifest_path, build_dir + "/manifest", False)
+                FileUtils.create_directory(build_dir + "/include")
+                FileUtils.create_directory(build_dir + "/modules")
+                Command.run_async(
+                    asyncio.to_thread(Trace.bind(FileUtils.copy_directory), include_dir, build_dir, False),
+                    asyncio.to_thread(Trace.bind(FileUtils.copy_directory), modules_dir, build_dir, False)
+                )
+                FileUtils.copy_file(manifest_path, build_dir + "/include/manifest.json", True)
 
-        FileUtils.create_directory(build_dir + "/modules")
-        FileUtils.copy_directory(modules_dir, build_dir, False)
+            with BuildSandbox(build_dir + "/root", enabled=sandbox):
+                if cached_layer < 0:
+                    logger.info("Installing packages")
+                    with Trace.span("Install packages", packages=len(manifest.packages)):
+                        Shards.install_packages(manifest.packages, build_dir + "/root", cache_dir=package_cache, log_file=log_file,
+                                                lockfile=lockfile)
+                    if layers is not None:
+                        with Trace.span("Snapshot layer", layer="install packages"):
+                            layers.snapshot(build_dir + "/root", fingerprints[0], "install packages")
+                else:
+                    logger.info("Packages are unchanged, skipping package installation")
+                logger.info("Executing commands")
+                with Trace.span("Execute commands", commands=len(manifest.commands)):
+                    if layers is None:
+                        Shards.execute_commands(manifest.commands, build_dir + "/root", batched=batch_commands, log_file=log_file)
+                    else:
+                        for index, command in enumerate(manifest.commands):
+                            if index + 1 <= cached_layer:
+                                logger.info(f"Skipping unchanged command {command}")
+                                continue
+                            Shards.execute_commands([command], build_dir + "/root", log_file=log_file)
+                            with Trace.span("Snapshot layer", layer="run " + command):
+                                layers.snapshot(build_dir + "/root", fingerprints[index + 1], "run " + command)
 
-        logger.info(f"Mount proc, sys and dev in {build_dir}/root")
-        DiskUtils.mount(source="/proc", mountpoint=build_dir + "/root/proc", fs="proc")
-        DiskUtils.mount(source="/sys", mountpoint=build_dir + "/root/sys", fs="sysfs")
-        DiskUtils.mount(source="/dev", mountpoint=build_dir + "/root/dev", options=["bind"])
+            if prune:
+                logger.info("Pruning files")
+                with Trace.span("Prune files"):
+                    Pruner(
+                        exclude=prune.get("exclude", []),
+                        locales=prune.get("locales"),
+                        strip=prune.get("strip", False),
+                        workers=workers
+                    ).run(build_dir + "/root")
 
-        logger.info("Installing packages")
-        Shards.install_packages(manifest.packages, build_dir + "/root")
-        logger.info("Executing commands")
-        Shards.execute_commands(manifest.commands, build_dir + "/root")
+            if dedup and dedup.get("enabled", True):
+                logger.info("Deduplicating files")
+                with Trace.span("Deduplicate files"):
+                    # FsGuard appends the signature to its binary, that must not change the files linked to it
+                    Deduplicator(
+                        mode=dedup.get("mode", "hardlink"),
+                        exclude=dedup.get("exclude", []) + [fsguard_binary],
+                        min_size=dedup.get("min_size", 1),
+                        workers=workers
+                    ).run(build_dir + "/root")
 
-        logger.info("Unmounting proc, sys and dev")
-        DiskUtils.unmount(mountpoint=build_dir + "/root/proc")
-        DiskUtils.unmount(mountpoint=build_dir + "/root/sys")
-        DiskUtils.unmount(mountpoint=build_dir + "/root/dev")
+            def fsguard():
+                with Trace.span("FsGuard setup"):
+                    SystemImage.fsGuard_setup(fsguard_paths=fsguard_paths, build_dir=build_dir, fsguard_binary=fsguard_binary,
+                                              workers=workers, cache_dir=cache_dir, checksum_cache=checksum_cache,
+                                              checksum_cache_size=checksum_cache_size, fsguard_format=fsguard_format,
+                                              fsguard_hash=fsguard_hash, fsguard_merkle=fsguard_merkle)
 
-        SystemImage.fsGuard_setup(fsguard_paths=fsguard_paths, build_dir=build_dir, fsguard_binary=fsguard_binary)
+            def flatpak_manifest():
+                with Trace.span("Generate flatpak manifest"):
+                    Shards.generate_flatpak_manifest(manifest, build_dir)
+
+            # The flatpak manifest doesn't depend on the FsGuard list, so it is generated while hashing and signing
+            Command.run_async(
+                asyncio.to_thread(Trace.bind(fsguard)),
+                asyncio.to_thread(Trace.bind(flatpak_manifest))
+            )
 
-        logger.info("Build flatpak")
-        Shards.generate_flatpak_manifest(manifest, build_dir)
-        Shards.build_flatpak(manifest, build_dir, repo)
+            if direct_export and len(Shards.module_files(build_dir)) == 0:
+                logger.info("Export flatpak")
+                with Trace.span("Export flatpak"):
+                    Shards.export_flatpak(manifest, build_dir, repo, log_file=log_file)
+            else:
+                if direct_export:
+                    logger.info("The image has modules, building it with flatpak-builder")
+                logger.info("Build flatpak")
+                with Trace.span("Build flatpak"):
+                    Shards.build_flatpak(manifest, build_dir, repo, log_file=log_file)
+        finally:
+            if overlay_mounted:
+                logger.info(f"Unmounting overlay, the changes to the base image are in {build_dir}/upper")
+                DiskUtils.unmount(mountpoint=build_dir + "/root")
 
     @staticmethod
-    def fsGuard_setup(fsguard_paths: list, build_dir: str, fsguard_binary: str):
+    def fsguard_filelist(
+            fsguard_paths: list,
+            build_dir: str,
+            fsguard_binary: str,
+            workers: int = None,
+            cache: ChecksumCache = None,
+            algorithm: str = "sha1"
+    ) -> list:
         """
-        Generates the FsGuard filelist and adds the signature to FsGuard
+        Collects all files in the FsGuard paths and calculates their checksums.
+        Every file is hashed exactly once, the hashing is spread over a thread pool.
 
         Args:
             fsguard_paths (str): The Paths to generate checksums for
             build_dir (str): Build directory of the image
             fsguard_binary (str): Path to the FsGuard binary
+            workers (int): How many files are hashed in parallel. Defaults to the cpu count if not specified
+            cache (ChecksumCache): Checksum cache used to skip unchanged files (optional)
+            algorithm (str): The hash algorithm. Defaults to sha1 if not specified
 
         Returns:
-
+            list: The FsGuard file list entries in the format "path checksum suid"
         """
-        logger.info("Creating FsGuard file list")
-        suid_binaries = []
+        entries = []
         for path in fsguard_paths:
             for (dirpath, dirname, filenames) in os.walk(build_dir + "/root/" + path):
 
@@ -135,41 +283,134 @@ class SystemImage:
                         if not os.path.isfile(filepath):
                             filepath = build_dir + "/root" + os.path.abspath(
                                 FileUtils.get_symlink(dirpath + "/" + file))
-                        suid = False
-                        if FileUtils.is_suid(filepath):
-                            suid = True
-                        suid_binaries.append("{} {} {}".format(
-                            filepath.replace(os.path.abspath(build_dir + "/root"), "").replace(build_dir + "/root", ""),
-                            Shards.fsguard_checksum(filepath),
-                            "true" if suid else "false")
-                        )
-                        print("{} {} {}".format(
-                            filepath.replace(os.path.abspath(build_dir + "/root"), "").replace(build_dir + "/root", ""),
-                            Shards.fsguard_checksum(filepath),
-                            "true" if suid else "false")
-                        )
+                        entries.append((filepath, FileUtils.is_suid(filepath)))
+
+        checksums = Checksum.checksum_files([filepath for (filepath, suid) in entries], workers=workers, cache=cache,
+                                             algorithm=algorithm)
+
+        filelist = []
+        for (filepath, suid), checksum in zip(entries, checksums):
+            filelist.append("{} {} {}".format(
+                filepath.replace(os.path.abspath(build_dir + "/root"), "").replace(build_dir + "/root", ""),
+                checksum,
+                "true" if suid else "false")
+            )
+        return filelist
+
+    @staticmethod
+    def fsGuard_setup(
+            fsguard_paths: list,
+            build_dir: str,
+            fsguard_binary: str,
+            workers: int = None,
+            cache_dir: str = None,
+            checksum_cache: str = "off",
+            checksum_cache_size: int = 1000000,
+            fsguard_format: str = "text",
+            fsguard_hash: str = "sha1",
+            fsguard_merkle: bool = False
+    ):
+        """
+        Generates the FsGuard filelist and adds the signature to FsGuard
+
+        Args:
+            fsguard_paths (str): The Paths to generate checksums for
+            build_dir (str): Build directory of the image
+            fsguard_binary (str): Path to the FsGuard binary
+            workers (int): How many files are hashed in parallel. Defaults to the cpu count if not specified
+            cache_dir (str): Directory the checksum cache is kept in. Defaults to ~/.cache/shardimg if not specified
+            checksum_cache (str): How the checksum cache validates entries, "strict", "mtime" or "off" to disable it.
+                                  Defaults to off if not specified. mtime trusts files with the same size and mtime,
+                                  which is faster but signs a stale checksum for a file changed without a new mtime
+            checksum_cache_size (int): Maximum number of entries in the checksum cache
+            fsguard_format (str): "text" for the line based filelist, "binary" for the sorted and indexed filelist.bin.
+                                  Defaults to "text" if not specified
+            fsguard_hash (str): Hash algorithm of the file list, sha1, sha256, blake2b or blake3.
+                                Defaults to sha1 if not specified
+            fsguard_merkle (bool): Whether to also write the Merkle tree include/FsGuard/merkle and its
+                                   signed root digest include/FsGuard/merkle.root. Defaults to False if not specified
+
+        Returns:
+
+        """
+        if fsguard_format not in ["text", "binary"]:
+            logger.error(f"Unknown FsGuard file list format {fsguard_format}, must be text or binary")
+            sys.exit(1)
+        # Exits if the algorithm is unknown or not installed, before anything is hashed
+        Checksum.hasher(fsguard_hash)
+        logger.info("Creating FsGuard file list")
+        cache = None
+        if checksum_cache != "off":
+            # One cache per build directory, entries of other images are never trusted
+            scope = hashlib.sha256(os.path.abspath(build_dir).encode("UTF-8")).hexdigest()[:16]
+            cache = ChecksumCache(
+                path=(cache_dir or CacheUtils.default_directory()) + "/checksums/" + scope + ".sqlite",
+                root=build_dir + "/root",
+                mode=checksum_cache,
+                max_entries=checksum_cache_size,
+                algorithm=fsguard_hash
+            )
+        try:
+            with Trace.span("Hash FsGuard paths"):
+                suid_binaries = SystemImage.fsguard_filelist(
+                    fsguard_paths=fsguard_paths,
+                    build_dir=build_dir,
+                    fsguard_binary=fsguard_binary,
+                    workers=workers,
+                    cache=cache,
+                    algorithm=fsguard_hash
+                )
+        finally:
+            if cache is not None:
+                cache.close()
+        for entry in suid_binaries:
+            print(entry)
 
         logger.info("Writing fsguard checksums to file")
-        if os.path.exists(build_dir + "/include/FsGuard/filelist"):
+        filelist = build_dir + "/include/FsGuard/" + ("filelist.bin" if fsguard_format == "binary" else "filelist")
+        if os.path.exists(build_dir + "/include/FsGuard/filelist") or os.path.exists(build_dir + "/include/FsGuard/filelist.bin"):
             logger.warn("File " + build_dir + "/include/suid_binaries already exists! Deleting.")
             FileUtils.delete_directory(build_dir + "/include/FsGuard")
         FileUtils.create_directory(build_dir + "/include/FsGuard")
-        FileUtils.create_file(build_dir + "/include/FsGuard/filelist")
-        FileUtils.write_file(path=build_dir + "/include/FsGuard/filelist", content="\n".join(suid_binaries))
+        entries = [entry.rsplit(" ", 2) for entry in suid_binaries]
+        entries = [(path, checksum, suid == "true") for (path, checksum, suid) in entries]
+        if fsguard_format == "binary":
+            BinaryFilelist.write(filelist, entries, algorithm=fsguard_hash)
+        else:
+            # sha1 lists have no header, so they stay readable by FsGuard versions without algorithm support
+            header = [f"# hash {fsguard_hash}"] if fsguard_hash != "sha1" else []
+            FileUtils.create_file(filelist)
+            FileUtils.write_file(path=filelist, content="\n".join(header + suid_binaries))
 
         if not os.path.exists(os.getenv("HOME")+"/.minisign/minisign.pub"):
             logger.error(f"Minisign public key not found! {os.getenv('HOME')}/.minisign/minisign.pub: No such file "
                          f"or directory")
             sys.exit(1)
 
-        Command.execute_command(
-            command=[
-                "bash",
-                "-c",
-                "echo | minisign -Sm"+build_dir+"/include/FsGuard/filelist -x "+build_dir+"/filelist.minisig"
-            ],
-            crash=True
-        )
+        with Trace.span("Sign FsGuard file list"):
+            Command.execute_command(
+                command=[
+                    "bash",
+                    "-c",
+                    "echo | minisign -Sm"+filelist+" -x "+build_dir+"/filelist.minisig"
+                ],
+                crash=True
+            )
+        if fsguard_merkle:
+            with Trace.span("Build FsGuard Merkle tree"):
+                tree = MerkleTree.build(entries, algorithm=fsguard_hash)
+                tree.write(build_dir + "/include/FsGuard/merkle")
+                FileUtils.create_file(build_dir + "/include/FsGuard/merkle.root")
+                FileUtils.write_file(path=build_dir + "/include/FsGuard/merkle.root", content=tree.root + "\n")
+                logger.info("FsGuard Merkle root " + tree.root)
+                Command.execute_command(
+                    command=[
+                        "bash",
+                        "-c",
+                        "echo | minisign -Sm"+build_dir+"/include/FsGuard/merkle.root -x "+build_dir+"/include/FsGuard/merkle.root.minisig"
+                    ],
+                    crash=True
+                )
         signature = "----begin attach----"
         with open(build_dir+"/filelist.minisig", "r") as minisig:
             signature = signature+minisig.read()
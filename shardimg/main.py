@@ -16,15 +16,28 @@
 #
 # SPDX-License-Identifier: GPL-3.0-only
 import click
+import os
 import sys
-from shardimg.classes.manifest import Manifest
-from shardimg.classes.bootmanifest import BootManifest
-from shardimg.functions.system import SystemImage
-from shardimg.functions.boot import *
-from shardimg.functions.init import *
 from shardimg.utils.log import setup_logging
 logger = setup_logging()
 
+# The build stack is only imported by the commands that need it, so that
+# --help and init don't pay for it
+
+
+def validate_size(ctx, param, value):
+    """
+    Rejects sizes like "20G" that can't be parsed before the command starts.
+    """
+    from shardimg.utils.cache import CacheUtils
+
+    try:
+        if CacheUtils.parse_size(value) >= 0:
+            return value
+    except (ValueError, KeyError):
+        pass
+    raise click.BadParameter(f"{value} is not a size, use e.g. 512M or 20G")
+
 @click.group()
 @click.option('--verbose', is_flag=True, help='Enables verbose mode.', default=False)
 def main(verbose):
@@ -36,7 +49,35 @@ def main(verbose):
 @click.option('--build-dir', help='Path to the build directory.', default="build")
 @click.option('--repo', help='Path to the flatpak repository. Can be an empty directory.', default="repo")
 @click.option('--keep', is_flag=True, help='Keep the build directory after the build.', default=False)
-def build(manifest, build_dir, keep, repo):
+@click.option('--jobs', type=int, help='Number of files to hash in parallel. Defaults to the number of CPUs.', default=None)
+@click.option('--cache-dir', help='Directory to keep caches in across builds. Defaults to ~/.cache/shardimg.', default=None)
+@click.option('--checksum-cache', type=click.Choice(["strict", "mtime", "off"]), help='Reuse FsGuard checksums of unchanged files from earlier builds in the same build directory. mtime trusts size and mtime, which is faster but lets a file changed without updating its mtime into the signed file list. strict also compares inode and ctime.', default="off")
+@click.option('--checksum-cache-size', type=int, help='Maximum number of entries in the FsGuard checksum cache.', default=1000000)
+@click.option('--package-cache-size', callback=validate_size, help='Size budget of the shared package cache, e.g. 20G.', default="20G")
+@click.option('--layer-cache', is_flag=True, help='Reuse cached snapshots of the root for unchanged packages and commands.', default=False)
+@click.option('--batch-commands', is_flag=True, help='Run all manifest commands in a single chroot session.', default=False)
+@click.option('--overlay', is_flag=True, help='Mount the base image as an overlay instead of copying it.', default=False)
+@click.option('--trace', help='Where to write the Chrome trace of the build. Defaults to <build-dir>/trace.json.', default=None)
+@click.option('--force', is_flag=True, help='Build even if nothing changed since the last build.', default=False)
+@click.option('--log-file', help='Write the output of pacman, flatpak-builder and the commands to this file and only show progress.', default=None)
+@click.option('--no-sandbox', is_flag=True, help='Mount proc, sys and dev on the host instead of in a private mount namespace.', default=False)
+@click.option('--privileged-helper', is_flag=True, help='Run elevated commands through one long-lived root helper instead of sudo each time.', default=False)
+@click.option('--direct-export', is_flag=True, help='Commit the root to the repository directly instead of copying it through flatpak-builder.', default=False)
+@click.option('--deltas', type=int, help='Generate static deltas from this many previous commits after the build.', default=0)
+@click.option('--delta-min-size', callback=validate_size, help='Static deltas smaller than this are not kept, e.g. 64K.', default="0")
+@click.option('--lockfile', help='Install the packages locked in this file from the package cache, without refreshing the sync databases.', default=None)
+@click.option('--locked', is_flag=True, help='Use the packages.lock.json next to the manifest as lockfile.', default=False)
+def build(manifest, build_dir, keep, repo, jobs, cache_dir, checksum_cache, checksum_cache_size, package_cache_size, layer_cache, batch_commands, overlay, trace, force, log_file, no_sandbox, privileged_helper, direct_export, deltas, delta_min_size, lockfile, locked):
+    from shardimg.classes.manifest import Manifest
+    from shardimg.classes.bootmanifest import BootManifest
+    from shardimg.functions.system import SystemImage
+    from shardimg.functions.boot import build_boot_image
+    from shardimg.utils.cache import CacheUtils
+    from shardimg.utils.fingerprint import Fingerprint
+    from shardimg.utils.helper import PrivilegedHelper
+    from shardimg.utils.lockfile import PackageLock
+    from shardimg.utils.trace import Trace
+
     print(manifest)
     try:
         manifest_parsed = Manifest(manifest=manifest)
@@ -45,6 +86,15 @@ def build(manifest, build_dir, keep, repo):
         manifest_parsed = BootManifest(manifest=manifest)
         manifest_parsed.parse_manifest()
 
+    cache_dir = cache_dir or CacheUtils.default_directory()
+    package_cache = cache_dir + "/pacman"
+    log_file = os.path.abspath(log_file) if log_file is not None else None
+    if locked and lockfile is None:
+        lockfile = PackageLock.default_path(manifest)
+    if lockfile is not None:
+        lockfile = os.path.abspath(lockfile)
+        PackageLock.load(lockfile)
+
     print(manifest_parsed)
     print("Name "+manifest_parsed.name)
     print("ID "+manifest_parsed.id)
@@ -53,28 +103,289 @@ def build(manifest, build_dir, keep, repo):
     if manifest_parsed.id.count(".") < 2:
         logger.error("Invalid ID. Must contain at least 2 periods")
         sys.exit(1)
-    if manifest_parsed.type == "system":
-        print("Packages "+str(manifest_parsed.packages))
-        print("Base "+manifest_parsed.base)
-        print("Commands" +str(manifest_parsed.commands))
-        print("FsGuard enabled "+str(manifest_parsed.fsguard_enabled))
-        print("FsGuard binary "+manifest_parsed.fsguard_binary)
-        print("FsGuard paths "+" ".join(manifest_parsed.fsguard_paths))
-        print("Building System Image")
-        SystemImage.build_system_image(manifest=manifest_parsed,
-                                       build_dir=build_dir,
-                                       repo=repo,
-                                       manifest_path=manifest,
-                                       fsguard_enabled=manifest_parsed.fsguard_enabled,
-                                       fsguard_binary=manifest_parsed.fsguard_binary,
-                                       fsguard_paths=manifest_parsed.fsguard_paths
-                                       )
-    elif manifest_parsed.type == "boot":
-        print("Kernel Name "+manifest_parsed.kernelname)
-        print("Kernel Package "+manifest_parsed.kernelpackage)
-        print("Kernel Args "+manifest_parsed.kernelargs)
-        print("Commands "+str(manifest_parsed.commands))
-        build_boot_image(manifest_parsed, build_dir, repo, manifest)
+
+    image_dir = os.path.dirname(os.path.abspath(manifest))
+    fingerprint = Fingerprint.build(manifest_parsed, image_dir + "/include", image_dir + "/modules", lockfile=lockfile,
+                                    user=overlay)
+    if not force and Fingerprint.is_current(repo, manifest_parsed.id, fingerprint):
+        logger.info(f"{manifest_parsed.id} is unchanged since the last build, nothing to do. Use --force to rebuild")
+        return
+
+    try:
+        with PrivilegedHelper(enabled=privileged_helper, roots=[build_dir, cache_dir]), Trace.span("Build " + manifest_parsed.id, type=manifest_parsed.type):
+            if manifest_parsed.type == "system":
+                print("Packages "+str(manifest_parsed.packages))
+                print("Base "+manifest_parsed.base)
+                print("Commands" +str(manifest_parsed.commands))
+                print("FsGuard enabled "+str(manifest_parsed.fsguard_enabled))
+                print("FsGuard binary "+manifest_parsed.fsguard_binary)
+                print("FsGuard paths "+" ".join(manifest_parsed.fsguard_paths))
+                print("FsGuard format "+manifest_parsed.fsguard_format)
+                print("FsGuard hash "+manifest_parsed.fsguard_hash)
+                print("FsGuard Merkle tree "+str(manifest_parsed.fsguard_merkle))
+                print("Pruning "+str(manifest_parsed.prune or "off"))
+                print("Deduplication "+str(manifest_parsed.dedup or "off"))
+                print("Building System Image")
+                SystemImage.build_system_image(manifest=manifest_parsed,
+                                               build_dir=build_dir,
+                                               repo=repo,
+                                               manifest_path=manifest,
+                                               fsguard_enabled=manifest_parsed.fsguard_enabled,
+                                               fsguard_binary=manifest_parsed.fsguard_binary,
+                                               fsguard_paths=manifest_parsed.fsguard_paths,
+                                               workers=jobs,
+                                               cache_dir=cache_dir,
+                                               checksum_cache=checksum_cache,
+                                               checksum_cache_size=checksum_cache_size,
+                                               package_cache=package_cache,
+                                               layer_cache=layer_cache,
+                                               batch_commands=batch_commands,
+                                               overlay=overlay,
+                                               log_file=log_file,
+                                               sandbox=not no_sandbox,
+                                               direct_export=direct_export,
+                                               fsguard_format=manifest_parsed.fsguard_format,
+                                               fsguard_hash=manifest_parsed.fsguard_hash,
+                                               fsguard_merkle=manifest_parsed.fsguard_merkle,
+                                               dedup=manifest_parsed.dedup,
+                                               prune=manifest_parsed.prune,
+                                               lockfile=lockfile
+                                               )
+            elif manifest_parsed.type == "boot":
+                print("Kernel Name "+manifest_parsed.kernelname)
+                print("Kernel Package "+manifest_parsed.kernelpackage)
+                print("Kernel Args "+manifest_parsed.kernelargs)
+                print("Commands "+str(manifest_parsed.commands))
+                build_boot_image(manifest_parsed, build_dir, repo, manifest, package_cache=package_cache,
+                                 batch_commands=batch_commands, log_file=log_file, sandbox=not no_sandbox,
+                                 direct_export=direct_export, lockfile=lockfile)
+    finally:
+        Trace.write(trace or build_dir + "/trace.json")
+        print(Trace.summary())
+
+    if fingerprint is None:
+        # The base image is installed by now
+        fingerprint = Fingerprint.build(manifest_parsed, image_dir + "/include", image_dir + "/modules", lockfile=lockfile,
+                                        user=overlay)
+    if fingerprint is not None:
+        Fingerprint.store(repo, manifest_parsed.id, fingerprint)
+    if deltas > 0:
+        from shardimg.utils.deltas import StaticDeltas
+        StaticDeltas.generate(repo, ids=[manifest_parsed.id], depth=deltas, min_size=CacheUtils.parse_size(delta_min_size))
+    CacheUtils.prune_packages(package_cache, CacheUtils.parse_size(package_cache_size))
+
+
+@main.command(name="build-all")
+@click.argument('manifests', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--build-root', help='Directory the build directories of all images are created in.', default="builds")
+@click.option('--repo', help='Path to the flatpak repository. Can be an empty directory.', default="repo")
+@click.option('--max-parallel', type=int, help='Number of images to build at the same time.', default=2)
+@click.option('--cache-dir', help='Directory to keep caches in across builds. Defaults to ~/.cache/shardimg.', default=None)
+@click.option('--layer-cache', is_flag=True, help='Reuse cached snapshots of the root for unchanged packages and commands.', default=False)
+@click.option('--batch-commands', is_flag=True, help='Run all manifest commands in a single chroot session.', default=False)
+@click.option('--overlay', is_flag=True, help='Mount the base image as an overlay instead of copying it.', default=False)
+@click.option('--no-sandbox', is_flag=True, help='Mount proc, sys and dev on the host instead of in a private mount namespace.', default=False)
+@click.option('--privileged-helper', is_flag=True, help='Run elevated commands through one long-lived root helper per build instead of sudo each time.', default=False)
+@click.option('--direct-export', is_flag=True, help='Commit the roots to the repository directly instead of copying them through flatpak-builder.', default=False)
+@click.option('--deltas', type=int, help='Generate static deltas from this many previous commits for every built image.', default=0)
+@click.option('--delta-min-size', callback=validate_size, help='Static deltas smaller than this are not kept, e.g. 64K.', default="0")
+@click.option('--locked', is_flag=True, help='Install the packages of every image from the packages.lock.json next to its manifest.', default=False)
+def build_all(manifests, build_root, repo, max_parallel, cache_dir, layer_cache, batch_commands, overlay, no_sandbox, privileged_helper, direct_export, deltas, delta_min_size, locked):
+    from shardimg.functions.buildall import BuildAll
+
+    build_args = []
+    if cache_dir is not None:
+        build_args.extend(["--cache-dir", os.path.abspath(cache_dir)])
+    if layer_cache:
+        build_args.append("--layer-cache")
+    if batch_commands:
+        build_args.append("--batch-commands")
+    if overlay:
+        build_args.append("--overlay")
+    if no_sandbox:
+        build_args.append("--no-sandbox")
+    if privileged_helper:
+        build_args.append("--privileged-helper")
+    if direct_export:
+        build_args.append("--direct-export")
+    if locked:
+        build_args.append("--locked")
+    results = BuildAll.build_all(
+        manifest_paths=list(manifests),
+        build_root=os.path.abspath(build_root),
+        repo=os.path.abspath(repo),
+        max_parallel=max_parallel,
+        build_args=build_args,
+        user=overlay
+    )
+    built = [id for id, result in results.items() if result == "success"]
+    if deltas > 0 and len(built) > 0:
+        from shardimg.utils.cache import CacheUtils
+        from shardimg.utils.deltas import StaticDeltas
+        StaticDeltas.generate(os.path.abspath(repo), ids=built, depth=deltas, min_size=CacheUtils.parse_size(delta_min_size))
+    if any(result != "success" for result in results.values()):
+        sys.exit(1)
+
+
+@main.command()
+@click.option('--repo', help='Path to the flatpak repository.', default="repo")
+@click.option('--id', 'ids', multiple=True, help='Only generate deltas for this image. Can be given multiple times.')
+@click.option('--depth', type=int, help='Number of previous commits of every ref to generate deltas from.', default=3)
+@click.option('--min-size', callback=validate_size, help='Static deltas smaller than this are not kept, e.g. 64K.', default="0")
+@click.option('--jobs', type=int, help='Number of refs to process in parallel. Defaults to the number of CPUs.', default=None)
+def deltas(repo, ids, depth, min_size, jobs):
+    from shardimg.utils.cache import CacheUtils
+    from shardimg.utils.deltas import StaticDeltas
+
+    StaticDeltas.generate(repo, ids=list(ids) or None, depth=depth, min_size=CacheUtils.parse_size(min_size), jobs=jobs)
+
+
+@main.command()
+@click.option('--manifest', help='Path to the manifest file.', default="manifest.json")
+@click.option('--output', help='Where to write the lockfile. Defaults to packages.lock.json next to the manifest.', default=None)
+@click.option('--cache-dir', help='Directory to keep caches in across builds. Defaults to ~/.cache/shardimg.', default=None)
+@click.option('--log-file', help='Write the output of pacman to this file and only show progress.', default=None)
+def lock(manifest, output, cache_dir, log_file):
+    from shardimg.classes.manifest import Manifest
+    from shardimg.classes.bootmanifest import BootManifest
+    from shardimg.functions.boot import boot_packages
+    from shardimg.utils.cache import CacheUtils
+    from shardimg.utils.lockfile import PackageLock
+
+    try:
+        manifest_parsed = Manifest(manifest=manifest)
+        manifest_parsed.parse_manifest()
+        packages = manifest_parsed.packages
+    except KeyError:
+        manifest_parsed = BootManifest(manifest=manifest)
+        manifest_parsed.parse_manifest()
+        packages = boot_packages(manifest_parsed)
+
+    cache_dir = cache_dir or CacheUtils.default_directory()
+    output = output or PackageLock.default_path(manifest)
+    result = PackageLock.resolve(packages, cache_dir + "/pacman",
+                                 log_file=os.path.abspath(log_file) if log_file is not None else None)
+    PackageLock.write(output, result)
+    logger.info(f"Wrote lockfile {output}")
+
+
+@main.command(name="bench-hash")
+@click.option('--size', callback=validate_size, help='Amount of data hashed per run, e.g. 256M.', default="256M")
+@click.option('--runs', type=int, help='Number of runs per algorithm, the fastest one counts.', default=3)
+def bench_hash(size, runs):
+    from shardimg.utils.cache import CacheUtils
+    from shardimg.utils.checksum import ALGORITHMS, Checksum
+
+    available = Checksum.available_algorithms()
+    for algorithm in ALGORITHMS:
+        if algorithm not in available:
+            print(f"{algorithm:<8} not installed")
+            continue
+        print(f"{algorithm:<8} {Checksum.benchmark(algorithm, CacheUtils.parse_size(size), runs):10.1f} MiB/s")
+
+
+@main.command()
+@click.argument('old')
+@click.argument('new')
+@click.option('--repo', help='Compare two refs or commits of this repository instead of build roots or file lists.', default=None)
+@click.option('--memory', callback=validate_size, help='Memory budget for sorting the entries, e.g. 512M.', default="512M")
+@click.option('--depth', type=int, help='Number of directory levels size changes are summed up for.', default=2)
+@click.option('--by-package', is_flag=True, help='Also sum up size changes per pacman package. Build roots only.', default=False)
+@click.option('--top', type=int, help='Number of directories and packages with the largest size changes to show.', default=20)
+@click.option('--summary', is_flag=True, help='Only print the summary, not every changed file.', default=False)
+@click.option('--tmpdir', help='Directory the sorted runs are written to. Defaults to the system temporary directory.', default=None)
+def diff(old, new, repo, memory, depth, by_package, top, summary, tmpdir):
+    from shardimg.utils.cache import CacheUtils
+    from shardimg.utils.diff import DiffSource, ImageDiff
+
+    for location in [old, new]:
+        if repo is None and not os.path.exists(location):
+            logger.error(f"{location} is neither a build root nor a file list. Use --repo to compare commits")
+            sys.exit(1)
+    signs = {"added": "+", "removed": "-", "changed": "~", "suid": "!"}
+
+    def show(status, path, size):
+        print(f"{signs[status]} {path}" + (f" ({ImageDiff.format_size(size)})" if size != 0 else ""))
+
+    result = ImageDiff.diff(
+        DiffSource(old, repo),
+        DiffSource(new, repo),
+        memory=CacheUtils.parse_size(memory),
+        depth=depth,
+        by_package=by_package,
+        tmpdir=tmpdir,
+        callback=None if summary else show
+    )
+    ImageDiff.report(result, top=top)
+
+
+@main.group()
+def merkle():
+    pass
+
+
+@merkle.command(name="diff")
+@click.argument('old', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new', type=click.Path(exists=True, dir_okay=False))
+def merkle_diff(old, new):
+    from shardimg.utils.merkle import MerkleTree
+
+    result = MerkleTree.diff(MerkleTree.load(old), MerkleTree.load(new))
+    if result is None:
+        sys.exit(1)
+    for (status, sign) in [("removed", "-"), ("added", "+"), ("changed", "~")]:
+        for path in result[status]:
+            print(sign + " " + path)
+
+
+@merkle.command(name="verify")
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.option('--tree', help='Path to the Merkle tree. Defaults to <root>/FsGuard/merkle.', default=None)
+@click.option('--subtree', help='Only verify the files below this path of the image.', default="/")
+@click.option('--pubkey', help='minisign public key the root digest is checked with.', default=None)
+@click.option('--jobs', type=int, help='Number of files to hash in parallel. Defaults to the number of CPUs.', default=None)
+def merkle_verify(root, tree, subtree, pubkey, jobs):
+    from shardimg.utils.command import Command
+    from shardimg.utils.merkle import MerkleTree
+
+    tree = tree or root + "/FsGuard/merkle"
+    root_file = os.path.dirname(tree) + "/merkle.root"
+    if not os.path.exists(root_file):
+        logger.error(f"Signed Merkle root {root_file} not found")
+        sys.exit(1)
+    if pubkey is not None:
+        Command.execute_command(
+            command=["minisign", "-Vm", root_file, "-x", root_file + ".minisig", "-p", pubkey],
+            command_description="Verifying the signature of the Merkle root",
+            crash=True
+        )
+    with open(root_file, "r") as f:
+        root_digest = f.read().strip()
+    mismatches = MerkleTree.load(tree).verify(os.path.abspath(root), subtree, root_digest=root_digest, workers=jobs)
+    for path in mismatches:
+        print("! " + path)
+    if len(mismatches) > 0:
+        logger.error(f"{len(mismatches)} paths below {subtree} don't match the Merkle tree")
+        sys.exit(1)
+    logger.info(f"{subtree} matches the Merkle tree")
+
+
+@main.group()
+def cache():
+    pass
+
+
+@cache.command()
+@click.option('--cache-dir', help='Directory the caches are kept in. Defaults to ~/.cache/shardimg.', default=None)
+@click.option('--max-size', callback=validate_size, help='Size the package cache should be pruned to, e.g. 20G.', default="20G")
+@click.option('--max-layers', type=int, help='Number of cached root layers to keep.', default=20)
+def prune(cache_dir, max_size, max_layers):
+    from shardimg.utils.cache import CacheUtils
+    from shardimg.utils.layers import LayerCache
+
+    cache_dir = cache_dir or CacheUtils.default_directory()
+    CacheUtils.prune_packages(cache_dir + "/pacman", CacheUtils.parse_size(max_size))
+    LayerCache(cache_dir + "/layers").prune(max_layers)
 
 
 @main.command()
@@ -86,6 +397,8 @@ def build(manifest, build_dir, keep, repo):
 @click.option('--type', type=click.Choice(["boot", "system"], case_sensitive=False), prompt='What type of image do you want to Create?', help='The type of image to create, can be boot and system', default="system")
 @click.option('--base', prompt='What image should be used as the base?', help='The base image to be used, can be empty to create an independent image', default='')
 def init(directory, name, id, version, author, type, base):
+    from shardimg.functions.init import initialize_directory
+
     print(directory)
     print(name)
     print(id)
@@ -0,0 +1,139 @@
+# cache.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import os
+import time
+from shardimg.utils.files import FileUtils
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# Partial downloads younger than this may still be written by a running pacman
+PARTIAL_MAX_AGE = 60 * 60
+
+SIZE_UNITS = {
+    "": 1,
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3,
+    "T": 1024 ** 4,
+}
+
+
+class CacheUtils:
+
+    @staticmethod
+    def default_directory() -> str:
+        """
+        Returns the directory shardimg keeps its caches in across builds.
+
+        Returns:
+        str: $XDG_CACHE_HOME/shardimg, or ~/.cache/shardimg if XDG_CACHE_HOME is not set
+        """
+        cache_home = os.environ.get("XDG_CACHE_HOME", "").strip()
+        if cache_home == "":
+            cache_home = os.path.expanduser("~/.cache")
+        return cache_home + "/shardimg"
+
+    @staticmethod
+    def parse_size(size: str) -> int:
+        """
+        Parses a human readable size like "512M" or "20G" into bytes.
+
+        Parameters:
+        size (str): The size to parse, with an optional K, M, G or T suffix
+
+        Returns:
+        int: The size in bytes
+        """
+        size = size.strip().upper().removesuffix("B").removesuffix("I")
+        unit = size[-1] if size != "" and size[-1] in SIZE_UNITS else ""
+        return int(float(size.removesuffix(unit)) * SIZE_UNITS[unit])
+
+    @staticmethod
+    def mark_packages_used(cache_dir: str, dbpath: str):
+        """
+        Marks the packages installed into a root as recently used in the package cache,
+        so that pruning the cache evicts the packages that haven't been used the longest.
+
+        Parameters:
+        cache_dir (str): The pacman package cache
+        dbpath    (str): The pacman database of the root the packages were installed into
+        """
+        if os.environ.get("DEBUG"):
+            logger.debug(f"Marking packages from {dbpath} as used in {cache_dir}")
+            if os.environ.get("SHARDS_FAKE"):
+                return
+        if not os.path.exists(dbpath + "/local") or not os.path.exists(cache_dir):
+            return
+        installed = set(os.listdir(dbpath + "/local"))
+        now = time.time()
+        for file in os.listdir(cache_dir):
+            if ".pkg.tar" not in file:
+                continue
+            # <name>-<version>-<release>-<arch>.pkg.tar.*, the local database uses <name>-<version>-<release>
+            if file.split(".pkg.tar")[0].rsplit("-", 1)[0] in installed:
+                os.utime(cache_dir + "/" + file, (now, now))
+
+    @staticmethod
+    def prune_packages(cache_dir: str, max_size: int):
+        """
+        Deletes the least recently used packages from the package cache until it fits into the given size.
+        Partial downloads are deleted once they are older than PARTIAL_MAX_AGE. The cache is locked exclusively
+        meanwhile, builds installing packages from it hold a shared lock.
+
+        Parameters:
+        cache_dir (str): The pacman package cache
+        max_size  (int): The maximum size of the cache in bytes
+        """
+        if not os.path.exists(cache_dir):
+            return
+        with FileUtils.lock(cache_dir):
+            packages = []
+            total = 0
+            now = time.time()
+            for file in os.listdir(cache_dir):
+                path = cache_dir + "/" + file
+                if file.endswith(".part") or file.startswith("download-"):
+                    if now - os.lstat(path).st_mtime < PARTIAL_MAX_AGE:
+                        continue
+                    if os.path.isdir(path):
+                        FileUtils.delete_directory(path)
+                    else:
+                        FileUtils.delete_file(path)
+                    continue
+                if ".pkg.tar" not in file or file.endswith(".sig") or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                size = stat.st_size
+                if os.path.exists(path + ".sig"):
+                    size += os.stat(path + ".sig").st_size
+                packages.append((stat.st_mtime, size, path))
+                total += size
+
+            logger.info(f"Package cache {cache_dir} uses {total / 1024 ** 2:.1f} MiB of {max_size / 1024 ** 2:.1f} MiB")
+            freed = 0
+            removed = 0
+            for (mtime, size, path) in sorted(packages):
+                if total - freed <= max_size:
+                    break
+                FileUtils.delete_file(path)
+                if os.path.exists(path + ".sig"):
+                    FileUtils.delete_file(path + ".sig")
+                freed += size
+                removed += 1
+            if removed > 0:
+                logger.info(f"Pruned {removed} packages ({freed / 1024 ** 2:.1f} MiB) from {cache_dir}")
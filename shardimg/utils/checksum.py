@@ -0,0 +1,312 @@
+# checksum.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+CHUNK_SIZE = 1024 * 1024
+# blake3 is only available if the blake3 package is installed
+ALGORITHMS = ["sha1", "sha256", "blake2b", "blake3"]
+
+
+class Checksum:
+
+    @staticmethod
+    def hasher(algorithm: str):
+        """
+        Returns the constructor of a hash algorithm.
+
+        Parameters:
+        algorithm (str): One of sha1, sha256, blake2b or blake3
+
+        Returns:
+        func: Creates a new hash object with update and hexdigest
+        """
+        if algorithm not in ALGORITHMS:
+            logger.error(f"Unknown hash algorithm {algorithm}, must be one of " + ", ".join(ALGORITHMS))
+            sys.exit(1)
+        if algorithm == "blake3":
+            try:
+                from blake3 import blake3
+            except ImportError:
+                logger.error("The blake3 hash algorithm needs the blake3 python package")
+                sys.exit(1)
+            return blake3
+        return getattr(hashlib, algorithm)
+
+    @staticmethod
+    def available_algorithms() -> list:
+        """
+        Returns the hash algorithms that can be used on this machine.
+        """
+        try:
+            import blake3
+        except ImportError:
+            return [algorithm for algorithm in ALGORITHMS if algorithm != "blake3"]
+        return list(ALGORITHMS)
+
+    @staticmethod
+    def file_checksum(
+        path: str,
+        chunk_size: int = CHUNK_SIZE,
+        algorithm: str = "sha1"
+    ) -> str:
+        """
+        Calculates the checksum of a file without reading it into memory as a whole.
+
+        Parameters:
+        path       (str): The file to checksum
+        chunk_size (int): How many bytes are read and hashed at once. Defaults to 1MiB if not specified
+        algorithm  (str): The hash algorithm. Defaults to sha1 if not specified
+
+        Returns:
+        str: The hex digest of the file
+        """
+        digest = Checksum.hasher(algorithm)()
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        with open(path, 'rb', buffering=0) as f:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                digest.update(view[:read])
+        return digest.hexdigest()
+
+    @staticmethod
+    def checksum_files(
+        paths: list,
+        workers: int = None,
+        cache: "ChecksumCache" = None,
+        algorithm: str = "sha1"
+    ) -> list:
+        """
+        Calculates the checksums of multiple files in parallel.
+        hashlib releases the GIL while hashing, so a thread pool is enough to keep all cores busy.
+
+        Parameters:
+        paths   (list)         : The files to checksum
+        workers (int)          : How many files are hashed at the same time. Defaults to the cpu count if not specified
+        cache   (ChecksumCache): Cache to look up unchanged files in, and to store new checksums in (optional).
+                                 It has to use the same algorithm
+        algorithm (str)        : The hash algorithm. Defaults to sha1 if not specified
+
+        Returns:
+        list: The hex digests, in the same order as the given paths
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        checksums = [None] * len(paths)
+        missing = []
+        for index, path in enumerate(paths):
+            if cache is None:
+                missing.append((index, None))
+                continue
+            stat = os.stat(path)
+            checksum = cache.lookup(path, stat)
+            if checksum is None:
+                missing.append((index, stat))
+            else:
+                checksums[index] = checksum
+
+        # Hardlinks of one inode, e.g. after deduplication, are only read once
+        inodes = {}
+        missing_paths = []
+        owners = []
+        for (index, stat) in missing:
+            stat = stat or os.stat(paths[index])
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in inodes:
+                inodes[inode] = len(missing_paths)
+                missing_paths.append(paths[index])
+            owners.append(inodes[inode])
+        checksum = partial(Checksum.file_checksum, algorithm=algorithm)
+        if workers <= 1 or len(missing_paths) <= 1:
+            results = [checksum(path) for path in missing_paths]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(checksum, missing_paths))
+
+        for (index, stat), owner in zip(missing, owners):
+            checksum = results[owner]
+            checksums[index] = checksum
+            if cache is not None:
+                cache.store(paths[index], stat, checksum)
+        return checksums
+
+    @staticmethod
+    def benchmark(algorithm: str, size: int = 256 * 1024 * 1024, runs: int = 3) -> float:
+        """
+        Measures how fast an algorithm hashes data on one core, the way file_checksum feeds it.
+
+        Parameters:
+        algorithm (str): The hash algorithm
+        size      (int): How many bytes are hashed per run. Defaults to 256MiB if not specified
+        runs      (int): How often the data is hashed, the fastest run counts. Defaults to 3 if not specified
+
+        Returns:
+        float: The throughput in MiB per second
+        """
+        hasher = Checksum.hasher(algorithm)
+        buffer = memoryview(os.urandom(CHUNK_SIZE))
+        chunks = max(size // CHUNK_SIZE, 1)
+        fastest = None
+        for run in range(runs):
+            start = time.perf_counter()
+            digest = hasher()
+            for chunk in range(chunks):
+                digest.update(buffer)
+            digest.hexdigest()
+            elapsed = time.perf_counter() - start
+            fastest = elapsed if fastest is None else min(fastest, elapsed)
+        return chunks * CHUNK_SIZE / 1024 / 1024 / fastest
+
+
+class ChecksumCache:
+    """
+    On-disk cache of file checksums that survives across builds.
+
+    Entries are keyed by the path relative to the image root and the hash algorithm. An entry is only used
+    if the file still has the same size and mtime, in strict mode the inode and ctime have to match as well.
+    Once the cache holds more than max_entries entries, the least recently used ones are evicted.
+
+    The cached checksums end up in the signed FsGuard file list, so the cache trades integrity for speed:
+    in mtime mode, a file whose contents changed without a new size or mtime keeps its old checksum.
+    Strict mode only hits for files that keep their inode across builds, e.g. the lower layer of an overlay build,
+    copied and restored roots get new inodes. Callers use one cache per build directory.
+    """
+
+    MODES = ["strict", "mtime"]
+
+    def __init__(
+        self,
+        path: str,
+        root: str,
+        mode: str = "mtime",
+        max_entries: int = 1000000,
+        algorithm: str = "sha1"
+    ):
+        """
+        Opens the cache, creating it if it does not exist yet.
+
+        Parameters:
+        path        (str): Path to the cache database
+        root        (str): The image root, paths are stored relative to it
+        mode        (str): Which file attributes have to match for an entry to be used, either "strict" or "mtime"
+        max_entries (int): How many entries the cache may hold before old entries are evicted
+        algorithm   (str): The hash algorithm the checksums are calculated with. Defaults to sha1 if not specified
+        """
+        self.root = os.path.abspath(root)
+        self.algorithm = algorithm
+        self.strict = mode == "strict"
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+        self.used = []
+        self.stored = []
+        self.now = int(time.time())
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Builds running in parallel share the cache, wait for their writes instead of failing
+        self.database = sqlite3.connect(path, timeout=300)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in self.database.execute("PRAGMA table_info(checksums)")]
+        if len(columns) > 0 and "algorithm" not in columns:
+            # Caches from before the hash algorithm was configurable only hold sha1 checksums under the path alone
+            logger.info("Checksum cache has an old format, starting a new one")
+            with self.database:
+                self.database.execute("DROP TABLE checksums")
+        self.database.execute(
+            "CREATE TABLE IF NOT EXISTS checksums ("
+            "path TEXT, algorithm TEXT, size INTEGER, mtime INTEGER, inode INTEGER, ctime INTEGER, "
+            "checksum TEXT, last_used INTEGER, PRIMARY KEY (path, algorithm))"
+        )
+        self.database.execute("CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+
+    def key(self, path: str) -> str:
+        """
+        Returns the cache key of a file, which is its path relative to the image root.
+        """
+        return os.path.abspath(path).replace(self.root, "", 1)
+
+    def lookup(self, path: str, stat: os.stat_result) -> str:
+        """
+        Looks up the checksum of an unchanged file.
+
+        Parameters:
+        path (str)           : The file to look up
+        stat (os.stat_result): The current stat of the file
+
+        Returns:
+        str: The cached checksum. None if the file is not cached or has changed since
+        """
+        key = self.key(path)
+        row = self.database.execute(
+            "SELECT size, mtime, inode, ctime, checksum FROM checksums WHERE path = ? AND algorithm = ?",
+            (key, self.algorithm)
+        ).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns or \
+                (self.strict and (row[2] != stat.st_ino or row[3] != stat.st_ctime_ns)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_bytes += stat.st_size
+        self.used.append((self.now, key, self.algorithm))
+        return row[4]
+
+    def store(self, path: str, stat: os.stat_result, checksum: str):
+        """
+        Adds the checksum of a file to the cache.
+
+        Parameters:
+        path     (str)           : The file the checksum belongs to
+        stat     (os.stat_result): The stat of the file at the time it was hashed
+        checksum (str)           : The checksum of the file
+        """
+        self.stored.append((self.key(path), self.algorithm, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                            stat.st_ctime_ns, checksum, self.now))
+
+    def close(self):
+        """
+        Writes all changes to disk, evicts the least recently used entries and reports the cache statistics.
+        """
+        with self.database:
+            self.database.executemany("UPDATE checksums SET last_used = ? WHERE path = ? AND algorithm = ?", self.used)
+            self.database.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.stored)
+            count = self.database.execute("SELECT COUNT(*) FROM checksums").fetchone()[0]
+            if count > self.max_entries:
+                self.database.execute(
+                    "DELETE FROM checksums WHERE rowid IN "
+                    "(SELECT rowid FROM checksums ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                logger.info(f"Evicted {count - self.max_entries} entries from the checksum cache")
+        self.database.close()
+        self.used = []
+        self.stored = []
+        logger.info(f"Checksum cache: {self.hits} hits, {self.misses} misses, "
+                    f"{self.saved_bytes / 1024 / 1024:.1f} MiB not re-read")
@@ -15,13 +15,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # SPDX-License-Identifier: GPL-3.0-only
+import asyncio
 import subprocess
 import os
 import sys
+from collections import deque
+from shardimg.utils.helper import PrivilegedHelper
+from shardimg.utils.progress import Progress
 from shardimg.utils.log import setup_logging
 logger=setup_logging()
 
+TAIL_LINES = 50
+
 class Command:
+    # Maximum number of commands started through the async variants that run at the same time
+    async_limit = os.cpu_count() or 4
+    semaphores = {}
+
     @staticmethod
     def execute_command(
         command: list,
@@ -30,6 +40,12 @@ class Command:
         workdir: str = "",
         elevated: bool = False,
         capture: bool = False,
+        stream: bool = False,
+        log_file: str = None,
+        callback = None,
+        progress = Progress.log,
+        tail: int = TAIL_LINES,
+        quiet: bool = False,
     ) -> [str, str, str]:
         """
         Executes a given command and optionally captures the output.
@@ -39,11 +55,23 @@ class Command:
         command_description (str) : A description of what the command does (optional)
         crash               (bool): Whether the system should crash if the command fails. Defaults to False if not specified
         workdir             (str) : In what directory the command should run. Runs in the current cwd if not specified
-        elevated            (bool): Whether the command should be run as the root user. Defaults to False if not specified
+        elevated            (bool): Whether the command should be run as the root user. Runs through the privileged helper
+                                    if one is active, with sudo otherwise. Defaults to False if not specified
         capture             (bool): Whether the command output should be captured. Defaults to False if not specified.
+        stream              (bool): Whether the output should be read line by line instead of going to the terminal.
+                                    Only the last lines are kept in memory and logged if the command fails.
+                                    Defaults to False if not specified
+        log_file            (str) : File the streamed output is appended to (optional)
+        callback            (func): Called with every streamed output line (optional)
+        progress            (func): Called with the progress events parsed from the streamed output.
+                                    Logs them if not specified, None disables progress events
+        tail                (int) : How many of the last streamed output lines are kept. Defaults to 50 if not specified
+        quiet               (bool): Whether a failure is left to the caller instead of being logged, for commands whose
+                                    failure is an expected answer. Has no effect with crash. Defaults to False if not specified
 
         Returns:
-        [str, str, str]: A list containing the returncode, stdout and stderr
+        [str, str, str]: A list containing the returncode, stdout and stderr.
+                         When streaming, stdout contains the kept output lines and stderr is None
         """
         if os.environ.get("DEBUG"):
             logger.debug("Command: " + " ".join(command))
@@ -51,21 +79,206 @@ class Command:
                 return [0, "", ""]
 
         rootcommand = ["sudo"] + command
-        out = subprocess.run(
-            rootcommand if elevated else command,
-            capture_output=capture,
-            cwd=workdir if workdir.strip() != "" else None
-        )
-        if out.returncode != 0 and command_description.strip() != "":
-            logger.error(command_description+" failed with returncode "+str(out.returncode))
+        helper = PrivilegedHelper.active if elevated else None
+        if stream:
+            out = Command.stream_command(
+                rootcommand if elevated and helper is None else command,
+                workdir=workdir,
+                log_file=log_file,
+                callback=callback,
+                progress=progress,
+                tail=tail,
+                helper=helper
+            )
+        elif helper is not None:
+            (returncode, stdout, stderr) = helper.run(command, workdir=workdir, capture=capture)
+            out = subprocess.CompletedProcess(command, returncode, stdout=stdout, stderr=stderr)
+        else:
+            out = subprocess.run(
+                rootcommand if elevated else command,
+                capture_output=capture,
+                cwd=workdir if workdir.strip() != "" else None
+            )
+        if quiet and not crash:
+            return [out.returncode, out.stdout, out.stderr]
+        if out.returncode != 0 and stream and out.stdout:
+            logger.error("Last output lines:\n" + out.stdout.decode("UTF-8", errors="replace").rstrip())
+        Command.check_returncode(command, command_description, out.returncode, crash)
+
+        return [out.returncode, out.stdout, out.stderr]
+
+    @staticmethod
+    def check_returncode(command: list, command_description: str, returncode: int, crash: bool):
+        """
+        Logs a failed command and exits if requested.
+
+        Parameters:
+        command             (list): The command that was run
+        command_description (str) : A description of what the command does, used instead of the command if set
+        returncode          (int) : The returncode of the command
+        crash               (bool): Whether the system should crash if the command failed
+        """
+        if returncode != 0 and command_description.strip() != "":
+            logger.error(command_description+" failed with returncode "+str(returncode))
             if crash:
-                sys.exit(out.returncode)
-        elif out.returncode != 0:
-            logger.error(" ".join(command)+" failed with returncode "+str(out.returncode))
+                sys.exit(returncode)
+        elif returncode != 0:
+            logger.error(" ".join(command)+" failed with returncode "+str(returncode))
             if crash:
-                sys.exit(out.returncode)
+                sys.exit(returncode)
 
-        return [out.returncode, out.stdout, out.stderr]
+    @staticmethod
+    def async_semaphore() -> asyncio.Semaphore:
+        """
+        Returns the semaphore limiting the concurrent async commands of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in Command.semaphores:
+            # Semaphores can't be shared between event loops, the ones of finished loops are dropped
+            Command.semaphores = {loop: asyncio.Semaphore(max(Command.async_limit, 1))}
+        return Command.semaphores[loop]
+
+    @staticmethod
+    async def execute_command_async(
+        command: list,
+        command_description: str = "",
+        crash: bool = False,
+        workdir: str = "",
+        elevated: bool = False,
+        capture: bool = False,
+    ) -> [str, str, str]:
+        """
+        Executes a given command without blocking the event loop and optionally captures the output.
+        At most Command.async_limit commands run at the same time, the others wait for a free slot.
+
+        Parameters:
+        command             (list): The command to run, each parameter is a seperate object in the list
+        command_description (str) : A description of what the command does (optional)
+        crash               (bool): Whether the system should crash if the command fails. Defaults to False if not specified
+        workdir             (str) : In what directory the command should run. Runs in the current cwd if not specified
+        elevated            (bool): Whether the command should be run as the root user. Runs through the privileged helper
+                                    if one is active, with sudo otherwise. Defaults to False if not specified
+        capture             (bool): Whether the command output should be captured. Defaults to False if not specified.
+
+        Returns:
+        [str, str, str]: A list containing the returncode, stdout and stderr
+        """
+        if os.environ.get("DEBUG"):
+            logger.debug("Command: " + " ".join(command))
+            if os.environ.get("SHARDS_FAKE"):
+                return [0, "", ""]
+
+        rootcommand = ["sudo"] + command
+        helper = PrivilegedHelper.active if elevated else None
+        async with Command.async_semaphore():
+            if helper is not None:
+                (returncode, stdout, stderr) = await asyncio.to_thread(helper.run, command, workdir, capture)
+            else:
+                process = await asyncio.create_subprocess_exec(
+                    *(rootcommand if elevated else command),
+                    stdout=subprocess.PIPE if capture else None,
+                    stderr=subprocess.PIPE if capture else None,
+                    cwd=workdir if workdir.strip() != "" else None
+                )
+                stdout, stderr = await process.communicate()
+                returncode = process.returncode
+        Command.check_returncode(command, command_description, returncode, crash)
+
+        return [returncode, stdout, stderr]
+
+    @staticmethod
+    def run_async(*coroutines) -> list:
+        """
+        Runs coroutines concurrently and waits for all of them.
+        If one of them crashes, the crash is passed on once the others have finished.
+
+        Parameters:
+        coroutines: The coroutines to run, e.g. from the async command variants or asyncio.to_thread
+
+        Returns:
+        list: The results of the coroutines, in the order they were passed in
+        """
+        # SystemExit would stop the event loop in the middle of the other coroutines
+        async def guarded(coroutine):
+            try:
+                return (await coroutine, None)
+            except SystemExit as e:
+                return (None, e)
+
+        async def gather():
+            return await asyncio.gather(*[guarded(coroutine) for coroutine in coroutines])
+
+        results = asyncio.run(gather())
+        for (result, exit) in results:
+            if exit is not None:
+                raise exit
+        return [result for (result, exit) in results]
+
+    @staticmethod
+    def stream_command(
+            command: list,
+            workdir: str = "",
+            log_file: str = None,
+            callback = None,
+            progress = None,
+            tail: int = TAIL_LINES,
+            helper: PrivilegedHelper = None
+    ) -> subprocess.CompletedProcess:
+        """
+        Runs a command and reads its combined stdout and stderr line by line.
+        Memory use is bounded by the number of kept lines, no matter how much the command outputs.
+
+        Parameters:
+        command  (list): The command to run, each parameter is a seperate object in the list
+        workdir  (str) : In what directory the command should run. Runs in the current cwd if not specified
+        log_file (str) : File the output is appended to (optional)
+        callback (func): Called with every output line (optional)
+        progress (func): Called with the progress events parsed from the output (optional)
+        tail     (int) : How many of the last output lines are kept. Defaults to 50 if not specified
+        helper   (PrivilegedHelper): Helper that runs the command as root (optional)
+
+        Returns:
+        subprocess.CompletedProcess: The returncode and the kept output lines as stdout
+        """
+        lines = deque(maxlen=max(tail, 0))
+        log = open(log_file, "a") if log_file is not None else None
+        try:
+            if log is not None:
+                log.write("$ " + " ".join(command) + "\n")
+                log.flush()
+
+            def handle(raw):
+                # Progress bars redraw themselves with carriage returns, only the last state is kept
+                line = raw.decode("UTF-8", errors="replace").rstrip("\n").split("\r")[-1]
+                lines.append(line)
+                if log is not None:
+                    log.write(line + "\n")
+                if callback is not None:
+                    callback(line)
+                if progress is not None:
+                    event = Progress.parse(line)
+                    if event is not None:
+                        progress(event)
+
+            if helper is not None:
+                returncode = helper.run(command, workdir=workdir, line_callback=handle)[0]
+            else:
+                process = subprocess.Popen(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    cwd=workdir if workdir.strip() != "" else None
+                )
+                with process.stdout:
+                    for raw in process.stdout:
+                        handle(raw)
+                returncode = process.wait()
+        finally:
+            if log is not None:
+                log.close()
+        output = "".join(line + "\n" for line in lines).encode("UTF-8")
+        return subprocess.CompletedProcess(command, returncode, stdout=output, stderr=None)
 
     @staticmethod
     def execute_chroot(
@@ -94,3 +307,31 @@ class Command:
             crash=crash,
             elevated=True
         )
+
+    @staticmethod
+    async def execute_chroot_async(
+            command: list,
+            command_description: str = "",
+            crash: bool = False,
+            root: str = "/mnt"
+    ) -> [str, str, str]:
+        """
+        Executes a given command in a chroot without blocking the event loop.
+
+        Parameters:
+        command             (list): The command to run, each parameter is a seperate object in the list
+        command_description (str) : A description of what the command does (optional)
+        crash               (bool): Whether the system should crash if the command fails. Defaults to False if not specified
+        root                (str) : The root that chroot should switch to.
+
+        Returns:
+        [str, str, str]: A list containing the returncode, stdout and stderr
+        """
+        chroot_command = ["arch-chroot", root]
+        chroot_command.extend(command)
+        return await Command.execute_command_async(
+            command=chroot_command,
+            command_description=command_description,
+            crash=crash,
+            elevated=True
+        )
@@ -0,0 +1,324 @@
+# copyengine.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import errno
+import fcntl
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# ioctl request to share the extents of one file with another, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+COPY_CHUNK = 64 * 1024 * 1024
+# Errors that mean a copy method is not supported for the given files, so the next one should be tried
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.ETXTBSY)
+
+
+class CopyStats:
+    """
+    Statistics of a copy operation.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.reflinked = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def add(self, size: int, reflinked: bool):
+        """
+        Counts a copied file.
+
+        Parameters:
+        size      (int) : Size of the copied file
+        reflinked (bool): Whether the file was reflinked instead of copied
+        """
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            if reflinked:
+                self.reflinked += 1
+
+    def __str__(self):
+        return f"{self.files} files ({self.bytes / 1024 / 1024:.1f} MiB, {self.reflinked} reflinked)"
+
+
+class CopyEngine:
+    """
+    Copies files and directory trees in-process.
+
+    File contents are reflinked with FICLONE if the filesystem supports it, otherwise they are copied
+    with copy_file_range, sendfile or read/write, whichever works first. Holes in sparse files are kept.
+    Symlinks, hardlinks, special files, permissions, ownership, timestamps and extended attributes are preserved
+    as far as the current user is allowed to.
+    """
+
+    def __init__(self, workers: int = None):
+        """
+        Parameters:
+        workers (int): How many files are copied at the same time. Defaults to the cpu count if not specified
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.stats = CopyStats()
+
+    @staticmethod
+    def copy_data(source_fd: int, destination_fd: int, size: int) -> bool:
+        """
+        Copies the contents of one file into another, empty file.
+
+        Parameters:
+        source_fd      (int): File descriptor of the source
+        destination_fd (int): File descriptor of the destination
+        size           (int): Size of the source
+
+        Returns:
+        bool: True if the contents were reflinked
+        """
+        if size == 0:
+            return False
+        try:
+            fcntl.ioctl(destination_fd, FICLONE, source_fd)
+            return True
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+
+        # Copy only the data segments of sparse files, so that holes stay holes
+        segments = [(0, size)]
+        if os.fstat(source_fd).st_blocks * 512 < size:
+            segments = []
+            offset = 0
+            try:
+                while offset < size:
+                    start = os.lseek(source_fd, offset, os.SEEK_DATA)
+                    end = os.lseek(source_fd, start, os.SEEK_HOLE)
+                    segments.append((start, end))
+                    offset = end
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    pass
+                elif e.errno in UNSUPPORTED:
+                    segments = [(0, size)]
+                else:
+                    raise
+            os.ftruncate(destination_fd, size)
+
+        for (start, end) in segments:
+            CopyEngine.copy_range(source_fd, destination_fd, start, end)
+        return False
+
+    @staticmethod
+    def copy_range(source_fd: int, destination_fd: int, start: int, end: int):
+        """
+        Copies a byte range of one file to the same offset of another file.
+
+        Parameters:
+        source_fd      (int): File descriptor of the source
+        destination_fd (int): File descriptor of the destination
+        start          (int): First byte to copy
+        end            (int): First byte not to copy
+        """
+        offset = start
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < end:
+                    copied = os.copy_file_range(source_fd, destination_fd, min(COPY_CHUNK, end - offset),
+                                                offset, offset)
+                    if copied == 0:
+                        return
+                    offset += copied
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+        try:
+            os.lseek(destination_fd, offset, os.SEEK_SET)
+            while offset < end:
+                copied = os.sendfile(destination_fd, source_fd, offset, min(COPY_CHUNK, end - offset))
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError as e:
+            if e.errno not in UNSUPPORTED:
+                raise
+        os.lseek(source_fd, offset, os.SEEK_SET)
+        os.lseek(destination_fd, offset, os.SEEK_SET)
+        while offset < end:
+            data = os.read(source_fd, min(1024 * 1024, end - offset))
+            if not data:
+                return
+            os.write(destination_fd, data)
+            offset += len(data)
+
+    @staticmethod
+    def copy_metadata(source_stat: os.stat_result, source: str, destination: str):
+        """
+        Copies ownership, permissions, extended attributes and timestamps.
+        Ownership and attributes the current user can't set are skipped.
+
+        Parameters:
+        source_stat (os.stat_result): lstat of the source
+        source      (str)           : The source path
+        destination (str)           : The destination path
+        """
+        symlink = stat.S_ISLNK(source_stat.st_mode)
+        try:
+            os.chown(destination, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
+        except PermissionError:
+            pass
+        try:
+            for attribute in os.listxattr(source, follow_symlinks=False):
+                try:
+                    os.setxattr(destination, attribute, os.getxattr(source, attribute, follow_symlinks=False),
+                                follow_symlinks=False)
+                except OSError as e:
+                    if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EACCES):
+                        raise
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES):
+                raise
+        if not symlink:
+            # chown clears the suid and sgid bits, so the mode has to be set afterwards
+            os.chmod(destination, stat.S_IMODE(source_stat.st_mode))
+        os.utime(destination, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns), follow_symlinks=not symlink)
+
+    def copy_regular_file(self, source: str, destination: str, source_stat: os.stat_result):
+        """
+        Copies a regular file including its metadata.
+
+        Parameters:
+        source      (str)           : The source file
+        destination (str)           : The destination file, gets replaced if it exists
+        source_stat (os.stat_result): lstat of the source
+        """
+        source_fd = os.open(source, os.O_RDONLY)
+        try:
+            if os.path.lexists(destination):
+                os.unlink(destination)
+            destination_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                reflinked = CopyEngine.copy_data(source_fd, destination_fd, source_stat.st_size)
+            finally:
+                os.close(destination_fd)
+        finally:
+            os.close(source_fd)
+        CopyEngine.copy_metadata(source_stat, source, destination)
+        self.stats.add(source_stat.st_size, reflinked)
+
+    def copy_entry(self, source: str, destination: str, source_stat: os.stat_result):
+        """
+        Copies a single non-directory entry: a regular file, a symlink or a special file.
+
+        Parameters:
+        source      (str)           : The source path
+        destination (str)           : The destination path
+        source_stat (os.stat_result): lstat of the source
+        """
+        try:
+            if stat.S_ISREG(source_stat.st_mode):
+                self.copy_regular_file(source, destination, source_stat)
+                return
+            if os.path.lexists(destination):
+                os.unlink(destination)
+            if stat.S_ISLNK(source_stat.st_mode):
+                os.symlink(os.readlink(source), destination)
+            else:
+                os.mknod(destination, source_stat.st_mode, source_stat.st_rdev)
+            CopyEngine.copy_metadata(source_stat, source, destination)
+            self.stats.add(0, False)
+        except OSError as e:
+            with self.stats.lock:
+                self.stats.errors.append(f"{source}: {e.strerror}")
+
+    def copy_file(self, source: str, destination: str) -> CopyStats:
+        """
+        Copies a single file, symlink or special file.
+
+        Parameters:
+        source      (str): The source path
+        destination (str): The destination path
+
+        Returns:
+        CopyStats: The statistics of this engine so far
+        """
+        self.copy_entry(source, destination, os.lstat(source))
+        return self.stats
+
+    def copy_tree(self, source: str, destination: str) -> CopyStats:
+        """
+        Recursively copies a directory. Existing directories in the destination are merged with the source.
+        Regular files are copied by a pool of workers.
+
+        Parameters:
+        source      (str): The source directory
+        destination (str): The destination directory
+
+        Returns:
+        CopyStats: The statistics of this engine so far
+        """
+        directories = []
+        hardlinks = []
+        inodes = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = []
+            pending = [(source, destination, os.lstat(source))]
+            while len(pending) > 0:
+                (source_dir, destination_dir, source_stat) = pending.pop()
+                try:
+                    if not os.path.isdir(destination_dir):
+                        os.mkdir(destination_dir, 0o700)
+                    directories.append((source_dir, destination_dir, source_stat))
+                    with os.scandir(source_dir) as entries:
+                        for entry in entries:
+                            entry_stat = entry.stat(follow_symlinks=False)
+                            destination_path = destination_dir + "/" + entry.name
+                            if stat.S_ISDIR(entry_stat.st_mode):
+                                pending.append((entry.path, destination_path, entry_stat))
+                                continue
+                            if entry_stat.st_nlink > 1 and not stat.S_ISDIR(entry_stat.st_mode):
+                                key = (entry_stat.st_dev, entry_stat.st_ino)
+                                if key in inodes:
+                                    hardlinks.append((inodes[key], destination_path))
+                                    continue
+                                inodes[key] = destination_path
+                            futures.append(executor.submit(self.copy_entry, entry.path, destination_path, entry_stat))
+                except OSError as e:
+                    self.stats.errors.append(f"{source_dir}: {e.strerror}")
+            for future in futures:
+                future.result()
+
+        for (target, link) in hardlinks:
+            try:
+                if os.path.lexists(link):
+                    os.unlink(link)
+                os.link(target, link)
+                self.stats.add(0, False)
+            except OSError as e:
+                self.stats.errors.append(f"{link}: {e.strerror}")
+
+        # Directory timestamps change while their contents are copied, so they are set last, deepest first
+        for (source_dir, destination_dir, source_stat) in reversed(directories):
+            try:
+                CopyEngine.copy_metadata(source_stat, source_dir, destination_dir)
+            except OSError as e:
+                self.stats.errors.append(f"{destination_dir}: {e.strerror}")
+        return self.stats
@@ -0,0 +1,242 @@
+# dedup.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import fcntl
+import fnmatch
+import os
+import stat
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shardimg.utils.checksum import Checksum
+from shardimg.utils.command import Command
+from shardimg.utils.copyengine import FICLONE, UNSUPPORTED
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# How many bytes from the start of a file are hashed to split up files of the same size
+PARTIAL_SIZE = 64 * 1024
+
+
+class DedupStats:
+    """
+    Statistics of a deduplication pass.
+    """
+
+    def __init__(self):
+        self.scanned = 0
+        self.groups = 0
+        self.linked = 0
+        self.bytes = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, size: int):
+        with self.lock:
+            self.linked += 1
+            self.bytes += size
+
+    def __str__(self):
+        return (f"{self.linked} of {self.scanned} files deduplicated in {self.groups} groups, "
+                f"{self.bytes / 1024 / 1024:.1f} MiB reclaimed")
+
+
+class Deduplicator:
+    """
+    Replaces byte-identical files in a build root with hardlinks or reflinks of one copy.
+
+    Candidates are grouped by size and metadata first, then by a hash of their first PARTIAL_SIZE bytes and
+    finally by a hash of their whole contents, so most files are never read completely. Hardlinks are only
+    made between files with the same mode, owner and extended attributes, as the linked files share them.
+    Reflinks keep the metadata of every file and only share the data blocks.
+    suid and sgid files are never touched.
+    """
+
+    def __init__(
+            self,
+            mode: str = "hardlink",
+            exclude: list = [],
+            min_size: int = 1,
+            workers: int = None
+    ):
+        """
+        Parameters:
+        mode     (str) : "hardlink" or "reflink". Defaults to hardlink if not specified
+        exclude  (list): Glob patterns of paths in the image that are left alone, e.g. /usr/bin/FsGuard or /etc/*
+        min_size (int) : Files smaller than this many bytes are left alone. Defaults to 1 if not specified
+        workers  (int) : How many files are hashed and linked in parallel. Defaults to the cpu count if not specified
+        """
+        if mode not in ["hardlink", "reflink"]:
+            logger.error(f"Unknown deduplication mode {mode}, must be hardlink or reflink")
+            sys.exit(1)
+        self.mode = mode
+        self.exclude = exclude
+        self.min_size = max(min_size, 1)
+        self.workers = workers or os.cpu_count() or 1
+        self.stats = DedupStats()
+        self.elevated = []
+        # All paths of every candidate inode, so that every hardlink of a duplicate is replaced
+        self.links = {}
+        self.unsupported = False
+
+    def excluded(self, path: str) -> bool:
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self.exclude)
+
+    def metadata(self, path: str, info: os.stat_result) -> tuple:
+        """
+        Returns what has to match for two files of the same contents to be linked.
+        """
+        if self.mode == "reflink":
+            return (info.st_size,)
+        try:
+            attributes = tuple(sorted((name, os.getxattr(path, name, follow_symlinks=False))
+                                      for name in os.listxattr(path, follow_symlinks=False)))
+        except OSError:
+            attributes = ()
+        return (info.st_size, stat.S_IMODE(info.st_mode), info.st_uid, info.st_gid, attributes)
+
+    def scan(self, root: str) -> dict:
+        """
+        Collects the candidate files of a root, grouped by size.
+
+        Returns:
+        dict: Size to the list of (path, lstat) of the files with that size. Hardlinks of one inode are listed once,
+              all of their paths are kept in self.links
+        """
+        sizes = {}
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            for file in filenames:
+                path = dirpath + "/" + file
+                info = os.lstat(path)
+                if not stat.S_ISREG(info.st_mode) or info.st_size < self.min_size:
+                    continue
+                if info.st_mode & (stat.S_ISUID | stat.S_ISGID):
+                    continue
+                if self.excluded(path[len(root):]):
+                    continue
+                self.stats.scanned += 1
+                inode = (info.st_dev, info.st_ino)
+                self.links.setdefault(inode, []).append(path)
+                if len(self.links[inode]) > 1:
+                    continue
+                sizes.setdefault(info.st_size, []).append((path, info))
+        return sizes
+
+    @staticmethod
+    def partial_checksum(path: str) -> str:
+        with open(path, "rb") as f:
+            return Checksum.hasher("sha256")(f.read(PARTIAL_SIZE)).hexdigest()
+
+    def refine(self, executor: ThreadPoolExecutor, groups: list, checksum) -> list:
+        """
+        Splits groups of files up by a checksum, in parallel. Groups that end up with one file are dropped.
+        """
+        files = [file for group in groups for file in group]
+        checksums = executor.map(lambda file: checksum(file[0]), files)
+        refined = {}
+        for group_index, group in enumerate(groups):
+            for file in group:
+                refined.setdefault((group_index, next(checksums)), []).append(file)
+        return [group for group in refined.values() if len(group) > 1]
+
+    def link(self, source: str, duplicate: str, info: os.stat_result):
+        """
+        Replaces a duplicate with a hardlink or reflink of the source.
+        Files the current user can't replace are linked with elevated commands later.
+        """
+        try:
+            if self.mode == "hardlink":
+                for path in self.links[(info.st_dev, info.st_ino)]:
+                    temporary = path + ".shardimg-dedup"
+                    os.link(source, temporary)
+                    os.replace(temporary, path)
+            else:
+                source_fd = os.open(source, os.O_RDONLY)
+                try:
+                    duplicate_fd = os.open(duplicate, os.O_WRONLY)
+                    try:
+                        fcntl.ioctl(duplicate_fd, FICLONE, source_fd)
+                    finally:
+                        os.close(duplicate_fd)
+                finally:
+                    os.close(source_fd)
+                os.utime(duplicate, ns=(info.st_atime_ns, info.st_mtime_ns))
+        except PermissionError:
+            with self.stats.lock:
+                self.elevated.append((source, duplicate, info))
+            return
+        except OSError as e:
+            with self.stats.lock:
+                self.stats.failed += 1
+                if self.mode == "reflink" and e.errno in UNSUPPORTED:
+                    if not self.unsupported:
+                        logger.error(f"The filesystem of {duplicate} doesn't support reflinks: {e.strerror}")
+                    self.unsupported = True
+                else:
+                    logger.error(f"Deduplicating {duplicate} failed: {e.strerror}")
+            return
+        self.stats.add(info.st_size)
+
+    async def link_elevated(self, source: str, duplicate: str, info: os.stat_result):
+        command = ["cp", "--force", "--no-dereference"]
+        command += ["--link"] if self.mode == "hardlink" else ["--reflink=always"]
+        paths = self.links[(info.st_dev, info.st_ino)] if self.mode == "hardlink" else [duplicate]
+        for path in paths:
+            out = await Command.execute_command_async(
+                command=command + [source, path],
+                command_description=f"Deduplicating {path}",
+                elevated=True,
+                crash=False
+            )
+            if out[0] != 0:
+                self.stats.failed += 1
+                return
+        self.stats.add(info.st_size)
+
+    def run(self, root: str) -> DedupStats:
+        """
+        Deduplicates the files of a root.
+
+        Parameters:
+        root (str): The build root
+
+        Returns:
+        DedupStats: How many files were linked and how many bytes were reclaimed
+        """
+        root = os.path.abspath(root)
+        sizes = self.scan(root)
+        groups = {}
+        for files in sizes.values():
+            if len(files) < 2:
+                continue
+            for (path, info) in files:
+                groups.setdefault(self.metadata(path, info), []).append((path, info))
+        groups = [group for group in groups.values() if len(group) > 1]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            groups = self.refine(executor, groups, Deduplicator.partial_checksum)
+            groups = self.refine(executor, groups, lambda path: Checksum.file_checksum(path, algorithm="sha256"))
+            self.stats.groups = len(groups)
+            # The first file of every group is kept, the others become links of it
+            list(executor.map(lambda pair: self.link(*pair),
+                              [(group[0][0], path, info) for group in groups for (path, info) in group[1:]]))
+        if len(self.elevated) > 0:
+            Command.run_async(*[self.link_elevated(source, duplicate, info)
+                                for (source, duplicate, info) in self.elevated])
+        if self.stats.failed > 0:
+            logger.warning(f"{self.stats.failed} files could not be deduplicated")
+        logger.info(str(self.stats))
+        return self.stats
@@ -0,0 +1,251 @@
+# deltas.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import base64
+import glob
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shardimg.utils.command import Command
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+
+class StaticDeltas:
+    """
+    Static deltas let clients download a single precomputed diff between two commits of a ref,
+    instead of every object that changed.
+    Deltas below the size threshold are remembered in <repo>/shardimg/small-deltas, so they aren't generated again.
+    """
+
+    lock = threading.Lock()
+
+    @staticmethod
+    def small_deltas(repo: str) -> set:
+        """
+        Returns the deltas that were deleted for being below the size threshold.
+        """
+        path = repo + "/shardimg/small-deltas"
+        if not os.path.exists(path):
+            return set()
+        with open(path, "r") as f:
+            return set(line.strip() for line in f if line.strip() != "")
+
+    @staticmethod
+    def add_small_delta(repo: str, name: str):
+        """
+        Remembers a delta that was deleted for being below the size threshold.
+        """
+        with StaticDeltas.lock:
+            os.makedirs(repo + "/shardimg", exist_ok=True)
+            with open(repo + "/shardimg/small-deltas", "a") as f:
+                f.write(name + "\n")
+
+    @staticmethod
+    def refs(repo: str, ids: list = None) -> list:
+        """
+        Returns the app refs in a repository.
+
+        Parameters:
+        repo (str) : Path to the repository
+        ids  (list): Only return the refs of these images. Returns all refs if not specified
+
+        Returns:
+        list: The refs, e.g. app/org.example.Image/x86_64/master
+        """
+        refs = []
+        for path in sorted(glob.glob(repo + "/refs/heads/app/*/*/*")):
+            ref = os.path.relpath(path, repo + "/refs/heads")
+            if ids is None or ref.split("/")[1] in ids:
+                refs.append(ref)
+        return refs
+
+    @staticmethod
+    def history(repo: str, ref: str, depth: int) -> list:
+        """
+        Returns the latest commits of a ref.
+
+        Parameters:
+        repo  (str): Path to the repository
+        ref   (str): The ref
+        depth (int): How many commits to return at most
+
+        Returns:
+        list: The commits, newest first
+        """
+        out = Command.execute_command(
+            command=["ostree", "log", "--repo=" + repo, ref],
+            command_description=f"Reading history of {ref}",
+            crash=False,
+            capture=True
+        )
+        if out[0] != 0 or not out[1]:
+            return []
+        commits = []
+        for line in out[1].decode("UTF-8").splitlines():
+            if line.startswith("commit "):
+                commits.append(line.split()[1])
+                if len(commits) >= depth:
+                    break
+        return commits
+
+    @staticmethod
+    def delta_path(repo: str, source: str, target: str) -> str:
+        """
+        Returns where ostree stores the static delta between two commits.
+
+        Parameters:
+        repo   (str): Path to the repository
+        source (str): The commit the delta starts from
+        target (str): The commit the delta leads to
+
+        Returns:
+        str: The directory of the delta
+        """
+        def encode(commit):
+            # ostree names deltas after the modified base64 of the binary checksums
+            return base64.b64encode(bytes.fromhex(commit)).decode("ascii").rstrip("=").replace("/", "_")
+        name = encode(source)
+        return f"{repo}/deltas/{name[:2]}/{name[2:]}-{encode(target)}"
+
+    @staticmethod
+    def directory_size(path: str) -> int:
+        """
+        Returns the size of all files in a directory.
+        """
+        size = 0
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for file in filenames:
+                size += os.lstat(dirpath + "/" + file).st_size
+        return size
+
+    @staticmethod
+    def generate_ref(repo: str, ref: str, depth: int, min_size: int) -> dict:
+        """
+        Generates the static deltas from the previous commits of a ref to its latest commit.
+        Deltas that already exist are kept, deltas smaller than min_size are deleted again,
+        pulling the objects directly is about as cheap for them.
+
+        Parameters:
+        repo     (str): Path to the repository
+        ref      (str): The ref
+        depth    (int): From how many previous commits deltas are generated
+        min_size (int): Deltas smaller than this many bytes are not kept
+
+        Returns:
+        dict: The number of generated, existing, skipped and failed deltas
+        """
+        result = {"generated": 0, "existing": 0, "skipped": 0, "failed": 0}
+        commits = StaticDeltas.history(repo, ref, depth + 1)
+        if len(commits) < 2:
+            return result
+        target = commits[0]
+        small = StaticDeltas.small_deltas(repo)
+        for source in commits[1:]:
+            path = StaticDeltas.delta_path(repo, source, target)
+            if source + "-" + target in small:
+                result["skipped"] += 1
+                continue
+            if os.path.exists(path):
+                result["existing"] += 1
+                continue
+            out = Command.execute_command(
+                command=[
+                    "ostree",
+                    "static-delta",
+                    "generate",
+                    "--repo=" + repo,
+                    "--from=" + source,
+                    "--to=" + target
+                ],
+                command_description=f"Generating static delta {source[:12]}-{target[:12]} for {ref}",
+                crash=False,
+                capture=True
+            )
+            if out[0] != 0:
+                result["failed"] += 1
+                continue
+            size = StaticDeltas.directory_size(path)
+            if size < min_size:
+                Command.execute_command(
+                    command=["ostree", "static-delta", "delete", "--repo=" + repo, source + "-" + target],
+                    command_description=f"Deleting small static delta {source[:12]}-{target[:12]}",
+                    crash=False,
+                    capture=True
+                )
+                StaticDeltas.add_small_delta(repo, source + "-" + target)
+                result["skipped"] += 1
+                continue
+            logger.info(f"Generated static delta {source[:12]}-{target[:12]} for {ref} ({size / 1024 / 1024:.1f} MiB)")
+            result["generated"] += 1
+        return result
+
+    @staticmethod
+    def update_summary(repo: str, force: bool = False) -> bool:
+        """
+        Regenerates the summary of a repository, if any ref or delta changed since it was last generated.
+
+        Parameters:
+        repo  (str) : Path to the repository
+        force (bool): Whether to regenerate the summary even if nothing changed. Defaults to False if not specified
+
+        Returns:
+        bool: True if the summary was regenerated
+        """
+        summary = repo + "/summary"
+        if not force and os.path.exists(summary):
+            generated = os.path.getmtime(summary)
+            changed = [path for path in glob.glob(repo + "/refs/heads/**", recursive=True) + [repo + "/deltas"]
+                       if os.path.exists(path) and os.path.getmtime(path) > generated]
+            if len(changed) == 0:
+                logger.info("Repository summary is up to date")
+                return False
+        Command.execute_command(
+            command=["flatpak", "build-update-repo", repo],
+            command_description="Updating repository summary",
+            crash=True
+        )
+        return True
+
+    @staticmethod
+    def generate(repo: str, ids: list = None, depth: int = 3, min_size: int = 0, jobs: int = None) -> dict:
+        """
+        Generates static deltas for the refs of a repository in parallel and updates the summary.
+
+        Parameters:
+        repo     (str) : Path to the repository
+        ids      (list): Only generate deltas for these images. Generates deltas for all images if not specified
+        depth    (int) : From how many previous commits of every ref deltas are generated. Defaults to 3 if not specified
+        min_size (int) : Deltas smaller than this many bytes are not kept. Defaults to 0 if not specified
+        jobs     (int) : How many refs are processed in parallel. Defaults to the cpu count if not specified
+
+        Returns:
+        dict: The result of every ref
+        """
+        refs = StaticDeltas.refs(repo, ids)
+        if len(refs) == 0:
+            logger.warning(f"No refs to generate static deltas for in {repo}")
+            return {}
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            results = dict(zip(refs, executor.map(
+                lambda ref: StaticDeltas.generate_ref(repo, ref, depth, min_size), refs
+            )))
+        for ref, result in results.items():
+            print(f"{ref}: {result['generated']} generated, {result['existing']} existing, "
+                  f"{result['skipped']} below size threshold, {result['failed']} failed")
+        StaticDeltas.update_summary(repo, force=any(result["generated"] > 0 for result in results.values()))
+        return results
@@ -0,0 +1,403 @@
+# diff.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import glob
+import heapq
+import os
+from operator import itemgetter
+import pickle
+import stat
+import tempfile
+from shardimg.utils.checksum import ALGORITHMS, Checksum
+from shardimg.utils.command import Command
+from shardimg.utils.filelist import MAGIC, BinaryFilelist
+from shardimg.utils.merkle import sort_key
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# Rough size of one sorted entry in memory, used to turn the memory budget into a number of entries per run
+ENTRY_SIZE = 400
+# Entries are written to and read back from the runs in batches of this size
+BATCH_SIZE = 1024
+
+
+class ExternalSort:
+    """
+    Sorts more entries than fit into the memory budget. Entries are collected until the budget is reached,
+    then sorted and written to a temporary run file. Iterating merges all runs, so only one batch per run
+    is in memory at a time. Entries are tuples that are sorted by their first element.
+    """
+
+    def __init__(self, directory: str, max_entries: int):
+        """
+        Parameters:
+        directory   (str): Directory the run files are written to
+        max_entries (int): How many entries are kept in memory before a run is written
+        """
+        self.directory = directory
+        self.max_entries = max(max_entries, BATCH_SIZE)
+        self.entries = []
+        self.runs = []
+
+    def add(self, entry: tuple):
+        self.entries.append(entry)
+        if len(self.entries) >= self.max_entries:
+            self.spill()
+
+    def spill(self):
+        """
+        Writes the collected entries to a new run.
+        """
+        self.entries.sort(key=itemgetter(0))
+        (fd, path) = tempfile.mkstemp(prefix="run-", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            for start in range(0, len(self.entries), BATCH_SIZE):
+                pickle.dump(self.entries[start:start + BATCH_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runs.append(path)
+        self.entries = []
+
+    def finish(self):
+        """
+        Writes the entries still in memory to a run, so that the next sorter gets the whole memory budget.
+        """
+        if len(self.entries) > 0:
+            self.spill()
+
+    @staticmethod
+    def read_run(path: str):
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                yield from batch
+
+    def __iter__(self):
+        if len(self.runs) == 0:
+            self.entries.sort(key=itemgetter(0))
+            return iter(self.entries)
+        if len(self.entries) > 0:
+            self.spill()
+        return heapq.merge(*[ExternalSort.read_run(path) for path in self.runs], key=itemgetter(0))
+
+    @staticmethod
+    def unique(entries):
+        """
+        Skips entries whose key is the same as the one of the previous entry.
+        """
+        previous = None
+        for entry in entries:
+            if previous is None or entry[0] != previous:
+                previous = entry[0]
+                yield entry
+
+
+class DiffSource:
+    """
+    One side of a diff: a build root, an FsGuard file list or a commit in a repository.
+    Produces (key, path, kind, size, digest, suid, mtime) entries, kind is f for files, l for symlinks
+    and o for everything else. size, digest and mtime are None if the source doesn't know them.
+    """
+
+    def __init__(self, location: str, repo: str = None):
+        """
+        Parameters:
+        location (str): Path to a build root or file list, or a ref or commit if repo is set
+        repo     (str): Repository the ref or commit is in (optional)
+        """
+        self.location = location
+        self.repo = repo
+        self.algorithm = None
+        if repo is not None:
+            self.type = "commit"
+            self.algorithm = "ostree"
+        elif os.path.isdir(location):
+            self.type = "root"
+        else:
+            self.type = "filelist"
+            with open(location, "rb") as f:
+                self.binary = f.read(len(MAGIC)) == MAGIC
+            if self.binary:
+                with BinaryFilelist(location) as filelist:
+                    self.algorithm = filelist.algorithm
+            else:
+                self.algorithm = "sha1"
+                with open(location, "r", encoding="UTF-8", errors="surrogateescape") as f:
+                    first = f.readline()
+                if first.startswith("# hash "):
+                    self.algorithm = first.split()[2]
+
+    def collect(self, sorter: ExternalSort):
+        """
+        Adds all entries of the source to a sorter.
+        """
+        if self.type == "root":
+            root = os.path.abspath(self.location)
+            for (dirpath, dirnames, filenames) in os.walk(root):
+                for file in filenames:
+                    full = dirpath + "/" + file
+                    path = full[len(root):]
+                    info = os.lstat(full)
+                    kind = "f" if stat.S_ISREG(info.st_mode) else "l" if stat.S_ISLNK(info.st_mode) else "o"
+                    digest = "-> " + os.readlink(full) if kind == "l" else None
+                    sorter.add((sort_key(path), path, kind, info.st_size, digest,
+                                bool(info.st_mode & stat.S_ISUID), info.st_mtime_ns))
+        elif self.type == "filelist" and self.binary:
+            with BinaryFilelist(self.location) as filelist:
+                for (path, digest, suid) in filelist.entries():
+                    sorter.add((sort_key(path), path, "f", None, digest, suid, None))
+        elif self.type == "filelist":
+            with open(self.location, "r", encoding="UTF-8", errors="surrogateescape") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.strip() == "" or line.startswith("#"):
+                        continue
+                    (path, digest, suid) = line.rsplit(" ", 2)
+                    sorter.add((sort_key(path), path, "f", None, digest, suid == "true", None))
+        else:
+            Command.execute_command(
+                command=["ostree", "ls", "--repo=" + self.repo, "-R", "-C", self.location, "/"],
+                command_description=f"Listing {self.location}",
+                crash=True,
+                stream=True,
+                callback=lambda line: DiffSource.add_ostree_line(sorter, line),
+                progress=None
+            )
+
+    @staticmethod
+    def add_ostree_line(sorter: ExternalSort, line: str):
+        """
+        Parses a line of ostree ls -R -C, e.g. "-00644 0 0 1024 <checksum> /usr/bin/foo".
+        Directories carry a second checksum for their metadata and are skipped.
+        """
+        if len(line) < 2 or line[0] not in "-dl" or not line[1:2].isdigit():
+            return
+        if line[0] == "d":
+            return
+        fields = line.split(None, 5)
+        if len(fields) < 6:
+            return
+        (mode, uid, gid, size, digest, path) = fields
+        kind = "f" if mode[0] == "-" else "l"
+        if kind == "l" and " -> " in path:
+            (path, target) = path.split(" -> ", 1)
+            digest = "-> " + target
+        sorter.add((sort_key(path), path, kind, int(size), digest, bool(int(mode[1:], 8) & stat.S_ISUID), None))
+
+    def full_path(self, path: str) -> str:
+        return os.path.abspath(self.location) + path if self.type == "root" else None
+
+    def packages(self, sorter: ExternalSort) -> bool:
+        """
+        Adds the (key, path, package) entries of the pacman database of a build root to a sorter.
+
+        Returns:
+        bool: False if the source has no pacman database
+        """
+        if self.type != "root":
+            return False
+        databases = glob.glob(os.path.abspath(self.location) + "/var/lib/pacman/local/*/files")
+        for files in databases:
+            package = os.path.basename(os.path.dirname(files)).rsplit("-", 2)[0]
+            with open(files, "r", encoding="UTF-8", errors="surrogateescape") as f:
+                listed = False
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.startswith("%"):
+                        listed = line == "%FILES%"
+                        continue
+                    if listed and line != "" and not line.endswith("/"):
+                        sorter.add((sort_key("/" + line), "/" + line, package))
+        return len(databases) > 0
+
+
+class OwnerCursor:
+    """
+    Looks up the package of paths in a sorted owner stream. The paths have to be looked up in sorted order.
+    """
+
+    def __init__(self, entries):
+        self.entries = iter(entries) if entries is not None else iter(())
+        self.current = next(self.entries, None)
+
+    def owner(self, key: str) -> str:
+        while self.current is not None and self.current[0] < key:
+            self.current = next(self.entries, None)
+        if self.current is not None and self.current[0] == key:
+            return self.current[2]
+        return None
+
+
+class ImageDiff:
+
+    @staticmethod
+    def same_content(old_source: DiffSource, old: tuple, new_source: DiffSource, new: tuple) -> bool:
+        """
+        Returns whether two entries of the same path have the same content.
+        Files of build roots are only hashed if their size matches and their mtime doesn't.
+        """
+        (old_kind, old_size, old_digest, old_mtime) = (old[2], old[3], old[4], old[6])
+        (new_kind, new_size, new_digest, new_mtime) = (new[2], new[3], new[4], new[6])
+        if old_kind != new_kind:
+            return False
+        if old_size is not None and new_size is not None and old_size != new_size:
+            return False
+        if old_digest is not None and new_digest is not None and old_source.algorithm == new_source.algorithm:
+            return old_digest == new_digest
+        if old_source.type != "root" and new_source.type != "root":
+            # Digests of different algorithms can't be compared, and neither side can be hashed again
+            return old_size == new_size
+        if old_kind != "f":
+            return old_digest == new_digest
+        if old_mtime is not None and old_mtime == new_mtime:
+            return True
+        # A build root can be hashed with the algorithm of the other side
+        algorithm = new_source.algorithm if old_source.type == "root" else old_source.algorithm
+        if algorithm is None:
+            algorithm = "sha1"
+        if algorithm not in ALGORITHMS:
+            return old_size == new_size
+        if old_digest is None:
+            old_digest = Checksum.file_checksum(old_source.full_path(old[1]), algorithm=algorithm)
+        if new_digest is None:
+            new_digest = Checksum.file_checksum(new_source.full_path(new[1]), algorithm=algorithm)
+        return old_digest == new_digest
+
+    @staticmethod
+    def directory(path: str, depth: int) -> str:
+        """
+        Returns the directory a path is accounted to, at most depth levels below /.
+        """
+        return "/" + "/".join(path.split("/")[1:-1][:depth])
+
+    @staticmethod
+    def diff(
+            old_source: DiffSource,
+            new_source: DiffSource,
+            memory: int = 512 * 1024 * 1024,
+            depth: int = 2,
+            by_package: bool = False,
+            tmpdir: str = None,
+            callback = None
+    ) -> dict:
+        """
+        Compares two sources. Both are sorted externally, then their sorted entries are merged,
+        so memory use depends on the memory budget and not on the number of files.
+
+        Parameters:
+        old_source (DiffSource): The old image
+        new_source (DiffSource): The new image
+        memory     (int)       : Memory budget in bytes for sorting the entries. Defaults to 512MiB if not specified
+        depth      (int)       : Size changes are summed up per directory up to this many levels below /. Defaults to 2 if not specified
+        by_package (bool)      : Whether size changes are also summed up per pacman package, for build roots only.
+                                 Defaults to False if not specified
+        tmpdir     (str)       : Where the sorted runs are written to. Uses the default temporary directory if not specified
+        callback   (func)      : Called with the status (added, removed, changed or suid), path and size change of every difference (optional)
+
+        Returns:
+        dict: The number of added, removed, changed and suid changed files, the total size change
+              and the size changes per directory and per package
+        """
+        result = {"added": 0, "removed": 0, "changed": 0, "suid": 0, "size": 0, "directories": {}, "packages": {}}
+        max_entries = memory // ENTRY_SIZE
+        if old_source.type != "root" and new_source.type != "root" and old_source.algorithm != new_source.algorithm:
+            logger.warning(f"{old_source.location} uses {old_source.algorithm} and {new_source.location} {new_source.algorithm}, "
+                           "changed files are only detected by their size")
+        with tempfile.TemporaryDirectory(prefix="shardimg-diff-", dir=tmpdir) as directory:
+            sorted_entries = []
+            # Every sorter is spilled once it is filled, so only one of them holds entries in memory at a time
+            for source in [old_source, new_source]:
+                sorter = ExternalSort(directory, max_entries)
+                source.collect(sorter)
+                sorter.finish()
+                sorted_entries.append(sorter)
+            owners = [None, None]
+            if by_package:
+                for index, source in enumerate([old_source, new_source]):
+                    sorter = ExternalSort(directory, max_entries)
+                    if source.packages(sorter):
+                        sorter.finish()
+                        owners[index] = sorter
+                    else:
+                        logger.warning(f"{source.location} has no pacman database, its files are not accounted to packages")
+            old_owners = OwnerCursor(owners[0])
+            new_owners = OwnerCursor(owners[1])
+
+            def record(status: str, path: str, size: int, key: str):
+                if status != "suid":
+                    result[status] += 1
+                    result["size"] += size
+                    directory = ImageDiff.directory(path, depth)
+                    result["directories"][directory] = result["directories"].get(directory, 0) + size
+                    if by_package:
+                        package = (old_owners if status == "removed" else new_owners).owner(key) or "(unowned)"
+                        result["packages"][package] = result["packages"].get(package, 0) + size
+                else:
+                    result["suid"] += 1
+                if callback is not None:
+                    callback(status, path, size)
+
+            # File lists repeat the targets of symlinks
+            old_entries = ExternalSort.unique(sorted_entries[0])
+            new_entries = ExternalSort.unique(sorted_entries[1])
+            old = next(old_entries, None)
+            new = next(new_entries, None)
+            while old is not None or new is not None:
+                if new is None or (old is not None and old[0] < new[0]):
+                    record("removed", old[1], -(old[3] or 0), old[0])
+                    old = next(old_entries, None)
+                elif old is None or new[0] < old[0]:
+                    record("added", new[1], new[3] or 0, new[0])
+                    new = next(new_entries, None)
+                else:
+                    if not ImageDiff.same_content(old_source, old, new_source, new):
+                        record("changed", new[1], (new[3] or 0) - (old[3] or 0), new[0])
+                    if old[5] != new[5]:
+                        record("suid", new[1], 0, new[0])
+                    old = next(old_entries, None)
+                    new = next(new_entries, None)
+        return result
+
+    @staticmethod
+    def format_size(size: int) -> str:
+        sign = "+" if size >= 0 else "-"
+        size = abs(size)
+        for unit in ["B", "KiB", "MiB", "GiB"]:
+            if size < 1024 or unit == "GiB":
+                return f"{sign}{size:.1f} {unit}" if unit != "B" else f"{sign}{size} B"
+            size /= 1024
+
+    @staticmethod
+    def report(result: dict, top: int = 20):
+        """
+        Prints the summary of a diff.
+
+        Parameters:
+        result (dict): The result of ImageDiff.diff
+        top    (int) : How many directories and packages with the largest size changes are shown. Defaults to 20 if not specified
+        """
+        print(f"{result['added']} added, {result['removed']} removed, {result['changed']} changed, "
+              f"{result['suid']} suid changes, {ImageDiff.format_size(result['size'])} in total")
+        for (title, sizes) in [("Directories", result["directories"]), ("Packages", result["packages"])]:
+            largest = heapq.nlargest(top, sizes.items(), key=lambda item: abs(item[1]))
+            largest = [(name, size) for (name, size) in largest if size != 0]
+            if len(largest) == 0:
+                continue
+            print(title + ":")
+            for (name, size) in largest:
+                print(f"  {ImageDiff.format_size(size):>14}  {name}")
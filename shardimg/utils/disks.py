@@ -16,10 +16,23 @@
 #
 # SPDX-License-Identifier: GPL-3.0
 
+import os
+import subprocess
+import sys
 from shardimg.utils.command import Command
+from shardimg.utils.trace import Trace
 from shardimg.utils.log import setup_logging
 logger=setup_logging()
 
+# Mounts proc, sys and dev below $1 and keeps the mount namespace alive until stdin is closed
+SANDBOX_SCRIPT = (
+    'mount -t proc proc "$1/proc" && '
+    'mount -t sysfs sys "$1/sys" && '
+    'mount --bind /dev "$1/dev" && '
+    'echo $$ && '
+    'exec cat > /dev/null'
+)
+
 class DiskUtils:
     @staticmethod
     def unmount(
@@ -33,6 +46,18 @@ class DiskUtils:
         """
         Command.execute_command(command=["umount", mountpoint], command_description="Unmount "+mountpoint, crash=True, elevated=True)
 
+    @staticmethod
+    async def unmount_async(
+        mountpoint: str,
+    ):
+        """
+        Unmounts a mountpoint without blocking the event loop.
+
+        Parameters:
+        mountpoint (str): The mountpoint to unmount
+        """
+        await Command.execute_command_async(command=["umount", mountpoint], command_description="Unmount "+mountpoint, crash=True, elevated=True)
+
     @staticmethod
     def bind_mount(
         source: str,
@@ -63,6 +88,59 @@ class DiskUtils:
         options    (list): Options to add to the mount command (optional)
         fs         (str) : The device type, equivalent to the -t flag in mount (optional)
         """
+        command = DiskUtils.mount_command(source, mountpoint, options, fs)
+        print(command)
+        Command.execute_command(
+            command=command,
+            command_description="Mount "+source+" to "+mountpoint+" with options "+" ".join(options),
+            crash=True,
+            elevated=True
+        )
+
+    @staticmethod
+    async def mount_async(
+        source: str,
+        mountpoint: str,
+        options: list = [],
+        fs: str = None
+    ):
+        """
+        Mounts a device to a given mountpoint without blocking the event loop.
+
+        Parameters:
+        source     (str) : Path to the device to mount
+        mountpoint (str) : Mountpoint for the device
+        options    (list): Options to add to the mount command (optional)
+        fs         (str) : The device type, equivalent to the -t flag in mount (optional)
+        """
+        command = DiskUtils.mount_command(source, mountpoint, options, fs)
+        print(command)
+        await Command.execute_command_async(
+            command=command,
+            command_description="Mount "+source+" to "+mountpoint+" with options "+" ".join(options),
+            crash=True,
+            elevated=True
+        )
+
+    @staticmethod
+    def mount_command(
+        source: str,
+        mountpoint: str,
+        options: list = [],
+        fs: str = None
+    ) -> list:
+        """
+        Builds the mount command for a device.
+
+        Parameters:
+        source     (str) : Path to the device to mount
+        mountpoint (str) : Mountpoint for the device
+        options    (list): Options to add to the mount command (optional)
+        fs         (str) : The device type, equivalent to the -t flag in mount (optional)
+
+        Returns:
+        list: The mount command
+        """
         command = ["mount"]
         if fs is not None:
             command.extend(["-t", fs])
@@ -71,12 +149,34 @@ class DiskUtils:
             command.extend(["-o", ",".join(options)])
 
         command.extend([source, mountpoint])
-        print(command)
-        Command.execute_command(
-            command=command,
-            command_description="Mount "+source+" to "+mountpoint+" with options "+" ".join(options),
-            crash=True,
-            elevated=True
+        return command
+
+    @staticmethod
+    def mount_api_filesystems(root: str):
+        """
+        Mounts proc, sys and dev into a root. The three mounts run concurrently.
+
+        Parameters:
+        root (str): Path to the root
+        """
+        Command.run_async(
+            DiskUtils.mount_async(source="/proc", mountpoint=root + "/proc", fs="proc"),
+            DiskUtils.mount_async(source="/sys", mountpoint=root + "/sys", fs="sysfs"),
+            DiskUtils.mount_async(source="/dev", mountpoint=root + "/dev", options=["bind"])
+        )
+
+    @staticmethod
+    def unmount_api_filesystems(root: str):
+        """
+        Unmounts proc, sys and dev from a root. The three unmounts run concurrently.
+
+        Parameters:
+        root (str): Path to the root
+        """
+        Command.run_async(
+            DiskUtils.unmount_async(mountpoint=root + "/proc"),
+            DiskUtils.unmount_async(mountpoint=root + "/sys"),
+            DiskUtils.unmount_async(mountpoint=root + "/dev")
         )
 
     @staticmethod
@@ -102,3 +202,81 @@ class DiskUtils:
             command.extend(["-o",",".join(options)])
         command.extend(["-o", "lowerdir="+":".join(lowerdirs)+",upperdir="+upperdir+",workdir="+workdir, destination])
         Command.execute_command(command=command, command_description="Mount overlay at "+destination, crash=True, elevated=True)
+
+
+class BuildSandbox:
+    """
+    Provides proc, sys and dev inside a build root for as long as the with block runs.
+
+    The mounts are created in a private mount namespace by a single privileged process, so they are never
+    visible on the host and disappear together with the namespace, no matter how the build ends.
+    Commands have to enter the namespace to see them, BuildSandbox.wrap does that for commands run in the root.
+    If the sandbox is disabled, proc, sys and dev are mounted on the host instead and unmounted when the block ends.
+    """
+
+    # Process holding the mount namespace of every active sandbox, by absolute path of the root
+    active = {}
+
+    def __init__(self, root: str, enabled: bool = True):
+        """
+        Parameters:
+        root    (str) : Path to the build root
+        enabled (bool): Whether to use a private mount namespace. Defaults to True if not specified
+        """
+        self.root = os.path.abspath(root)
+        self.enabled = enabled
+        self.process = None
+
+    def __enter__(self):
+        logger.info(f"Mount proc, sys and dev in {self.root}")
+        with Trace.span("Mount proc, sys and dev"):
+            if not self.enabled:
+                DiskUtils.mount_api_filesystems(self.root)
+                return self
+            command = ["sudo", "unshare", "--mount", "--propagation", "private", "sh", "-c", SANDBOX_SCRIPT,
+                       "sh", self.root]
+            if os.environ.get("DEBUG"):
+                logger.debug("Command: " + " ".join(command))
+                if os.environ.get("SHARDS_FAKE"):
+                    return self
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            pid = self.process.stdout.readline().decode("UTF-8").strip()
+            if not pid.isdigit():
+                self.process.stdin.close()
+                returncode = self.process.wait()
+                logger.error(f"Creating build sandbox for {self.root} failed with returncode {returncode}")
+                sys.exit(returncode or 1)
+            BuildSandbox.active[self.root] = int(pid)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        logger.info(f"Unmounting proc, sys and dev from {self.root}")
+        with Trace.span("Unmount proc, sys and dev"):
+            if not self.enabled:
+                DiskUtils.unmount_api_filesystems(self.root)
+                return False
+            BuildSandbox.active.pop(self.root, None)
+            if self.process is not None:
+                # The holder exits once stdin is closed, which destroys the namespace and its mounts
+                self.process.stdin.close()
+                self.process.stdout.close()
+                self.process.wait()
+                self.process = None
+        return False
+
+    @staticmethod
+    def wrap(root: str, command: list) -> list:
+        """
+        Makes a command run in the mount namespace of the sandbox of a root, if one is active.
+
+        Parameters:
+        root    (str) : Path to the build root
+        command (list): The command to run, it has to be run elevated
+
+        Returns:
+        list: The command, prefixed with nsenter if a sandbox is active
+        """
+        pid = BuildSandbox.active.get(os.path.abspath(root))
+        if pid is None:
+            return command
+        return ["nsenter", "--target", str(pid), "--mount"] + command
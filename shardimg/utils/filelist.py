@@ -0,0 +1,218 @@
+# filelist.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import mmap
+import struct
+
+MAGIC = b"FSGL"
+VERSION = 1
+# Every RESTART_INTERVAL records the full path is stored, the index points at these records
+RESTART_INTERVAL = 16
+# magic, version, digest size, algorithm name length, record count, restart interval,
+# offsets of the records, digests, suid bitset and index
+HEADER = struct.Struct("<4sHBBIIQQQQ")
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_varint(data, offset: int) -> (int, int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value, offset)
+        shift += 7
+
+
+class BinaryFilelist:
+    """
+    Compact FsGuard file list, looked up in O(log n) through mmap without parsing the whole file.
+
+    Layout, all integers little endian:
+    header    : magic "FSGL", version, digest size, algorithm name length, record count, restart interval,
+                offsets of the records, digests, suid bitset and index, followed by the algorithm name
+    records   : paths sorted bytewise, each as varint shared prefix length with the previous path,
+                varint suffix length and the suffix. Every restart interval records the shared length is 0
+    digests   : one binary digest of digest size bytes per record
+    suid      : one bit per record, least significant bit first
+    index     : u32 offset of every restart record, relative to the records
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens a binary file list for lookups.
+
+        Parameters:
+        path (str): Path to the file list
+        """
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.digest_size, name_length, self.count, self.restart_interval,
+         self.records_offset, self.digests_offset, self.suid_offset, self.index_offset) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} FsGuard file list")
+        self.algorithm = self.data[HEADER.size:HEADER.size + name_length].decode("ascii")
+        self.restarts = (self.count + self.restart_interval - 1) // self.restart_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    @staticmethod
+    def write(path: str, entries: list, algorithm: str = "sha1"):
+        """
+        Writes a binary file list.
+
+        Parameters:
+        path      (str) : Where to write the file list
+        entries   (list): (path, hex digest, suid) tuples. Repeated paths are only written once
+        algorithm (str) : Name of the hash algorithm the digests were calculated with. Defaults to sha1 if not specified
+        """
+        unique = {}
+        for (file, digest, suid) in entries:
+            unique.setdefault(file.encode("UTF-8", errors="surrogateescape"), (bytes.fromhex(digest), suid))
+        files = sorted(unique)
+        digest_size = len(unique[files[0]][0]) if len(files) > 0 else 0
+        name = algorithm.encode("ascii")
+
+        records = bytearray()
+        index = bytearray()
+        previous = b""
+        for position, file in enumerate(files):
+            shared = 0
+            if position % RESTART_INTERVAL == 0:
+                index += struct.pack("<I", len(records))
+            else:
+                limit = min(len(previous), len(file))
+                while shared < limit and previous[shared] == file[shared]:
+                    shared += 1
+            records += encode_varint(shared) + encode_varint(len(file) - shared) + file[shared:]
+            previous = file
+
+        digests = b"".join(unique[file][0] for file in files)
+        suid = bytearray((len(files) + 7) // 8)
+        for position, file in enumerate(files):
+            if unique[file][1]:
+                suid[position // 8] |= 1 << (position % 8)
+
+        records_offset = HEADER.size + len(name)
+        digests_offset = records_offset + len(records)
+        suid_offset = digests_offset + len(digests)
+        index_offset = suid_offset + len(suid)
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, digest_size, len(name), len(files), RESTART_INTERVAL,
+                                records_offset, digests_offset, suid_offset, index_offset))
+            f.write(name)
+            f.write(records)
+            f.write(digests)
+            f.write(suid)
+            f.write(index)
+
+    def restart_offset(self, restart: int) -> int:
+        return self.records_offset + struct.unpack_from("<I", self.data, self.index_offset + restart * 4)[0]
+
+    def read_record(self, offset: int, previous: bytes) -> (bytes, int):
+        """
+        Reads the record at an offset.
+
+        Returns:
+        (bytes, int): The path and the offset of the next record
+        """
+        (shared, offset) = decode_varint(self.data, offset)
+        (length, offset) = decode_varint(self.data, offset)
+        return (previous[:shared] + self.data[offset:offset + length], offset + length)
+
+    def entry(self, position: int) -> (str, bool):
+        """
+        Returns the digest and suid bit of the record at a position.
+        """
+        start = self.digests_offset + position * self.digest_size
+        digest = self.data[start:start + self.digest_size].hex()
+        suid = bool(self.data[self.suid_offset + position // 8] & (1 << (position % 8)))
+        return (digest, suid)
+
+    def lookup(self, path: str) -> (str, bool):
+        """
+        Looks up a file. Binary searches the restart records, then scans at most one restart interval.
+
+        Parameters:
+        path (str): Path of the file in the image, e.g. /usr/bin/bash
+
+        Returns:
+        (str, bool): The hex digest and whether the file is suid. None if the file is not in the list
+        """
+        key = path.encode("UTF-8", errors="surrogateescape")
+        low = 0
+        high = self.restarts
+        # Finds the last restart record that is not greater than the path
+        while low < high:
+            middle = (low + high) // 2
+            file = self.read_record(self.restart_offset(middle), b"")[0]
+            if file <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        restart = low - 1
+        offset = self.restart_offset(restart)
+        file = b""
+        for position in range(restart * self.restart_interval, min((restart + 1) * self.restart_interval, self.count)):
+            (file, offset) = self.read_record(offset, file)
+            if file == key:
+                return self.entry(position)
+            if file > key:
+                return None
+        return None
+
+    def entries(self):
+        """
+        Iterates over all files in the list, in sorted order.
+
+        Yields:
+        (str, str, bool): The path, hex digest and suid bit of every file
+        """
+        offset = self.records_offset
+        file = b""
+        for position in range(self.count):
+            (file, offset) = self.read_record(offset, file)
+            (digest, suid) = self.entry(position)
+            yield (file.decode("UTF-8", errors="surrogateescape"), digest, suid)
@@ -17,7 +17,10 @@
 # SPDX-License-Identifier: GPL-3.0-only
 import sys
 
+import fcntl
+from contextlib import contextmanager
 from shardimg.utils.command import Command
+from shardimg.utils.copyengine import CopyEngine, CopyStats
 from os.path import exists
 import os
 import shutil
@@ -191,49 +194,82 @@ class FileUtils:
         crash: bool = False,
     ):
         """
-        Copies a file.
+        Copies a file. Reflinks the file if the filesystem supports it.
 
         Parameters:
         source      (str) : The file source
-        destination (str) : Where the file should be copied to
+        destination (str) : Where the file should be copied to. If it is a directory, the file is copied into it
         crash       (bool): Whether the program should crash if the copying failed
         """
         logger.info(f"Copying file {source} to {destination}")
-        Command.execute_command(
-            command=[
-                "cp",
-                source,
-                destination,
-            ],
-            command_description="Copying file "+source+" to "+destination,
-            crash=crash,
-        )
+        if os.environ.get("DEBUG"):
+            logger.debug(f"Copying file {source} to {destination}")
+            if os.environ.get("SHARDS_FAKE"):
+                return
+        if os.path.isdir(destination):
+            destination = destination + "/" + os.path.basename(source)
+        engine = CopyEngine()
+        try:
+            engine.copy_file(source, destination)
+        except OSError as e:
+            engine.stats.errors.append(f"{source}: {e.strerror}")
+        FileUtils.check_copy(engine.stats, "Copying file "+source+" to "+destination, crash)
 
     @staticmethod
     def copy_directory(
         source: str,
         destination: str,
         crash: bool = False,
+        workers: int = None,
     ):
         """
-        Copies a directory.
+        Copies a directory. Files are reflinked if the filesystem supports it and copied in parallel.
 
         Parameters:
         source      (str) : The file source
-        destination (str) : Where the file should be copied to
+        destination (str) : Where the file should be copied to. If it is an existing directory, the source is copied into it
         crash       (bool): Whether the program should crash if the copying failed
+        workers     (int) : How many files are copied in parallel. Defaults to the cpu count if not specified
         """
         logger.info(f"Copying directory {source} to {destination}")
-        Command.execute_command(
-            command=[
-                "cp",
-                "-r",
-                source,
-                destination
-            ],
-            command_description="Copying directory "+source+" to "+destination,
-            crash=crash
-        )
+        if os.environ.get("DEBUG"):
+            logger.debug(f"Copying directory {source} to {destination}")
+            if os.environ.get("SHARDS_FAKE"):
+                return
+        if os.path.isdir(destination):
+            destination = destination + "/" + os.path.basename(os.path.normpath(source))
+        engine = CopyEngine(workers=workers)
+        try:
+            if os.path.isdir(source) and not os.path.islink(source):
+                engine.copy_tree(source, destination)
+            else:
+                engine.copy_file(source, destination)
+        except OSError as e:
+            engine.stats.errors.append(f"{source}: {e.strerror}")
+        FileUtils.check_copy(engine.stats, "Copying directory "+source+" to "+destination, crash)
+
+    @staticmethod
+    def check_copy(
+        stats: CopyStats,
+        description: str,
+        crash: bool,
+    ):
+        """
+        Reports the result of a copy operation.
+
+        Parameters:
+        stats       (CopyStats): The statistics of the copy
+        description (str)      : A description of what was copied
+        crash       (bool)     : Whether the program should crash if the copying failed
+        """
+        for error in stats.errors:
+            logger.error(error)
+        if len(stats.errors) > 0:
+            logger.error(description+" failed")
+            if crash:
+                sys.exit(1)
+            return
+        logger.info(f"Copied {stats}")
 
     @staticmethod
     def is_suid(path: str) -> bool:
@@ -263,3 +299,22 @@ class FileUtils:
             return os.readlink(path)
         else:
             return None
+
+    @staticmethod
+    @contextmanager
+    def lock(directory: str, shared: bool = False):
+        """
+        Holds a lock on a directory shared between builds running in parallel, e.g. a cache.
+        The lock is released when the with block ends, or when the process exits.
+
+        Parameters:
+        directory (str) : The directory to lock, a .lock file is created in it
+        shared    (bool): Whether other shared holders are allowed at the same time. Defaults to False if not specified
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(directory + "/.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,213 @@
+# fingerprint.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import hashlib
+import json
+import os
+import stat
+from shardimg.utils.checksum import Checksum
+from shardimg.utils.command import Command
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# Branch builds are exported to, flatpak-builder and flatpak build-export default to it
+BRANCH = "master"
+
+
+class Fingerprint:
+    """
+    Fingerprints of the inputs of a build, used to detect rebuilds that wouldn't change anything.
+    The fingerprint of the last build of every image is stored in <repo>/shardimg/fingerprints,
+    together with the commit its ref pointed to afterwards.
+    """
+
+    @staticmethod
+    def directory(path: str) -> str:
+        """
+        Calculates a fingerprint over the names, types, permissions and contents of everything in a directory.
+
+        Parameters:
+        path (str): The directory to fingerprint
+
+        Returns:
+        str: The fingerprint. Empty if the directory does not exist
+        """
+        if not os.path.isdir(path):
+            return ""
+        entries = []
+        files = []
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, path)
+            entries.append(["d", relative, stat.S_IMODE(os.lstat(dirpath).st_mode)])
+            for file in sorted(filenames):
+                filepath = dirpath + "/" + file
+                file_stat = os.lstat(filepath)
+                if stat.S_ISLNK(file_stat.st_mode):
+                    entries.append(["l", relative + "/" + file, os.readlink(filepath)])
+                elif stat.S_ISREG(file_stat.st_mode):
+                    entries.append(["f", relative + "/" + file, stat.S_IMODE(file_stat.st_mode)])
+                    files.append(filepath)
+        # The checksums are appended in the same order the files were added in
+        checksums = iter(Checksum.checksum_files(files))
+        for entry in entries:
+            if entry[0] == "f":
+                entry.append(next(checksums))
+        return hashlib.sha256(json.dumps(entries).encode("UTF-8")).hexdigest()
+
+    @staticmethod
+    def base_commit(base: str, user: bool = False) -> str:
+        """
+        Returns the commit the base image is installed at, without installing or updating it.
+
+        Parameters:
+        base (str) : ID of the base image, empty if the image has no base
+        user (bool): Whether the base image is installed for the current user instead of system wide,
+                     as builds with --overlay do
+
+        Returns:
+        str: The commit. Empty if there is no base, None if the commit can't be looked up, e.g. because
+             the base is not installed yet
+        """
+        if base.strip() == "":
+            return ""
+        # The base isn't installed before the first build of an image, that is a cache miss and not an error
+        out = Command.execute_command(
+            command=["flatpak", "info"] + (["--user"] if user else []) + ["--show-commit", base],
+            command_description=f"Getting installed commit of {base}",
+            capture=True,
+            quiet=True
+        )
+        if out[0] != 0 or out[1] is None:
+            return None
+        return out[1].decode("UTF-8").strip()
+
+    @staticmethod
+    def build(manifest, include_dir: str, modules_dir: str, lockfile: str = None, user: bool = False) -> str:
+        """
+        Calculates the fingerprint of a build from the parsed manifest, the include and modules directories
+        and the commit of the base image.
+
+        Parameters:
+        manifest    (Manifest | BootManifest): The parsed manifest
+        include_dir (str)                    : The include directory next to the manifest
+        modules_dir (str)                    : The modules directory next to the manifest
+        lockfile    (str)                    : The lockfile the packages are installed from (optional)
+        user        (bool)                   : Whether the base image is installed for the current user instead of system wide
+
+        Returns:
+        str: The fingerprint. None if the commit of the base image is unknown, the build counts as changed then
+        """
+        base = Fingerprint.base_commit(getattr(manifest, "base", ""), user=user)
+        if base is None:
+            return None
+        inputs = {
+            "manifest": manifest.fingerprint(),
+            "include": Fingerprint.directory(include_dir),
+            "modules": Fingerprint.directory(modules_dir),
+            "base": base,
+        }
+        if lockfile is not None:
+            with open(lockfile, "rb") as f:
+                inputs["lockfile"] = hashlib.sha256(f.read()).hexdigest()
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("UTF-8")).hexdigest()
+
+    @staticmethod
+    def ref(id: str) -> str:
+        """
+        Returns the ref a build of an image is exported to: the default flatpak architecture
+        and the default branch, as neither flatpak-builder nor the direct export set them.
+
+        Parameters:
+        id (str): ID of the image
+
+        Returns:
+        str: The ref, e.g. app/<id>/x86_64/master
+        """
+        arch = Command.execute_command(
+            command=["flatpak", "--default-arch"],
+            command_description="Getting the default flatpak architecture",
+            capture=True
+        )
+        arch = arch[1].decode("UTF-8").strip() if arch[0] == 0 and arch[1] else "x86_64"
+        return "app/" + id + "/" + arch + "/" + BRANCH
+
+    @staticmethod
+    def ref_commit(repo: str, id: str) -> str:
+        """
+        Returns the commit the app ref a build of an image is exported to points to in a repository.
+
+        Parameters:
+        repo (str): Path to the repository
+        id   (str): ID of the image
+
+        Returns:
+        str: The commit. None if the repository has no such ref
+        """
+        path = repo + "/refs/heads/" + Fingerprint.ref(id)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            return f.read().strip()
+
+    @staticmethod
+    def path(repo: str, id: str) -> str:
+        """
+        Returns where the fingerprint of an image is stored.
+        """
+        return repo + "/shardimg/fingerprints/" + id + ".json"
+
+    @staticmethod
+    def is_current(repo: str, id: str, fingerprint: str) -> bool:
+        """
+        Checks if the last build of an image had the same fingerprint and is still what the repository contains.
+
+        Parameters:
+        repo        (str): Path to the repository
+        id          (str): ID of the image
+        fingerprint (str): Fingerprint of the current build
+
+        Returns:
+        bool: True if rebuilding the image would not change anything
+        """
+        path = Fingerprint.path(repo, id)
+        if fingerprint is None or not os.path.exists(path):
+            return False
+        with open(path, "r") as f:
+            stored = json.load(f)
+        commit = Fingerprint.ref_commit(repo, id)
+        return stored.get("fingerprint") == fingerprint and commit is not None and stored.get("commit") == commit
+
+    @staticmethod
+    def store(repo: str, id: str, fingerprint: str):
+        """
+        Stores the fingerprint of a finished build, together with the commit the build created.
+
+        Parameters:
+        repo        (str): Path to the repository
+        id          (str): ID of the image
+        fingerprint (str): Fingerprint of the build
+        """
+        commit = Fingerprint.ref_commit(repo, id)
+        if commit is None:
+            logger.warning(f"No ref for {id} in {repo}, not storing the build fingerprint")
+            return
+        path = Fingerprint.path(repo, id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"fingerprint": fingerprint, "commit": commit}, f)
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,163 @@
+# helper.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import base64
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helper_server.py")
+
+
+class PrivilegedHelper:
+    """
+    Long-lived root process that runs the elevated commands of a build.
+    sudo is only invoked once, when the helper starts. While a helper is active,
+    Command.execute_command(elevated=True) sends its commands to it over a pipe instead of spawning sudo.
+    Only the programs in the allow-list of helper_server.py are run, and only on paths inside the given roots.
+    """
+
+    # The helper elevated commands are currently sent to
+    active = None
+
+    def __init__(self, enabled: bool = True, roots: list = []):
+        """
+        Parameters:
+        enabled (bool): Whether to start the helper. Elevated commands use sudo if False. Defaults to True if not specified
+        roots   (list): The directories elevated commands may touch, e.g. the build and cache directories
+        """
+        self.enabled = enabled
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.process = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = {}
+        self.next_id = 0
+        self.reader = None
+        self.alive = False
+
+    def __enter__(self):
+        if not self.enabled:
+            return self
+        command = ["sudo", sys.executable, SERVER] + self.roots
+        if os.environ.get("DEBUG"):
+            logger.debug("Command: " + " ".join(command))
+            if os.environ.get("SHARDS_FAKE"):
+                return self
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        ready = self.process.stdout.readline()
+        if ready.strip() == b"":
+            returncode = self.process.wait()
+            logger.error(f"Starting the privileged helper failed with returncode {returncode}")
+            sys.exit(returncode or 1)
+        self.alive = True
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.reader.start()
+        PrivilegedHelper.active = self
+        logger.info("Started privileged helper")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if PrivilegedHelper.active is self:
+            PrivilegedHelper.active = None
+        if self.process is not None:
+            # The helper exits once stdin is closed and the running commands have finished
+            self.process.stdin.close()
+            self.process.wait()
+            self.reader.join()
+            self.process.stdout.close()
+            self.process = None
+        return False
+
+    def read(self):
+        """
+        Passes the messages of the helper on to the callers waiting for them.
+        """
+        for line in self.process.stdout:
+            message = json.loads(line)
+            with self.lock:
+                waiting = self.pending.get(message.get("id"))
+            if waiting is not None:
+                waiting.put(message)
+        # The helper is gone, nobody would answer the waiting callers anymore
+        with self.lock:
+            self.alive = False
+            waiting = list(self.pending.values())
+        for messages in waiting:
+            messages.put({"returncode": 1, "error": "The privileged helper exited"})
+
+    def run(
+            self,
+            command: list,
+            workdir: str = "",
+            capture: bool = False,
+            line_callback = None
+    ) -> [int, bytes, bytes]:
+        """
+        Runs a command as root through the helper. Can be called from several threads at the same time.
+
+        Parameters:
+        command       (list): The command to run, each parameter is a seperate object in the list
+        workdir       (str) : In what directory the command should run. Runs in the current cwd if not specified
+        capture       (bool): Whether the command output should be captured. Defaults to False if not specified
+        line_callback (func): Called with every line of the combined stdout and stderr as bytes.
+                              The output is streamed instead of captured if set (optional)
+
+        Returns:
+        [int, bytes, bytes]: A list containing the returncode, stdout and stderr
+        """
+        messages = queue.Queue()
+        with self.lock:
+            if not self.alive:
+                logger.error("The privileged helper is not running")
+                return [1, None, None]
+            self.next_id += 1
+            id = self.next_id
+            self.pending[id] = messages
+        request = {
+            "id": id,
+            "command": command,
+            "cwd": os.path.abspath(workdir) if workdir.strip() != "" else os.getcwd(),
+            "capture": capture,
+            "stream": line_callback is not None,
+        }
+        try:
+            with self.write_lock:
+                self.process.stdin.write((json.dumps(request) + "\n").encode("UTF-8"))
+                self.process.stdin.flush()
+            while True:
+                message = messages.get()
+                if "output" in message:
+                    line_callback(base64.b64decode(message["output"]))
+                    continue
+                break
+        except (BrokenPipeError, ValueError):
+            message = {"returncode": 1, "error": "The privileged helper is not running"}
+        finally:
+            with self.lock:
+                self.pending.pop(id, None)
+
+        if message.get("error") is not None:
+            logger.error(message["error"])
+        stdout = base64.b64decode(message["stdout"]) if message.get("stdout") is not None else None
+        stderr = base64.b64decode(message["stderr"]) if message.get("stderr") is not None else None
+        return [message["returncode"], stdout, stderr]
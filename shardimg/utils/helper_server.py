@@ -0,0 +1,242 @@
+# helper_server.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+"""
+Privileged side of the shardimg helper. Started once as root by PrivilegedHelper and runs the elevated
+commands of a build, so that sudo doesn't have to be invoked for every one of them.
+
+Only uses the standard library, it runs outside of the shardimg installation with a plain sudo environment.
+
+Requests and responses are json objects, one per line, on stdin and stdout:
+request : {"id": 1, "command": ["mount", ...], "cwd": null, "capture": false, "stream": false}
+output  : {"id": 1, "output": "<base64 line>"}                       (stream requests only)
+response: {"id": 1, "returncode": 0, "stdout": "<base64>", "stderr": "<base64>", "error": null}
+
+Requests are handled concurrently. Output of commands that is neither captured nor streamed goes to stderr.
+
+The directories a build may touch are passed as arguments, e.g. the build and cache directories.
+Only the programs in ALLOWED are run, and only on paths inside these directories: the new root of chroot,
+the mountpoint and overlay upper and work directories of mount, and every path argument of umount, rm, cp,
+chown, strip and btrfs subvolume. nsenter may only enter a mount namespace and its command is checked the same way.
+The sources of mounts and the commands run inside a chroot are not restricted.
+"""
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+
+# Programs the helper runs, everything else is refused
+ALLOWED = ["mount", "umount", "chroot", "arch-chroot", "nsenter", "chown", "rm", "cp", "btrfs", "strip"]
+# Options that take the next argument as their value, by program
+VALUE_OPTIONS = {
+    "mount": ["-t", "--types", "-o", "--options"],
+    "chroot": ["--userspec", "--groups"],
+    "arch-chroot": ["-u"],
+    "nsenter": ["-t", "--target"],
+    "cp": ["-t", "--target-directory", "-S", "--suffix"],
+    "strip": ["-o", "-R", "--remove-section", "-K", "--keep-symbol", "-N", "--strip-symbol"],
+}
+# Options whose value is a path, by program
+PATH_OPTIONS = {
+    "cp": ["-t", "--target-directory"],
+    "strip": ["-o"],
+}
+# The only options nsenter may be run with
+NSENTER_OPTIONS = ["-t", "--target", "-m", "--mount"]
+# The btrfs subvolume commands used for build roots and cached layers
+BTRFS_COMMANDS = ["create", "delete", "snapshot"]
+
+
+def encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii") if data is not None else None
+
+
+def split(program: str, args: list, stop: bool = False) -> (list, list):
+    """
+    Splits the arguments of a program into options and positional arguments.
+
+    Parameters:
+    program (str) : The program the arguments belong to
+    args    (list): The arguments, without the program
+    stop    (bool): Whether everything from the first positional argument on is positional, e.g. the command run by chroot
+
+    Returns:
+    (list, list): (name, value) of every option, value is None for flags, and the positional arguments
+    """
+    options = []
+    positional = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if arg == "--":
+            positional.extend(args[index:])
+            break
+        if not arg.startswith("-") or arg == "-":
+            positional.append(arg)
+            if stop:
+                positional.extend(args[index:])
+                break
+            continue
+        if "=" in arg and arg.startswith("--"):
+            options.append(tuple(arg.split("=", 1)))
+        elif arg in VALUE_OPTIONS.get(program, []) and index < len(args):
+            options.append((arg, args[index]))
+            index += 1
+        else:
+            options.append((arg, None))
+    return (options, positional)
+
+
+class HelperServer:
+
+    def __init__(self, roots: list):
+        """
+        Parameters:
+        roots (list): The directories commands may touch
+        """
+        self.lock = threading.Lock()
+        self.roots = [os.path.realpath(root) for root in roots]
+
+    def inside(self, path: str, cwd: str) -> bool:
+        """
+        Checks if a path is inside one of the roots. Symlinks in the parent directories are resolved,
+        the last component is taken as is, since rm and cp act on a symlink and not on its target.
+        """
+        path = os.path.abspath(os.path.join(cwd or "/", path))
+        path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        return any(path == root or path.startswith(root + "/") for root in self.roots)
+
+    def check(self, command: list, cwd: str) -> str:
+        """
+        Checks that a command is allowed and only touches paths inside the roots.
+
+        Returns:
+        str: Why the command is refused, None if it is allowed
+        """
+        program = os.path.basename(command[0])
+        if program not in ALLOWED:
+            return command[0] + " is not allowed"
+        stop = program in ["chroot", "arch-chroot", "nsenter"]
+        (options, positional) = split(program, command[1:], stop=stop)
+        paths = [value for (name, value) in options if name in PATH_OPTIONS.get(program, [])]
+        if program == "nsenter":
+            if any(name not in NSENTER_OPTIONS for (name, value) in options) or len(positional) == 0:
+                return "nsenter may only run a command in the mount namespace of a build"
+            return self.check(positional, cwd)
+        elif program in ["chroot", "arch-chroot"]:
+            paths += positional[:1]
+        elif program == "mount":
+            paths += positional[-1:]
+            for (name, value) in options:
+                if name in ["-o", "--options"] and value is not None:
+                    paths += [option.split("=", 1)[1] for option in value.split(",")
+                              if option.startswith("upperdir=") or option.startswith("workdir=")]
+        elif program == "chown":
+            paths += positional[1:]
+        elif program == "btrfs":
+            if positional[:1] != ["subvolume"] or positional[1:2] == [] or positional[1] not in BTRFS_COMMANDS:
+                return "btrfs may only create, delete and snapshot subvolumes"
+            paths += positional[2:]
+        else:
+            paths += positional
+        if len(paths) == 0:
+            return program + " without a path is not allowed"
+        for path in paths:
+            if not self.inside(path, cwd):
+                return program + " may not touch " + path + ", it is outside of " + ", ".join(self.roots)
+        return None
+
+    def send(self, message: dict):
+        """
+        Writes a message to the client.
+        """
+        with self.lock:
+            sys.stdout.write(json.dumps(message) + "\n")
+            sys.stdout.flush()
+
+    def handle(self, request: dict):
+        """
+        Runs the command of a request and sends the result to the client.
+        """
+        command = request.get("command") or [""]
+        response = {"id": request.get("id"), "returncode": 0, "stdout": None, "stderr": None, "error": None}
+        refused = self.check(command, request.get("cwd"))
+        if refused is not None:
+            response["returncode"] = 126
+            response["error"] = refused
+            self.send(response)
+            return
+        try:
+            if request.get("stream"):
+                process = subprocess.Popen(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    cwd=request.get("cwd")
+                )
+                with process.stdout:
+                    for line in process.stdout:
+                        self.send({"id": request.get("id"), "output": encode(line)})
+                response["returncode"] = process.wait()
+            else:
+                capture = request.get("capture", False)
+                out = subprocess.run(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE if capture else sys.stderr.fileno(),
+                    stderr=subprocess.PIPE if capture else None,
+                    cwd=request.get("cwd")
+                )
+                response["returncode"] = out.returncode
+                response["stdout"] = encode(out.stdout)
+                response["stderr"] = encode(out.stderr)
+        except OSError as e:
+            response["returncode"] = 127
+            response["error"] = str(e)
+        self.send(response)
+
+    def serve(self):
+        """
+        Handles requests until stdin is closed, then waits for the running ones.
+        """
+        threads = []
+        for line in sys.stdin:
+            if line.strip() == "":
+                continue
+            thread = threading.Thread(target=self.handle, args=(json.loads(line),))
+            thread.start()
+            threads.append(thread)
+            threads = [thread for thread in threads if thread.is_alive()]
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == "__main__":
+    if os.geteuid() != 0:
+        print("The shardimg helper has to run as root", file=sys.stderr)
+        sys.exit(1)
+    roots = sys.argv[1:]
+    if len(roots) == 0 or any(os.path.realpath(root) == "/" for root in roots):
+        print("The shardimg helper needs the directories of the build, / is not allowed", file=sys.stderr)
+        sys.exit(1)
+    # Tells the client that authentication is done and requests can be sent
+    print(json.dumps({"ready": True}), flush=True)
+    HelperServer(roots).serve()
@@ -0,0 +1,275 @@
+# layers.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import hashlib
+import json
+import os
+import time
+from shardimg.utils.command import Command
+from shardimg.utils.files import FileUtils
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# Mountpoints inside the root, these are never part of a layer
+MOUNT_DIRS = ["proc", "sys", "dev"]
+
+
+class LayerCache:
+    """
+    Cache of build root snapshots, one per build phase.
+
+    Every layer is identified by a fingerprint over the inputs of its phase and the
+    fingerprint of the layer below it, so a changed input invalidates all layers above it.
+    Snapshots are btrfs subvolume snapshots if the root is a subvolume, otherwise
+    reflink copies (cp --reflink=auto) that fall back to regular copies.
+
+    Builds running in parallel share the cache. Layers are restored under a shared lock of the directory,
+    and only replaced or pruned under an exclusive one, so a layer never disappears while it is copied.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Parameters:
+        directory (str): The directory the layers are stored in
+        """
+        self.directory = directory
+
+    @staticmethod
+    def fingerprint(parent: str, kind: str, value) -> str:
+        """
+        Calculates the fingerprint of a layer.
+
+        Parameters:
+        parent (str): Fingerprint of the layer below, empty for the first layer
+        kind   (str): What kind of phase creates the layer
+        value       : The inputs of the phase, has to be serializable as json
+
+        Returns:
+        str: The fingerprint of the layer
+        """
+        return hashlib.sha256(json.dumps([parent, kind, value], sort_keys=True).encode("UTF-8")).hexdigest()
+
+    @staticmethod
+    def fingerprints(base: str, base_commit: str, packages: list, commands: list) -> list:
+        """
+        Calculates the fingerprints of the package layer and of one layer per command.
+
+        Parameters:
+        base        (str) : ID of the base image, empty if the image has no base
+        base_commit (str) : The commit of the installed base image
+        packages    (list): The packages to install
+        commands    (list): The commands to run after installing the packages
+
+        Returns:
+        list: The fingerprints, the package layer first
+        """
+        pacman_conf = ""
+        if os.path.exists("/etc/pacman.conf"):
+            with open("/etc/pacman.conf", "r") as f:
+                pacman_conf = f.read()
+        fingerprint = LayerCache.fingerprint("", "base", [base, base_commit])
+        fingerprint = LayerCache.fingerprint(fingerprint, "packages", [packages, pacman_conf])
+        fingerprints = [fingerprint]
+        for command in commands:
+            fingerprint = LayerCache.fingerprint(fingerprint, "command", command)
+            fingerprints.append(fingerprint)
+        return fingerprints
+
+    def layer_path(self, fingerprint: str) -> str:
+        """
+        Returns the directory a layer is stored in.
+        """
+        return self.directory + "/" + fingerprint
+
+    def find(self, fingerprints: list) -> int:
+        """
+        Finds the topmost layer that is cached.
+
+        Parameters:
+        fingerprints (list): The fingerprints of all layers, bottom layer first
+
+        Returns:
+        int: The index of the topmost cached layer. -1 if not even the bottom layer is cached
+        """
+        for index in reversed(range(len(fingerprints))):
+            if os.path.exists(self.layer_path(fingerprints[index]) + "/layer.json"):
+                return index
+        return -1
+
+    @staticmethod
+    def is_subvolume(path: str) -> bool:
+        """
+        Checks if a path is a btrfs subvolume.
+
+        Parameters:
+        path (str): The path to check
+        """
+        if not os.path.isdir(path) or os.stat(path).st_ino != 256:
+            return False
+        out = Command.execute_command(
+            command=["stat", "-f", "-c", "%T", path],
+            capture=True
+        )
+        return out[0] == 0 and out[1] is not None and out[1].decode("UTF-8").strip() == "btrfs"
+
+    @staticmethod
+    def create_root(root: str):
+        """
+        Creates an empty build root. The root is a btrfs subvolume if the build directory is on btrfs,
+        which allows snapshotting it without copying.
+
+        Parameters:
+        root (str): Path of the root to create
+        """
+        parent = os.path.dirname(os.path.abspath(root))
+        out = Command.execute_command(command=["stat", "-f", "-c", "%T", parent], capture=True)
+        subvolume = False
+        if out[0] == 0 and out[1] is not None and out[1].decode("UTF-8").strip() == "btrfs":
+            subvolume = Command.execute_command(
+                command=["btrfs", "subvolume", "create", root],
+                command_description=f"Create subvolume {root}",
+                crash=False
+            )[0] == 0
+        if not subvolume:
+            FileUtils.create_directory(root)
+        for directory in MOUNT_DIRS:
+            FileUtils.create_directory(root + "/" + directory)
+
+    @staticmethod
+    def delete_root(root: str):
+        """
+        Deletes a build root, regardless of whether it is a btrfs subvolume or a directory.
+
+        Parameters:
+        root (str): Path of the root to delete
+        """
+        if not os.path.exists(root):
+            return
+        if LayerCache.is_subvolume(root):
+            Command.execute_command(
+                command=["btrfs", "subvolume", "delete", root],
+                command_description=f"Delete subvolume {root}",
+                crash=True,
+                elevated=True
+            )
+            return
+        Command.execute_command(
+            command=["rm", "-rf", "--one-file-system", root],
+            command_description=f"Delete {root}",
+            crash=True,
+            elevated=True
+        )
+
+    @staticmethod
+    def copy_root(source: str, destination: str):
+        """
+        Snapshots a root, either with btrfs or with a reflink copy. Mountpoints are left empty.
+
+        Parameters:
+        source      (str): The root to snapshot
+        destination (str): Where the snapshot is created, must not exist yet
+        """
+        if LayerCache.is_subvolume(source):
+            # Fails if the destination is on a different filesystem, a regular copy is used then
+            if Command.execute_command(
+                command=["btrfs", "subvolume", "snapshot", source, destination],
+                command_description=f"Snapshot {source} to {destination}",
+                crash=False,
+                elevated=True
+            )[0] == 0:
+                return
+        FileUtils.create_directory(destination)
+        entries = [source + "/" + entry for entry in os.listdir(source) if entry not in MOUNT_DIRS]
+        if len(entries) > 0:
+            Command.execute_command(
+                command=["cp", "-a", "--reflink=auto"] + entries + [destination + "/"],
+                command_description=f"Copy {source} to {destination}",
+                crash=True,
+                elevated=True
+            )
+        for directory in MOUNT_DIRS:
+            FileUtils.create_directory(destination + "/" + directory)
+
+    def snapshot(self, root: str, fingerprint: str, description: str):
+        """
+        Stores the current state of the root as a layer.
+
+        Parameters:
+        root        (str): The build root
+        fingerprint (str): Fingerprint of the layer
+        description (str): Human readable description of the phase that created the layer
+        """
+        logger.info(f"Caching layer {fingerprint[:12]} ({description})")
+        path = self.layer_path(fingerprint)
+        with FileUtils.lock(self.directory):
+            if os.path.exists(path):
+                LayerCache.delete_root(path + "/root")
+                FileUtils.delete_directory(path)
+            FileUtils.create_directory(path)
+            LayerCache.copy_root(root, path + "/root")
+            with open(path + "/layer.json", "w") as f:
+                json.dump({"description": description, "created": int(time.time())}, f)
+
+    def restore(self, fingerprints: list, root: str) -> int:
+        """
+        Replaces the build root with the topmost cached layer. The layer is looked up and copied under one shared lock,
+        so a concurrent prune can't delete it in between.
+
+        Parameters:
+        fingerprints (list): The fingerprints of all layers, bottom layer first
+        root         (str) : The build root
+
+        Returns:
+        int: The index of the restored layer. -1 if no layer is cached, the root is left alone then
+        """
+        with FileUtils.lock(self.directory, shared=True):
+            index = self.find(fingerprints)
+            if index < 0:
+                return -1
+            path = self.layer_path(fingerprints[index])
+            with open(path + "/layer.json", "r") as f:
+                description = json.load(f)["description"]
+            logger.info(f"Restoring cached layer {fingerprints[index][:12]} ({description})")
+            LayerCache.delete_root(root)
+            LayerCache.copy_root(path + "/root", root)
+            os.utime(path + "/layer.json")
+        return index
+
+    def prune(self, max_layers: int):
+        """
+        Deletes the least recently used layers until at most max_layers are left.
+
+        Parameters:
+        max_layers (int): How many layers to keep
+        """
+        if not os.path.exists(self.directory):
+            return
+        with FileUtils.lock(self.directory):
+            layers = []
+            for fingerprint in os.listdir(self.directory):
+                path = self.layer_path(fingerprint)
+                if not os.path.isdir(path):
+                    continue
+                if not os.path.exists(path + "/layer.json"):
+                    layers.append((0, path))
+                    continue
+                layers.append((os.stat(path + "/layer.json").st_mtime, path))
+            layers.sort()
+            for (mtime, path) in layers[:max(len(layers) - max_layers, 0)]:
+                logger.info(f"Pruning layer {os.path.basename(path)}")
+                LayerCache.delete_root(path + "/root")
+                FileUtils.delete_directory(path)
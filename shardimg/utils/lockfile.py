@@ -0,0 +1,194 @@
+# lockfile.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from shardimg.utils.checksum import Checksum
+from shardimg.utils.command import Command
+from shardimg.utils.files import FileUtils
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+VERSION = 1
+# Name of the lockfile next to the manifest
+DEFAULT_NAME = "packages.lock.json"
+
+
+class PackageLock:
+    """
+    Lockfiles pin the packages of an image, including all dependencies, to exact package files.
+    shardimg lock resolves them against a fresh sync database in a temporary directory and downloads them
+    into the package cache. Builds with a lockfile install these files with pacman -U, without refreshing
+    the sync databases, so they are repeatable and work offline.
+
+    Format:
+    {"version": 1, "packages": [<packages of the manifest>],
+     "resolved": [{"name": ..., "version": ..., "repository": ..., "filename": ..., "sha256": ...}]}
+    """
+
+    @staticmethod
+    def default_path(manifest_path: str) -> str:
+        """
+        Returns where the lockfile of a manifest is kept by default.
+        """
+        return os.path.dirname(os.path.abspath(manifest_path)) + "/" + DEFAULT_NAME
+
+    @staticmethod
+    def digest(path: str) -> str:
+        """
+        Returns a hash of a lockfile, used to tell builds with different locked packages apart.
+        """
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def resolve(packages: list, cache_dir: str, log_file: str = None, workers: int = None) -> dict:
+        """
+        Resolves packages and their dependencies to exact package files and downloads them into the cache.
+
+        Parameters:
+        packages  (list): The packages of the manifest
+        cache_dir (str) : The package cache the files are downloaded to
+        log_file  (str) : File the output of pacman is written to instead of the terminal (optional)
+        workers   (int) : How many package files are hashed in parallel. Defaults to the cpu count if not specified
+
+        Returns:
+        dict: The lock
+        """
+        # Keeps concurrent prunes from deleting the downloaded packages before they are hashed
+        with FileUtils.lock(cache_dir, shared=True):
+            # An empty local database makes pacman resolve every dependency, the host database isn't touched
+            dbpath = tempfile.mkdtemp(prefix="shardimg-lock-")
+            try:
+                pacman = [
+                    "fakeroot",
+                    "pacman",
+                    "--noconfirm",
+                    "--dbpath",
+                    dbpath,
+                    "--config",
+                    "/etc/pacman.conf",
+                    "--cachedir",
+                    cache_dir
+                ]
+                Command.execute_command(
+                    command=pacman + ["-Sy"],
+                    command_description="Refreshing sync databases",
+                    crash=True,
+                    stream=log_file is not None,
+                    log_file=log_file
+                )
+                out = Command.execute_command(
+                    command=pacman + ["-Sp", "--print-format", "%n %v %r %f"] + packages,
+                    command_description="Resolving packages",
+                    crash=True,
+                    capture=True
+                )
+                resolved = []
+                for line in (out[1] or b"").decode("UTF-8").splitlines():
+                    fields = line.split()
+                    if len(fields) == 4:
+                        resolved.append({"name": fields[0], "version": fields[1], "repository": fields[2], "filename": fields[3]})
+                Command.execute_command(
+                    command=pacman + ["-Sw"] + packages,
+                    command_description="Downloading packages",
+                    crash=True,
+                    stream=log_file is not None,
+                    log_file=log_file
+                )
+            finally:
+                shutil.rmtree(dbpath, ignore_errors=True)
+
+            checksums = Checksum.checksum_files([cache_dir + "/" + package["filename"] for package in resolved],
+                                                workers=workers, algorithm="sha256")
+            for package, checksum in zip(resolved, checksums):
+                package["sha256"] = checksum
+            PackageLock.mark_used([cache_dir + "/" + package["filename"] for package in resolved])
+        logger.info(f"Locked {len(resolved)} packages")
+        return {"version": VERSION, "packages": packages, "resolved": resolved}
+
+    @staticmethod
+    def write(path: str, lock: dict):
+        with open(path, "w") as f:
+            json.dump(lock, f, ensure_ascii=False, indent=4)
+            f.write("\n")
+
+    @staticmethod
+    def load(path: str) -> dict:
+        if not os.path.exists(path):
+            logger.error(f"Lockfile {path} not found, create it with shardimg lock")
+            sys.exit(1)
+        with open(path, "r") as f:
+            lock = json.load(f)
+        if lock.get("version") != VERSION:
+            logger.error(f"Lockfile {path} has version {lock.get('version')}, only version {VERSION} is supported")
+            sys.exit(1)
+        return lock
+
+    @staticmethod
+    def verify(path: str, packages: list, cache_dir: str, workers: int = None) -> list:
+        """
+        Checks that a lockfile belongs to the packages of a manifest and that all locked files are in the cache,
+        with the locked checksums. Exits if not.
+
+        Parameters:
+        path      (str) : Path to the lockfile
+        packages  (list): The packages of the manifest
+        cache_dir (str) : The package cache
+        workers   (int) : How many package files are hashed in parallel. Defaults to the cpu count if not specified
+
+        Returns:
+        list: Paths of the locked package files, in the order of the lockfile
+        """
+        lock = PackageLock.load(path)
+        if sorted(lock["packages"]) != sorted(packages):
+            logger.error(f"Lockfile {path} was created for different packages, update it with shardimg lock")
+            sys.exit(1)
+        files = [cache_dir + "/" + package["filename"] for package in lock["resolved"]]
+        missing = [file for file in files if not os.path.isfile(file)]
+        if len(missing) > 0:
+            logger.error(f"{len(missing)} locked packages are not in {cache_dir}, download them with shardimg lock:\n"
+                         + "\n".join(os.path.basename(file) for file in missing))
+            sys.exit(1)
+        checksums = Checksum.checksum_files(files, workers=workers, algorithm="sha256")
+        mismatches = [package["filename"] for package, checksum in zip(lock["resolved"], checksums)
+                      if checksum != package["sha256"]]
+        if len(mismatches) > 0:
+            logger.error("Locked packages don't match their checksums:\n" + "\n".join(mismatches))
+            sys.exit(1)
+        PackageLock.mark_used(files)
+        return files
+
+    @staticmethod
+    def mark_used(files: list):
+        """
+        Marks locked package files as recently used, so that pruning the package cache keeps them.
+        pacman -S doesn't touch files that are already in the cache, and --needed skips installed packages,
+        so marking the installed packages alone would let locked files age out.
+
+        Parameters:
+        files (list): Paths of the locked package files
+        """
+        now = time.time()
+        for file in files:
+            if os.path.isfile(file):
+                os.utime(file, (now, now))
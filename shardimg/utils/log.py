@@ -1,45 +1,28 @@
 import logging
-import logging.config
-import yaml
+
+LOG_FORMAT = "%(name)s - %(lineno)d -  %(message)s"
+LOGGERS = ["shard_logging", "__main__"]
+
+configured = False
+
 
 def setup_logging():
     """
-    Sets up logging.
+    Sets up logging. Logging is only configured on the first call,
+    later calls just return the logger.
 
     Returns:
     logger: the logger object that can be used to output log messages
     """
-    logging_config = """
-version: 1
-
-formatters:
-    simple:
-        format: "%(name)s - %(lineno)d -  %(message)s"
-
-    complex:
-        format: "%(asctime)s - %(name)s - %(lineno)d -  %(message)s"
-
-
-handlers:
-    console:
-        class: logging.StreamHandler
-        level: DEBUG
-        formatter: simple
-
-loggers:
-
-    shard_logging:
-        level: DEBUG
-        handlers: [console]
-        propagate: yes
-
-    __main__:
-        level: DEBUG
-        handlers: [console]
-        propagate: yes
-
-    """
-
-    config = yaml.safe_load(logging_config)
-    logging.config.dictConfig(config)
+    global configured
+    if not configured:
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        for name in LOGGERS:
+            named_logger = logging.getLogger(name)
+            named_logger.setLevel(logging.DEBUG)
+            named_logger.addHandler(handler)
+            named_logger.propagate = True
+        configured = True
     return logging.getLogger("shard_logging")
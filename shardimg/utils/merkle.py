@@ -0,0 +1,222 @@
+# merkle.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import os
+from shardimg.utils.checksum import Checksum
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+
+def sort_key(path: str) -> str:
+    # Sorts a directory directly before its contents, so every subtree is a contiguous range of nodes
+    return path.replace("/", "\0")
+
+
+def parent(path: str) -> str:
+    return os.path.dirname(path) if path != "/" else None
+
+
+def depth(path: str) -> int:
+    return path.count("/") if path != "/" else 0
+
+
+class MerkleTree:
+    """
+    Merkle tree over the FsGuard file list. Every directory digest is the hash of the sorted
+    "<kind> <digest> <name>" lines of its children, so the digest of / covers every file in the list.
+    A subtree can be verified against the signed root digest by hashing only its own files,
+    and two trees are compared by descending only into the directories whose digests differ.
+
+    The tree file starts with "# merkle <algorithm>", followed by one "<kind> <digest> <path>" line per node
+    in sort_key order. kind is d for directories, f for files and s for suid files.
+    """
+
+    def __init__(self, nodes: dict, algorithm: str = "sha1"):
+        """
+        Parameters:
+        nodes     (dict): Path to (kind, hex digest) of every node
+        algorithm (str) : The hash algorithm of the digests. Defaults to sha1 if not specified
+        """
+        self.nodes = nodes
+        self.algorithm = algorithm
+        self.children = {}
+        for path in nodes:
+            if path != "/":
+                self.children.setdefault(parent(path), []).append(path)
+
+    @property
+    def root(self) -> str:
+        """
+        Returns the digest of /.
+        """
+        return self.nodes["/"][1]
+
+    @staticmethod
+    def build(entries: list, algorithm: str = "sha1") -> "MerkleTree":
+        """
+        Builds the tree over the files of a file list.
+
+        Parameters:
+        entries   (list): (path, hex digest, suid) tuples, paths are absolute inside the image. Repeated paths are only used once
+        algorithm (str) : The hash algorithm the file digests were calculated with. Defaults to sha1 if not specified
+
+        Returns:
+        MerkleTree: The tree
+        """
+        nodes = {"/": ("d", "")}
+        for (path, digest, suid) in entries:
+            if path in nodes:
+                continue
+            nodes[path] = ("s" if suid else "f", digest)
+            directory = parent(path)
+            while directory not in nodes:
+                nodes[directory] = ("d", "")
+                directory = parent(directory)
+        tree = MerkleTree(nodes, algorithm)
+        tree.hash_directories(list(nodes))
+        return tree
+
+    def hash_directories(self, paths: list):
+        """
+        Recalculates the digests of the given directories from their children, deepest directories first.
+        """
+        hasher = Checksum.hasher(self.algorithm)
+        for path in sorted((path for path in paths if self.nodes[path][0] == "d"),
+                           key=depth, reverse=True):
+            digest = hasher()
+            for child in sorted(self.children.get(path, []), key=sort_key):
+                (kind, child_digest) = self.nodes[child]
+                digest.update(f"{kind} {child_digest} {os.path.basename(child)}\n".encode("UTF-8", errors="surrogateescape"))
+            self.nodes[path] = ("d", digest.hexdigest())
+
+    def write(self, path: str):
+        """
+        Writes the tree file.
+        """
+        with open(path, "w", encoding="UTF-8", errors="surrogateescape") as f:
+            f.write(f"# merkle {self.algorithm}\n")
+            for node in sorted(self.nodes, key=sort_key):
+                (kind, digest) = self.nodes[node]
+                f.write(f"{kind} {digest} {node}\n")
+
+    @staticmethod
+    def load(path: str) -> "MerkleTree":
+        """
+        Reads a tree file.
+        """
+        nodes = {}
+        algorithm = "sha1"
+        with open(path, "r", encoding="UTF-8", errors="surrogateescape") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith("# merkle "):
+                    algorithm = line.split()[2]
+                    continue
+                if line.strip() == "" or line.startswith("#"):
+                    continue
+                (kind, digest, node) = line.split(" ", 2)
+                nodes[node] = (kind, digest)
+        return MerkleTree(nodes, algorithm)
+
+    def subtree(self, path: str) -> list:
+        """
+        Returns the path and all nodes below it.
+        """
+        nodes = []
+        pending = [path]
+        while pending:
+            node = pending.pop()
+            nodes.append(node)
+            pending.extend(self.children.get(node, []))
+        return nodes
+
+    def verify(self, root: str, path: str = "/", root_digest: str = None, workers: int = None) -> list:
+        """
+        Verifies the files of a subtree against the tree. Only the files below path are read,
+        the digests of the other branches are taken from the tree.
+
+        Parameters:
+        root        (str): The image root the files are read from
+        path        (str): The subtree to verify. Defaults to / if not specified
+        root_digest (str): The trusted, signed root digest. The digest in the tree is used if not specified
+        workers     (int): How many files are hashed in parallel. Defaults to the cpu count if not specified
+
+        Returns:
+        list: The files that are missing or whose digest differs. Contains / if the rest of the tree
+              doesn't match the root digest either
+        """
+        if path not in self.nodes:
+            logger.error(f"{path} is not in the Merkle tree")
+            return [path]
+        root_digest = root_digest or self.root
+        nodes = self.subtree(path)
+        files = [node for node in nodes if self.nodes[node][0] != "d"]
+        existing = [node for node in files if os.path.isfile(root + node)]
+        mismatches = list(set(files) - set(existing))
+        checksums = Checksum.checksum_files([root + node for node in existing], workers=workers, algorithm=self.algorithm)
+        actual = MerkleTree(dict(self.nodes), self.algorithm)
+        for node, checksum in zip(existing, checksums):
+            if checksum != self.nodes[node][1]:
+                mismatches.append(node)
+            actual.nodes[node] = (self.nodes[node][0], checksum)
+        # Recalculates the subtree and its ancestors, the result has to lead to the signed root
+        ancestors = []
+        ancestor = parent(path)
+        while ancestor is not None:
+            ancestors.append(ancestor)
+            ancestor = parent(ancestor)
+        actual.hash_directories(nodes + ancestors)
+        if actual.root != root_digest and len(mismatches) == 0:
+            mismatches.append("/")
+        return sorted(mismatches, key=sort_key)
+
+    @staticmethod
+    def diff(old: "MerkleTree", new: "MerkleTree") -> dict:
+        """
+        Compares two trees, descending only into the directories whose digests differ.
+
+        Parameters:
+        old (MerkleTree): The tree of the old image
+        new (MerkleTree): The tree of the new image
+
+        Returns:
+        dict: The added, removed and changed paths. Added and removed directories are listed
+              without their contents, files whose suid bit changed count as changed
+        """
+        result = {"added": [], "removed": [], "changed": []}
+        if old.algorithm != new.algorithm:
+            logger.error(f"Cannot compare a {old.algorithm} tree with a {new.algorithm} tree")
+            return None
+        pending = ["/"]
+        while pending:
+            directory = pending.pop()
+            if old.nodes[directory] == new.nodes[directory]:
+                continue
+            old_children = set(old.children.get(directory, []))
+            new_children = set(new.children.get(directory, []))
+            result["removed"].extend(old_children - new_children)
+            result["added"].extend(new_children - old_children)
+            for child in old_children & new_children:
+                (old_kind, old_digest) = old.nodes[child]
+                (new_kind, new_digest) = new.nodes[child]
+                if old_kind == "d" and new_kind == "d":
+                    pending.append(child)
+                elif old_kind != new_kind or old_digest != new_digest:
+                    result["changed"].append(child)
+        for paths in result.values():
+            paths.sort(key=sort_key)
+        return result
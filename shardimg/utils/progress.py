@@ -0,0 +1,71 @@
+# progress.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import re
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# (pattern, source, stage) for the progress lines of pacman and flatpak-builder
+PATTERNS = [
+    (re.compile(r"^\((?P<current>\d+)/(?P<total>\d+)\) (?P<item>.+)$"), "pacman", "step"),
+    (re.compile(r"^\s*(?P<item>\S+) downloading\.\.\.$"), "pacman", "download"),
+    (re.compile(r"^:: (?P<item>.+)$"), "pacman", "stage"),
+    (re.compile(r"^Starting module (?P<item>\S+)$"), "flatpak-builder", "module"),
+    (re.compile(r"^Building module (?P<item>\S+) in "), "flatpak-builder", "module"),
+    (re.compile(r"^Committing stage (?P<item>\S+) to cache$"), "flatpak-builder", "commit"),
+    (re.compile(r"^Exporting (?P<item>\S+) to repo$"), "flatpak-builder", "export"),
+    (re.compile(r"^Cleaning up$"), "flatpak-builder", "cleanup"),
+]
+
+
+class Progress:
+
+    @staticmethod
+    def parse(line: str) -> dict:
+        """
+        Parses a line of pacman or flatpak-builder output into a progress event.
+
+        Parameters:
+        line (str): The output line, without the trailing newline
+
+        Returns:
+        dict: The event with the keys source, stage and item, and current and total for numbered steps.
+              None if the line is not a progress line
+        """
+        for (pattern, source, stage) in PATTERNS:
+            match = pattern.match(line)
+            if match is None:
+                continue
+            event = {"source": source, "stage": stage, "item": match.groupdict().get("item", "").strip()}
+            if "current" in match.groupdict():
+                event["current"] = int(match.group("current"))
+                event["total"] = int(match.group("total"))
+            return event
+        return None
+
+    @staticmethod
+    def log(event: dict):
+        """
+        Logs a progress event.
+
+        Parameters:
+        event (dict): The event returned by Progress.parse
+        """
+        if "current" in event:
+            logger.info(f"{event['source']}: [{event['current']}/{event['total']}] {event['item']}")
+        else:
+            logger.info(f"{event['source']}: {event['stage']} {event['item']}".rstrip())
@@ -0,0 +1,251 @@
+# prune.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import fnmatch
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shardimg.utils.command import Command
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+# Directories that contain one subdirectory per locale
+LOCALE_DIRECTORIES = ["/usr/share/locale", "/usr/share/help", "/usr/share/man"]
+# Locales that are always kept
+DEFAULT_LOCALES = ["C", "POSIX"]
+# ELF files below these paths are never stripped, kernel modules may be signed
+STRIP_SKIP = ["/usr/lib/modules/*"]
+# How many files are passed to one strip invocation
+STRIP_BATCH = 64
+
+
+class PruneStats:
+    """
+    Files and bytes removed per rule.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.lock = threading.Lock()
+
+    def add(self, rule: str, files: int, size: int):
+        with self.lock:
+            (old_files, old_size) = self.rules.get(rule, (0, 0))
+            self.rules[rule] = (old_files + files, old_size + size)
+
+    @property
+    def bytes(self) -> int:
+        return sum(size for (files, size) in self.rules.values())
+
+    def __str__(self):
+        lines = [f"Pruned {self.bytes / 1024 / 1024:.1f} MiB"]
+        for rule, (files, size) in sorted(self.rules.items(), key=lambda item: item[1][1], reverse=True):
+            lines.append(f"  {size / 1024 / 1024:10.1f} MiB  {files:8} files  {rule}")
+        return "\n".join(lines)
+
+
+class Pruner:
+    """
+    Removes files an image doesn't need from a build root: paths matching exclude globs,
+    locales that aren't in the keep-list and the debug sections of ELF files.
+    """
+
+    def __init__(
+            self,
+            exclude: list = [],
+            locales: list = None,
+            strip: bool = False,
+            workers: int = None
+    ):
+        """
+        Parameters:
+        exclude (list): Glob patterns of paths in the image to remove, e.g. /usr/share/man/* or /usr/lib/*.a
+        locales (list): Locales to keep, e.g. en_US or de. A language keeps all of its variants. All locales are kept if not specified
+        strip   (bool): Whether to strip the debug sections of ELF files below /usr. Defaults to False if not specified
+        workers (int) : How many files are removed and stripped in parallel. Defaults to the cpu count if not specified
+        """
+        self.exclude = exclude
+        self.locales = locales
+        self.strip = strip
+        self.workers = workers or os.cpu_count() or 1
+        self.stats = PruneStats()
+
+    def keep_locale(self, name: str) -> bool:
+        """
+        Returns whether a locale directory is kept, e.g. de_DE.UTF-8 is kept if de or de_DE is in the keep-list.
+        """
+        if self.locales is None:
+            return True
+        language = name.split(".")[0].split("@")[0]
+        for locale in self.locales + DEFAULT_LOCALES:
+            if name == locale or language == locale or language.split("_")[0] == locale:
+                return True
+        return False
+
+    def rule(self, path: str, directory: bool) -> str:
+        """
+        Returns the rule that removes a path, None if it is kept.
+        """
+        for pattern in self.exclude:
+            if fnmatch.fnmatch(path, pattern):
+                return "exclude " + pattern
+        if directory and self.locales is not None and os.path.dirname(path) in LOCALE_DIRECTORIES:
+            name = os.path.basename(path)
+            # man sections like man1 aren't locales
+            if not (os.path.dirname(path) == "/usr/share/man" and name.startswith("man")) and not self.keep_locale(name):
+                return "locales"
+        return None
+
+    def scan(self, root: str) -> (list, list):
+        """
+        Walks a root once and collects what the rules remove and the files to strip.
+
+        Returns:
+        (list, list): (rule, path, is directory) of everything to remove and (path, size) of the strip candidates
+        """
+        removals = []
+        candidates = []
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            for dirname in list(dirnames):
+                path = dirpath[len(root):] + "/" + dirname
+                rule = self.rule(path, not os.path.islink(dirpath + "/" + dirname))
+                if rule is not None:
+                    removals.append((rule, path, not os.path.islink(dirpath + "/" + dirname)))
+                    # Nothing below a removed directory needs to be looked at
+                    dirnames.remove(dirname)
+            for file in filenames:
+                path = dirpath[len(root):] + "/" + file
+                rule = self.rule(path, False)
+                if rule is not None:
+                    removals.append((rule, path, False))
+                    continue
+                if self.strip and path.startswith("/usr/") and not any(fnmatch.fnmatch(path, pattern) for pattern in STRIP_SKIP):
+                    info = os.lstat(dirpath + "/" + file)
+                    if stat.S_ISREG(info.st_mode) and info.st_size > 0:
+                        candidates.append((path, info.st_size))
+        return (removals, candidates)
+
+    @staticmethod
+    def size(path: str, directory: bool) -> (int, int):
+        """
+        Returns the number of files and their size in bytes.
+        """
+        if not directory:
+            return (1, os.lstat(path).st_size)
+        files = 0
+        size = 0
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for file in filenames:
+                files += 1
+                size += os.lstat(dirpath + "/" + file).st_size
+        return (files, size)
+
+    def remove(self, root: str, rule: str, path: str, directory: bool) -> str:
+        """
+        Removes a path and counts it for its rule.
+
+        Returns:
+        str: The path if the current user isn't allowed to remove it, None otherwise
+        """
+        full = root + path
+        (files, size) = Pruner.size(full, directory)
+        self.stats.add(rule, files, size)
+        try:
+            if directory:
+                shutil.rmtree(full)
+            else:
+                os.remove(full)
+        except PermissionError:
+            return full
+        return None
+
+    @staticmethod
+    def is_elf(path: str) -> bool:
+        try:
+            with open(path, "rb") as f:
+                return f.read(4) == b"\x7fELF"
+        except OSError:
+            return False
+
+    @staticmethod
+    def writable(path: str) -> bool:
+        """
+        Returns whether the current user can strip a file, strip replaces it through a temporary file next to it.
+        """
+        return os.access(path, os.W_OK) and os.access(os.path.dirname(path), os.W_OK)
+
+    async def strip_batch(self, root: str, files: list, elevated: bool):
+        """
+        Strips the debug sections of a batch of ELF files and counts the bytes saved.
+        A batch that fails without elevation is retried elevated, in case some of its files belong to root.
+        """
+        out = await Command.execute_command_async(
+            command=["strip", "--strip-debug", "--preserve-dates"] + [root + path for (path, size) in files],
+            command_description=f"Stripping {len(files)} ELF files",
+            elevated=elevated,
+            crash=False
+        )
+        if out[0] != 0 and not elevated:
+            out = await Command.execute_command_async(
+                command=["strip", "--strip-debug", "--preserve-dates"] + [root + path for (path, size) in files],
+                command_description=f"Stripping {len(files)} ELF files elevated",
+                elevated=True,
+                crash=False
+            )
+        if out[0] != 0:
+            logger.warning("Some ELF files could not be stripped")
+        saved = sum(size - os.lstat(root + path).st_size for (path, size) in files)
+        self.stats.add("strip", len(files), saved)
+
+    def run(self, root: str) -> PruneStats:
+        """
+        Applies the rules to a root.
+
+        Parameters:
+        root (str): The build root
+
+        Returns:
+        PruneStats: How many files and bytes every rule removed
+        """
+        root = os.path.abspath(root)
+        (removals, candidates) = self.scan(root)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            denied = [path for path in executor.map(lambda removal: self.remove(root, *removal), removals)
+                      if path is not None]
+            elf = [file for (file, is_elf) in zip(candidates, executor.map(lambda file: Pruner.is_elf(root + file[0]), candidates))
+                   if is_elf]
+        coroutines = []
+        # pacman runs under fakeroot, so its files belong to the build user. Files created by the commands
+        # in the chroot belong to root, only the paths the current user couldn't remove are removed elevated
+        for start in range(0, len(denied), STRIP_BATCH):
+            coroutines.append(Command.execute_command_async(
+                command=["rm", "-rf"] + denied[start:start + STRIP_BATCH],
+                command_description="Removing pruned files",
+                elevated=True,
+                crash=True
+            ))
+        # Owners are mixed for the same reason, files are only stripped elevated if the current user can't write them
+        for elevated in [False, True]:
+            files = [file for file in elf if Pruner.writable(root + file[0]) != elevated]
+            for start in range(0, len(files), STRIP_BATCH):
+                coroutines.append(self.strip_batch(root, files[start:start + STRIP_BATCH], elevated))
+        if len(coroutines) > 0:
+            Command.run_async(*coroutines)
+        logger.info(str(self.stats))
+        return self.stats
@@ -16,13 +16,27 @@
 #
 # SPDX-License-Identifier: GPL-3.0-only
 
+import hashlib
 import os
-import yaml
+import random
+import shlex
+import string
+import sys
 import json
-import hashlib
+from shardimg.utils.checksum import Checksum
 from shardimg.utils.command import Command
+from shardimg.utils.disks import DiskUtils, BuildSandbox
 from shardimg.utils.files import FileUtils
+from shardimg.utils.cache import CacheUtils
+from shardimg.utils.lockfile import PackageLock
 from shardimg.classes.manifest import Manifest
+from shardimg.utils.trace import Trace
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+RUNTIME = "org.freedesktop.Platform"
+RUNTIME_VERSION = "22.08"
+SDK = "org.freedesktop.Sdk"
 
 
 class Shards:
@@ -30,14 +44,20 @@ class Shards:
     @staticmethod
     def initialize_base_image(
         base: str,
-        build_dir: str
+        build_dir: str,
+        overlay: bool = False,
+        log_file: str = None
     ):
         """
         Fetches the base image and populates the build directory accordingly.
 
         Parameters:
-        base      (str): ID of the base image
-        build_dir (str): Path to the build directory
+        base      (str) : ID of the base image
+        build_dir (str) : Path to the build directory
+        overlay   (bool): Whether to mount the base image as the read-only lower layer of an overlay instead of copying it.
+                          Only the changes of the new image end up in build_dir/upper. The base image is installed
+                          for the current user in this case, so that its files are writable through the overlay.
+        log_file  (str) : File the output of flatpak is written to instead of the terminal (optional)
         """
 
         Command.execute_command(
@@ -45,16 +65,20 @@ class Shards:
                 "flatpak",
                 "install",
                 "--assumeyes",
+            ] + (["--user"] if overlay else []) + [
                 base
             ],
             command_description=f"Fetching base image {base}",
             crash=True,
-            elevated=False
+            elevated=False,
+            stream=log_file is not None,
+            log_file=log_file
         )
         location=Command.execute_command(
             command=[
                 "flatpak",
                 "info",
+            ] + (["--user"] if overlay else []) + [
                 "-l",
                 base
             ],
@@ -65,100 +89,320 @@ class Shards:
         )
         location=location[1].decode("UTF-8").strip()
         FileUtils.create_directory(build_dir)
-        FileUtils.copy_directory(location+"/files/root", build_dir+"/root", True)
+        if not overlay:
+            FileUtils.copy_directory(location+"/files/root", build_dir+"/root", True)
+            return
+
+        FileUtils.create_directory(build_dir+"/upper")
+        FileUtils.create_directory(build_dir+"/work")
+        FileUtils.create_directory(build_dir+"/root")
+        DiskUtils.overlay_mount(
+            lowerdirs=[location+"/files/root"],
+            upperdir=os.path.abspath(build_dir+"/upper"),
+            destination=build_dir+"/root",
+            workdir=os.path.abspath(build_dir+"/work")
+        )
+
+    @staticmethod
+    def base_image_commit(base: str, user: bool = False, log_file: str = None) -> str:
+        """
+        Installs the base image if needed and returns the commit it is installed at.
+
+        Parameters:
+        base     (str) : ID of the base image
+        user     (bool): Whether the base image is installed for the current user instead of system wide
+        log_file (str) : File the output of flatpak is written to instead of the terminal (optional)
+
+        Returns:
+        str: The commit of the installed base image
+        """
+        Command.execute_command(
+            command=[
+                "flatpak",
+                "install",
+                "--assumeyes",
+            ] + (["--user"] if user else []) + [
+                base
+            ],
+            command_description=f"Fetching base image {base}",
+            crash=True,
+            elevated=False,
+            stream=log_file is not None,
+            log_file=log_file
+        )
+        commit=Command.execute_command(
+            command=[
+                "flatpak",
+                "info",
+            ] + (["--user"] if user else []) + [
+                "--show-commit",
+                base
+            ],
+            command_description=f"Getting installed commit of {base}",
+            crash=True,
+            elevated=False,
+            capture=True
+        )
+        return commit[1].decode("UTF-8").strip() if commit[1] is not None else ""
+
+    @staticmethod
+    def install_base_from_repo(repo: str, base: str, user: bool = False, log_file: str = None) -> bool:
+        """
+        Installs or updates a base image from a local repository, e.g. after it was built by build-all.
+        flatpak install alone keeps an installed base at its current commit and never looks at the local repository,
+        so the repository is added as a remote and the base is reinstalled from it if it came from somewhere else.
 
+        Parameters:
+        repo     (str) : Path to the repository the base image was committed to
+        base     (str) : ID of the base image
+        user     (bool): Whether the base image is installed for the current user instead of system wide
+        log_file (str) : File the output of flatpak is written to instead of the terminal (optional)
 
+        Returns:
+        bool: True if the base image is installed at the commit of the repository
+        """
+        repo = os.path.abspath(repo)
+        installation = ["--user"] if user else []
+        # One remote per repository, so that images from different repositories don't replace each other
+        remote = "shardimg-" + hashlib.sha256(repo.encode("UTF-8")).hexdigest()[:12]
+        if Command.execute_command(
+            command=[
+                "flatpak",
+                "remote-add",
+                "--if-not-exists",
+                "--no-gpg-verify",
+            ] + installation + [
+                remote,
+                "file://" + repo
+            ],
+            command_description=f"Adding {repo} as remote {remote}",
+            crash=False,
+            elevated=False
+        )[0] != 0:
+            return False
+        origin = Command.execute_command(
+            command=[
+                "flatpak",
+                "info",
+            ] + installation + [
+                "--show-origin",
+                base
+            ],
+            command_description=f"Getting origin of {base}",
+            crash=False,
+            elevated=False,
+            capture=True
+        )
+        if origin[0] == 0 and origin[1] is not None and origin[1].decode("UTF-8").strip() == remote:
+            command = ["flatpak", "update", "--assumeyes", "--noninteractive"] + installation + [base]
+        else:
+            command = ["flatpak", "install", "--assumeyes", "--noninteractive", "--reinstall"] + installation + [remote, base]
+        return Command.execute_command(
+            command=command,
+            command_description=f"Installing base image {base} from {repo}",
+            crash=False,
+            elevated=False,
+            stream=log_file is not None,
+            log_file=log_file
+        )[0] == 0
 
     @staticmethod
-    def install_packages(packages: list, root: str):
+    def install_packages(packages: list, root: str, cache_dir: str = None, log_file: str = None, lockfile: str = None):
         """
         Installs packages into a given root.
 
         Parameters:
-        packages (list): The list of packages to install
-        root     (str) : Path to the root where packages are going to be installed into
+        packages  (list): The list of packages to install
+        root      (str) : Path to the root where packages are going to be installed into
+        cache_dir (str) : Shared package cache that is kept across builds. If not specified,
+                          the cache inside the root is used and cleared after the installation
+        log_file  (str) : File the output of pacman is written to instead of the terminal (optional)
+        lockfile  (str) : Lockfile created by shardimg lock. The locked package files are installed from the cache
+                          without refreshing the sync databases if set, which requires cache_dir (optional)
+        """
+        if lockfile is not None and cache_dir is None:
+            logger.error("Installing packages from a lockfile requires a package cache")
+            sys.exit(1)
+        if cache_dir is None:
+            Shards.run_pacman(packages, root, None, log_file, None)
+            return
+        # Keeps concurrent prunes from deleting packages or partial downloads while pacman uses them
+        with FileUtils.lock(cache_dir, shared=True):
+            Shards.run_pacman(packages, root, cache_dir, log_file, lockfile)
+
+    @staticmethod
+    def run_pacman(packages: list, root: str, cache_dir: str, log_file: str, lockfile: str):
         """
+        Installs packages into a given root, see install_packages.
+        """
+        locked = PackageLock.verify(lockfile, packages, cache_dir) if lockfile is not None else None
         FileUtils.create_directory(root + "/var/lib/pacman")
         FileUtils.copy_file(source="/etc/pacman.conf", destination=root + "/pacman.conf", crash=True)
+        pacman = [
+            "fakechroot",
+            "fakeroot",
+            "pacman",
+            "--noconfirm",
+            "--root",
+            root,
+            "--dbpath",
+            root + "/var/lib/pacman",
+            "--config",
+            root + "/pacman.conf",
+        ]
+        if cache_dir is not None:
+            pacman.extend(["--cachedir", cache_dir])
         Command.execute_command(
-            command=[
-                        "fakechroot",
-                        "fakeroot",
-                        "pacman",
-                        "--noconfirm",
-                        "--root",
-                        root,
-                        "--dbpath",
-                        root + "/var/lib/pacman",
-                        "--config",
-                        root + "/pacman.conf",
+            command=pacman + [
                         "--needed",
                         "-Syu",
-                    ] + packages,
+                    ] + packages if locked is None else pacman + [
+                        "--needed",
+                        "-U",
+                    ] + locked,
             command_description="Installing packages",
             crash=True,
-            elevated=False
+            elevated=False,
+            stream=log_file is not None,
+            log_file=log_file
         )
+        if cache_dir is not None:
+            CacheUtils.mark_packages_used(cache_dir, root + "/var/lib/pacman")
+            return
         Command.execute_command(
-            command=[
-                        "fakechroot",
-                        "fakeroot",
-                        "pacman",
-                        "--noconfirm",
-                        "--root",
-                        root,
-                        "--dbpath",
-                        root + "/var/lib/pacman",
-                        "--config",
-                        root + "/pacman.conf",
+            command=pacman + [
                         "-Scc"
             ],
             command_description="Clearing pacman cache",
             crash=False,
-            elevated=False
+            elevated=False,
+            stream=log_file is not None,
+            log_file=log_file
         )
 
     @staticmethod
-    def execute_commands(commands: list, root: str):
+    def execute_commands(commands: list, root: str, batched: bool = False, log_file: str = None):
         """
         Executes Commands in a given root.
 
         Parameters:
         commands (list): The commands to run
         root     (str) : Path to the root to run the commands in
+        batched  (bool): Whether all commands should run in a single chroot session. Defaults to False if not specified
+        log_file (str) : File the output of the commands is written to instead of the terminal (optional)
         """
+        if batched and len(commands) > 1:
+            Shards.execute_commands_batched(commands, root, log_file=log_file)
+            return
         for command in commands:
-            Command.execute_command(
-                command=[
+            with Trace.span("Run " + command, category="command"):
+                Command.execute_command(
+                    command=BuildSandbox.wrap(root, [
+                        "chroot",
+                        root,
+                        "bash",
+                        "-c",
+                        command,
+                    ]),
+                    command_description="Run command "+command+" in chroot",
+                    crash=True,
+                    elevated=True,
+                    stream=log_file is not None,
+                    log_file=log_file
+                )
 
-                    "chroot",
-                    root,
-                    "bash",
-                    "-c",
-                    command,
-                ],
-                command_description="Run command "+command+" in chroot",
-                crash=True,
+    @staticmethod
+    def execute_commands_batched(commands: list, root: str, log_file: str = None):
+        """
+        Executes Commands in a given root using a single sudo and chroot invocation.
+        Every command still runs in its own bash, the session stops at the first failing command.
+        The exit status and runtime of every command is written to a status file in the root.
+
+        Parameters:
+        commands (list): The commands to run
+        root     (str) : Path to the root to run the commands in
+        log_file (str) : File the output of the commands is written to instead of the terminal (optional)
+        """
+        status_file = "/.shardimg-status-" + "".join(random.choices(string.ascii_lowercase, k=8))
+        script = [f"rm -f {status_file}"]
+        for index, command in enumerate(commands):
+            script.append(f"start=$EPOCHREALTIME; bash -c {shlex.quote(command)}; rc=$?")
+            script.append(f'echo "{index} $rc $start $EPOCHREALTIME" >> {status_file}')
+            script.append('if [ $rc -ne 0 ]; then exit $rc; fi')
+
+        out = Command.execute_command(
+            command=BuildSandbox.wrap(root, [
+                "chroot",
+                root,
+                "bash",
+                "-c",
+                "\n".join(script),
+            ]),
+            command_description="Run batched commands in chroot",
+            crash=False,
+            elevated=True,
+            stream=log_file is not None,
+            log_file=log_file
+        )
+        if os.environ.get("SHARDS_FAKE"):
+            return
+
+        statuses = []
+        if os.path.exists(root + status_file):
+            with open(root + status_file, "r") as f:
+                statuses = [line.split() for line in f.read().splitlines() if line.strip() != ""]
+            Command.execute_command(
+                command=["rm", "-f", root + status_file],
+                command_description="Remove command status file",
+                crash=False,
                 elevated=True
             )
 
+        for (index, returncode, start, end) in statuses:
+            command = commands[int(index)]
+            start = float(start.replace(",", "."))
+            end = float(end.replace(",", "."))
+            Trace.add("Run " + command, int(start * 1e9), int(end * 1e9), category="command",
+                      returncode=int(returncode))
+            if int(returncode) != 0:
+                logger.error("Run command "+command+" in chroot failed with returncode "+returncode)
+                sys.exit(int(returncode))
+            logger.info(f"Command {command} finished in {end - start:.2f}s")
+
+        if out[0] != 0:
+            logger.error("Running commands in chroot failed with returncode "+str(out[0]))
+            sys.exit(out[0])
+
     @staticmethod
-    def generate_flatpak_manifest(manifest: Manifest, build_dir: str):
+    def module_files(build_dir: str) -> list:
         """
-        Generates the flatpak manifest used to build a shards image.
+        Returns the flatpak-builder modules of the current build.
 
         Parameters:
-        manifest  (Manifest): The parsed Manifest with all values in it
-        build_dir (str)     : The build directory of the current build
-        """
+        build_dir (str): The build directory of the current build
 
+        Returns:
+        list: Absolute paths to the module files
+        """
         modules = []
-
         if os.path.exists(build_dir+"/modules"):
             for file in os.listdir(build_dir + "/modules"):
                 if not ".yml" in file or ".json" in file:
                     continue
                 modules.append(os.path.abspath(build_dir+"/modules/" + file))
+        return modules
+
+    @staticmethod
+    def generate_flatpak_manifest(manifest: Manifest, build_dir: str):
+        """
+        Generates the flatpak manifest used to build a shards image.
+
+        Parameters:
+        manifest  (Manifest): The parsed Manifest with all values in it
+        build_dir (str)     : The build directory of the current build
+        """
+
+        modules = Shards.module_files(build_dir)
 
         modules.append({
                         "name": "root",
@@ -188,15 +432,15 @@ class Shards:
         with open(build_dir + "/" + manifest.name + ".yml", "w") as f:
             flatpak_manifest=json.dumps({
                 "app-id": manifest.id,
-                "runtime": "org.freedesktop.Platform",
-                "runtime-version": "22.08",
-                "sdk": "org.freedesktop.Sdk",
+                "runtime": RUNTIME,
+                "runtime-version": RUNTIME_VERSION,
+                "sdk": SDK,
                 "modules": modules
             })
             f.write(flatpak_manifest)
 
     @staticmethod
-    def build_flatpak(manifest: Manifest, build_dir: str, repo: str):
+    def build_flatpak(manifest: Manifest, build_dir: str, repo: str, log_file: str = None):
         """
         Builds a flatpak using a previously generated manifest.
 
@@ -204,6 +448,7 @@ class Shards:
         manifest  (Manifest): The parsed Manifest with all values in it
         build_dir (str)     : The build directory of the current build
         repo      (str)     : Path to the repository where the build gets commited to
+        log_file  (str)     : File the output of flatpak-builder is written to instead of the terminal (optional)
         """
         Command.execute_command(
             command=[
@@ -215,14 +460,88 @@ class Shards:
             ],
             command_description="Building Flatpak",
             crash=True,
-            elevated=False
+            elevated=False,
+            stream=log_file is not None,
+            log_file=log_file
+        )
+
+    @staticmethod
+    def export_flatpak(manifest: Manifest, build_dir: str, repo: str, log_file: str = None):
+        """
+        Commits the root of the current build to the repository directly, without flatpak-builder.
+        The root is moved into an export directory and committed with flatpak build-export. If the image has an
+        include directory, the include directory and the root are mounted as a read-only overlay instead,
+        so the included files end up in the export like with flatpak-builder but never in the build root.
+        The ref and metadata are the same as with flatpak-builder. The root is moved back afterwards, it is never copied.
+
+        Parameters:
+        manifest  (Manifest): The parsed Manifest with all values in it
+        build_dir (str)     : The build directory of the current build
+        repo      (str)     : Path to the repository where the build gets commited to
+        log_file  (str)     : File the output of flatpak is written to instead of the terminal (optional)
+        """
+        root = os.path.abspath(build_dir + "/root")
+        export_dir = os.path.abspath(build_dir + "/export")
+        if os.path.exists(export_dir):
+            FileUtils.delete_directory(export_dir)
+        FileUtils.create_directory(export_dir + "/files/root")
+        include_dir = os.path.abspath(build_dir + "/include")
+        include = os.path.isdir(include_dir) and len(os.listdir(include_dir)) > 0
+
+        arch = Command.execute_command(
+            command=["flatpak", "--default-arch"],
+            command_description="Getting the default flatpak architecture",
+            crash=True,
+            capture=True
         )
+        arch = arch[1].decode("UTF-8").strip() if arch[1] else "x86_64"
+        FileUtils.create_file(export_dir + "/metadata")
+        FileUtils.write_file(
+            path=export_dir + "/metadata",
+            content="[Application]\n"
+                    f"name={manifest.id}\n"
+                    f"runtime={RUNTIME}/{arch}/{RUNTIME_VERSION}\n"
+                    f"sdk={SDK}/{arch}/{RUNTIME_VERSION}\n"
+        )
+        if os.path.exists(build_dir + "/" + manifest.name + ".yml"):
+            FileUtils.copy_file(build_dir + "/" + manifest.name + ".yml", export_dir + "/files/manifest.json", True)
+
+        # The upper layer of an overlay takes precedence, like cp include/* over the root
+        mounted = include or os.path.ismount(root)
+        if include:
+            DiskUtils.mount(
+                source="overlay",
+                mountpoint=export_dir + "/files/root",
+                options=["lowerdir=" + include_dir + ":" + root],
+                fs="overlay"
+            )
+        elif mounted:
+            # A mounted root (overlay builds) can't be renamed, it is bind mounted into the export directory instead
+            DiskUtils.bind_mount(root, export_dir + "/files/root")
+        else:
+            os.rmdir(export_dir + "/files/root")
+            os.rename(root, export_dir + "/files/root")
+        try:
+            Command.execute_command(
+                command=[
+                    "flatpak",
+                    "build-export",
+                    repo,
+                    export_dir
+                ],
+                command_description="Exporting image to repository",
+                crash=True,
+                elevated=False,
+                stream=log_file is not None,
+                log_file=log_file
+            )
+        finally:
+            if mounted:
+                DiskUtils.unmount(export_dir + "/files/root")
+            else:
+                os.rename(export_dir + "/files/root", root)
 
     @staticmethod
-    def fsguard_checksum(file):
-        sha1 = hashlib.sha1()
-        with open(file, 'rb') as f:
-            data = f.read()
-            sha1.update(data)
-        return sha1.hexdigest()
+    def fsguard_checksum(file, algorithm: str = "sha1"):
+        return Checksum.file_checksum(file, algorithm=algorithm)
     
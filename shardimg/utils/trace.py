@@ -0,0 +1,160 @@
+# trace.py
+#
+# Copyright 2023 axtlos <axtlos@getcryst.al>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# SPDX-License-Identifier: GPL-3.0-only
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from shardimg.utils.log import setup_logging
+logger=setup_logging()
+
+
+class Trace:
+    """
+    Records how long the phases of a build take.
+
+    Spans are collected for the whole process and can be written as a Chrome trace event file,
+    which can be opened in chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    events = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    @staticmethod
+    @contextmanager
+    def span(name: str, category: str = "build", **args):
+        """
+        Records the runtime of everything inside the with block.
+
+        Parameters:
+        name     (str): Name of the span
+        category (str): Category of the span, used to group spans in the trace viewer
+        args          : Additional information to attach to the span
+        """
+        depth = getattr(Trace.local, "depth", 0)
+        Trace.local.depth = depth + 1
+        start = time.time_ns()
+        try:
+            yield
+        except BaseException as e:
+            args["error"] = repr(e)
+            raise
+        finally:
+            Trace.local.depth = depth
+            Trace.add(name, start, time.time_ns(), category, depth, **args)
+
+    @staticmethod
+    def bind(function):
+        """
+        Wraps a function so that the spans it records in another thread are nested below the current span.
+
+        Parameters:
+        function (func): The function to wrap
+
+        Returns:
+        func: The wrapped function
+        """
+        depth = getattr(Trace.local, "depth", 0)
+
+        def wrapper(*args, **kwargs):
+            previous = getattr(Trace.local, "depth", 0)
+            Trace.local.depth = depth
+            try:
+                return function(*args, **kwargs)
+            finally:
+                Trace.local.depth = previous
+        return wrapper
+
+    @staticmethod
+    def add(name: str, start: int, end: int, category: str = "build", depth: int = None, **args):
+        """
+        Records a span that has already finished.
+
+        Parameters:
+        name     (str): Name of the span
+        start    (int): Start time in nanoseconds since the epoch
+        end      (int): End time in nanoseconds since the epoch
+        category (str): Category of the span
+        depth    (int): Nesting level of the span. Defaults to the level of the current span if not specified
+        args          : Additional information to attach to the span
+        """
+        if depth is None:
+            depth = getattr(Trace.local, "depth", 0)
+        with Trace.lock:
+            Trace.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": dict(args, depth=depth),
+            })
+
+    @staticmethod
+    def write(path: str):
+        """
+        Writes all recorded spans as a Chrome trace event file.
+
+        Parameters:
+        path (str): Where to write the trace to
+        """
+        with Trace.lock:
+            events = sorted(Trace.events, key=lambda event: event["ts"])
+        metadata = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": "shardimg"},
+        }]
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+        logger.info(f"Wrote build trace to {path}")
+
+    @staticmethod
+    def summary(max_depth: int = 2) -> str:
+        """
+        Formats the recorded spans as a table, in the order they started.
+
+        Parameters:
+        max_depth (int): Spans nested deeper than this are left out
+
+        Returns:
+        str: The table
+        """
+        with Trace.lock:
+            events = sorted(Trace.events, key=lambda event: event["ts"])
+        if len(events) == 0:
+            return ""
+        total = sum(event["dur"] for event in events if event["args"]["depth"] == 0) or 1
+        rows = []
+        for event in events:
+            depth = event["args"]["depth"]
+            if depth > max_depth:
+                continue
+            name = "  " * depth + event["name"]
+            if len(name) > 60:
+                name = name[:57] + "..."
+            rows.append(f"{name:<60} {event['dur'] / 1000000:>10.2f}s {event['dur'] / total * 100:>6.1f}%")
+        header = f"{'Phase':<60} {'Time':>11} {'Share':>7}"
+        return "\n".join([header, "-" * len(header)] + rows)